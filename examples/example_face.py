@@ -70,25 +70,19 @@ for i in range(0, len(SYMBOLS)):
                                                    'prob_success': 0.99, \
                                                    'bp_algo': 'sum'})
 
-    tmp_dict['var_ids'] = np.zeros(IM_SZ, dtype='int')
-    tmp_dict['fact_ids'] = np.zeros(IM_SZ, dtype='int')
-
     sym_super_nodes[sym] = tmp_dict
 
 #create variable nodes for presene/absence of each object and its connecting
-#noisy-or factor. Cconnect these entities together.
+#noisy-or factor, one per pixel. Connect these entities together.
 for sym in SYMBOLS:
     chunk_dict = sym_super_nodes[sym]
 
-    for i in range(0, IM_SZ[0]):
-        for j in range(0, IM_SZ[1]):
-
-            chunk_dict['var_ids'][i, j] = chunk_dict['vars'].create_nodes(1)[0]
-
-            chunk_dict['fact_ids'][i, j] = chunk_dict['noisy'].create_nodes(1)[0]
-            bpg.add_edge(chunk_dict['vars'], chunk_dict['var_ids'][i, j], \
-                         chunk_dict['noisy'], chunk_dict['fact_ids'][i, j], \
-                         'output')
+    num_pixels = IM_SZ[0]*IM_SZ[1]
+    chunk_dict['var_ids'] = np.reshape(chunk_dict['vars'].create_nodes(num_pixels), IM_SZ)
+    chunk_dict['fact_ids'] = np.reshape(chunk_dict['noisy'].create_nodes(num_pixels), IM_SZ)
+    bpg.add_edges(chunk_dict['vars'], chunk_dict['var_ids'], \
+                  chunk_dict['noisy'], chunk_dict['fact_ids'], \
+                  'output')
 
 face_super_nodes = sym_super_nodes['face']
 
@@ -117,47 +111,27 @@ for ch_ind in range(0, len(FACE_PARTS)):
 
     tmp_cat_vars = VarNodes(face_part + '_vars_cat' + str(ch_ind), {'num_states': 2})
 
+    #create categorical nodes, one per pixel
+    cat_ids = np.reshape(tmp_cat_nodes.create_nodes(IM_SZ[0]*IM_SZ[1]), IM_SZ)
+    bpg.add_edges(face_super_nodes['vars'], face_super_nodes['var_ids'], \
+                  tmp_cat_nodes, cat_ids, 'input')
+
+    #create categorical variable nodes, one image per choice. choice c of the
+    #categorical node at (i,j) is output c of that node.
+    cat_var_ids = np.reshape(tmp_cat_vars.create_nodes(num_choices*IM_SZ[0]*IM_SZ[1]), \
+                             [num_choices] + IM_SZ)
+    bpg.add_stencil_edges(tmp_cat_vars, cat_var_ids, tmp_cat_nodes, cat_ids, \
+                          np.zeros((num_choices, 2), dtype='int'), 'output')
+
+    #hook up categorical variables to noisy-or factors: choice (ii,jj) of the
+    #region of the face at (i,j) is an input of the noisy-or factor at
+    #(i,j)+offset+(ii,jj). the last choice (no part) has no noisy-or factor.
     ch_chunk = sym_super_nodes[face_part]
-    for i in range(0, IM_SZ[0]):
-        for j in range(0, IM_SZ[1]):
-
-            #create categorical node
-            cat_id = tmp_cat_nodes.create_nodes(1)[0]
-            bpg.add_edge(face_super_nodes['vars'], \
-                         face_super_nodes['var_ids'][i, j], \
-                         tmp_cat_nodes, \
-                         cat_id, \
-                         'input')
-
-            #create categorical variable nodes
-            cat_var_ids = tmp_cat_vars.create_nodes(num_choices)
-            for c_id in cat_var_ids:
-                bpg.add_edge(tmp_cat_vars, \
-                             c_id, \
-                             tmp_cat_nodes, \
-                             cat_id, \
-                             'output')
-
-            #hook up categorical variables to noisy-or factors
-            ct = 0
-            for ii in range(0, REGION_SIZES[ch_ind][0]):
-                ii_use = ii+i+offset[0]
-
-                if ii_use < 0 or ii_use >= IM_SZ[0]:
-                    continue
-
-                for jj in range(0, REGION_SIZES[ch_ind][1]):
-                    jj_use = jj+j+offset[1]
-
-                    if jj_use < 0 or jj_use >= IM_SZ[1]:
-                        continue
-
-                    bpg.add_edge(tmp_cat_vars, \
-                                 cat_var_ids[ct], \
-                                 ch_chunk['noisy'], \
-                                 ch_chunk['fact_ids'][ii_use, jj_use], \
-                                'input')
-                    ct += 1
+    (region_ii, region_jj) = np.mgrid[0:REGION_SIZES[ch_ind][0], 0:REGION_SIZES[ch_ind][1]]
+    region_offsets = np.stack([region_ii.ravel() + offset[0], \
+                               region_jj.ravel() + offset[1]], axis=1)
+    bpg.add_stencil_edges(tmp_cat_vars, cat_var_ids[:-1], ch_chunk['noisy'], \
+                          ch_chunk['fact_ids'], region_offsets, 'input')
 
     bpg.add_nodes_to_schedule(tmp_cat_nodes)
     bpg.add_nodes_to_schedule(tmp_cat_vars)
@@ -9,6 +9,7 @@ from skimage import color
 import scipy as sp
 import pylab
 from graph import BpGraph
+from graph import MultiscaleBp
 from nodesLib import VarNodes
 from nodesLib import PottsNodes
 import matplotlib.pyplot as plt
@@ -57,8 +58,9 @@ obs_vals = np.exp(obs_dist-sp.misc.logsumexp(obs_dist, 2, keepdims=True))
 #rasterize
 obs_vals = np.reshape(obs_vals, [obs_vals.shape[0]*obs_vals.shape[1], obs_vals.shape[2]])
 
-#create the factor graph object
-bpg = BpGraph(bp_params={'damp': 0.25})
+#create the factor graph object. damping is adapted per edge, so it does not
+#need to be tuned for this model.
+bpg = BpGraph(bp_params={'damp_mode': 'adaptive'})
 
 #create a container for variable nodes.
 var_nodes = VarNodes('var', {'num_states': NUM_STATES})
@@ -88,11 +90,13 @@ for i in range(0, IM_SZ[0]-1):
 bpg.add_nodes_to_schedule(var_nodes)
 bpg.add_nodes_to_schedule(potts_nodes)
 
-#prepare graph object for inference
-bpg.finalize()
+#prepare graph object for inference. inference runs coarse-to-fine, on a
+#pyramid of coarser grids built from this one, so evidence travels across the
+#image in few iterations.
+multiscale = MultiscaleBp(bpg, var_nodes, node_ids)
 
 #do inference
-bpg.do_message_passing()
+multiscale.do_message_passing()
 
 #get resulting beliefs
 bel = var_nodes.get_beliefs()
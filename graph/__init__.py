@@ -1,4 +1,16 @@
 from bp_graph import BpGraph
 from graph_edge_info import GraphEdgeInfo
+from adaptive_damping import AdaptiveDamping
+from schedule_block import ScheduleBlock
+from compiled_graph import CompiledGraph, InferenceState
+from distributed_bp import DistributedBp
+from graph_packer import GraphPacker
+from graph_reorderer import GraphReorderer
+from lifted_bp import LiftedBp
+from lazy_bp import LazyBp
+from multiscale_bp import MultiscaleBp
+from inference_server import InferenceServer, LocalClient
 
-__all__ = ['bp_graph', 'graph_edge_info']
\ No newline at end of file
+__all__ = ['adaptive_damping', 'bp_graph', 'compiled_graph', 'distributed_bp', \
+           'graph_edge_info', 'graph_packer', 'graph_reorderer', 'inference_server', \
+           'lazy_bp', 'lifted_bp', 'multiscale_bp', 'schedule_block']
@@ -0,0 +1,111 @@
+"""Module for the AdaptiveDamping class. See documentation for AdaptiveDamping
+class."""
+
+import numpy as np
+from nodesLib import MessageChunk
+
+class AdaptiveDamping(object):
+    """This class keeps per-edge damping factors for the messages of a factor
+    graph and adapts them from the observed trend of the message updates.
+
+    For every incoming message (ie, every row of a MessageChunk's messages when
+    prepared for distribution), the direction of the last update is stored.
+    If the new update points against the last one (the message oscillates),
+    the damping of that edge is moved towards damp_max. If it points in the
+    same direction, the damping is decayed towards damp_min. Optionally, edges
+    that keep moving in the same direction are over-relaxed (their step is
+    scaled by accel_omega) to speed up convergence.
+
+    Public methods:
+        update: applies a damped (and possibly over-relaxed) update to the
+            messages of a MessageChunk.
+
+        reset: forgets all per-edge damping state.
+    """
+
+    ACCEL_TYPES = frozenset({'none', 'overrelax'})
+
+    def __init__(self, damp_init, damp_min=0.0, damp_max=0.95, accel='none', \
+                 accel_omega=1.5):
+        """Initializer.
+
+        Args:
+            damp_init (double): initial damping for every edge.
+
+            damp_min (double, optional): smallest damping an edge may take.
+                Defaults to 0.
+
+            damp_max (double, optional): largest damping an edge may take.
+                Defaults to 0.95.
+
+            accel (str, optional): extrapolation to apply to edges whose
+                updates keep the same direction. One of ACCEL_TYPES. Defaults
+                to 'none'.
+
+            accel_omega (double, optional): over-relaxation factor used when
+                accel is 'overrelax'. Must be >= 1. Defaults to 1.5.
+        """
+
+        assert 0 <= damp_min <= damp_max < 1, \
+               'Must have 0 <= damp_min <= damp_max < 1'
+        assert accel in self.ACCEL_TYPES, 'Invalid accel type: ' + str(accel)
+        assert accel_omega >= 1, 'accel_omega must be >= 1'
+
+        self.damp_init = min(max(damp_init, damp_min), damp_max)
+        self.damp_min = damp_min
+        self.damp_max = damp_max
+        self.accel = accel
+        self.accel_omega = accel_omega
+
+        #key: MessageChunk. value: [per-row damping, per-row previous update]
+        self.__edge_state = {}
+
+    def reset(self):
+        """Forgets all per-edge damping state."""
+
+        self.__edge_state = {}
+
+    def update(self, msg_dest, dest_idxs, new_msgs):
+        """Applies a damped (and possibly over-relaxed) update to the messages
+        of a MessageChunk. msg_dest must be prepared for distribution.
+
+        Args:
+            msg_dest (:obj: MessageChunk): the MessageChunk receiving messages.
+
+            dest_idxs (ndarray): rows of msg_dest.msgs_in being updated.
+
+            new_msgs (ndarray): the incoming messages, one row per entry of
+                dest_idxs.
+        """
+
+        if msg_dest not in self.__edge_state:
+            num_rows = msg_dest.msgs_in.shape[0]
+            self.__edge_state[msg_dest] = \
+                [self.damp_init*np.ones(num_rows), \
+                 np.zeros((num_rows, msg_dest.num_states))]
+
+        (damp, prev_delta) = self.__edge_state[msg_dest]
+
+        delta = new_msgs - msg_dest.msgs_in[dest_idxs, :]
+        trend = np.sum(delta*prev_delta[dest_idxs, :], axis=1)
+
+        #oscillating edges get more damping, steadily moving edges get less
+        d_use = damp[dest_idxs]
+        d_use = np.where(trend < 0, 0.5*(d_use + self.damp_max), d_use)
+        d_use = np.where(trend > 0, np.maximum(0.8*d_use, self.damp_min), d_use)
+        damp[dest_idxs] = d_use
+
+        step = 1-d_use
+        if self.accel == 'overrelax':
+            step = np.where(trend > 0, self.accel_omega*step, step)
+
+        delta *= step[:, np.newaxis]
+        prev_delta[dest_idxs, :] = delta
+
+        upd = msg_dest.msgs_in[dest_idxs, :] + delta
+        if self.accel == 'overrelax':
+            #extrapolation can overshoot the simplex
+            upd = np.maximum(upd, MessageChunk._MSG_MIN_VAL)
+            upd /= np.sum(upd, axis=1, keepdims=True)
+
+        msg_dest.msgs_in[dest_idxs, :] = upd
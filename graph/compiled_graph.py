@@ -0,0 +1,169 @@
+"""Module for the CompiledGraph and InferenceState classes. See documentation
+for CompiledGraph class."""
+
+from nodesLib import VarNodes
+from nodesLib import RunState
+
+class CompiledGraph(object):
+    """This class is a read-only view of the structure of a finalized BpGraph:
+    its nodes, potentials, edges, schedule and message-passing parameters.
+    Everything that changes during message-passing (messages, beliefs,
+    evidence, message computation buffers, convergence bookkeeping) lives in
+    InferenceState objects instead, so any number of them can run
+    message-passing on the same CompiledGraph concurrently, one per thread,
+    without copying the structure.
+
+    The BpGraph must not be modified (nodes, edges, potentials) once
+    compiled. Its own messages become the initial messages of every new
+    InferenceState.
+
+    Public methods:
+        new_state: creates an InferenceState for this CompiledGraph.
+
+        get_nbytes: get the memory held by the structure and by the messages
+            new states start from.
+    """
+
+    def __init__(self, bpg):
+        """Initializer. Finalizes bpg if it has not been finalized yet.
+
+        Args:
+            bpg (:obj: BpGraph): the factor graph to compile.
+        """
+
+        if not bpg.is_finalized:
+            bpg.finalize()
+
+        #lazily merged unary potentials are part of the structure. merge them
+        #now, so states never write to it.
+        for nodes in bpg.get_scheduled_nodes():
+            if isinstance(nodes, VarNodes):
+                nodes.has_unaries()
+
+        self.bpg = bpg
+        self.topology_hash = bpg.topology_hash()
+
+    def new_state(self):
+        """Returns a new InferenceState for this CompiledGraph."""
+
+        return InferenceState(self)
+
+    def get_nbytes(self):
+        """Returns the number of bytes held by the structure of the factor
+        graph and by the messages new states start from.
+        """
+
+        return self.bpg.get_nbytes()
+
+class InferenceState(object):
+    """This class holds the state of message-passing runs on a CompiledGraph:
+    incoming messages, beliefs, evidence, message computation buffers and
+    convergence bookkeeping. Messages are copied from the compiled graph
+    lazily, the first time each MessageChunk is used.
+
+    An InferenceState must only be used by one thread at a time; different
+    InferenceStates of one CompiledGraph may be used by different threads at
+    the same time.
+
+    Public methods:
+        do_message_passing: performs message-passing (see
+            BpGraph.do_message_passing).
+
+        iter_message_passing: generator version of do_message_passing (see
+            BpGraph.iter_message_passing).
+
+        get_beliefs: get the beliefs of variable nodes.
+
+        set_evidence: sets hard evidence on variable nodes.
+
+        clear_evidence: removes the evidence of variable nodes.
+
+        reset_run: discards the progress of a stopped message-passing run.
+
+        get_nbytes: get the memory held by this state.
+    """
+
+    def __init__(self, compiled):
+        """Initializer.
+
+        Args:
+            compiled (:obj: CompiledGraph): the graph this state runs on.
+        """
+
+        self.compiled = compiled
+        self.__state = RunState()
+        self.__runner = compiled.bpg._new_run_view()
+
+    def do_message_passing(self, max_seconds=None, max_iters=None, query=None):
+        """Performs message-passing with the messages of this state. See
+        BpGraph.do_message_passing.
+        """
+
+        with self.__state:
+            return self.__runner.do_message_passing(max_seconds, max_iters, query)
+
+    def iter_message_passing(self, max_seconds=None, max_iters=None, query=None):
+        """Generator version of do_message_passing. See
+        BpGraph.iter_message_passing. The state is only bound to the calling
+        thread while the generator runs, so other states may be used in
+        between snapshots.
+        """
+
+        with self.__state:
+            snapshots = self.__runner.iter_message_passing(max_seconds, max_iters, query)
+
+        while True:
+            with self.__state:
+                try:
+                    snapshot = next(snapshots)
+                except StopIteration:
+                    return
+            yield snapshot
+
+    def get_beliefs(self, var_nodes, node_ids=None):
+        """Returns the beliefs of variable nodes in this state. See
+        VarNodes.get_beliefs.
+
+        Args:
+            var_nodes (:obj: VarNodes): scheduled VarNodes instance of the
+                compiled graph.
+
+            node_ids (ndarray, optional): ids of the variable nodes. Defaults
+                to all variable nodes.
+        """
+
+        with self.__state:
+            return var_nodes.get_beliefs(node_ids)
+
+    def set_evidence(self, var_nodes, node_ids, states):
+        """Sets hard evidence on variable nodes in this state, replacing any
+        evidence of var_nodes set before. See VarNodes.set_evidence. A stopped
+        run is discarded, so the next run starts anew.
+        """
+
+        with self.__state:
+            var_nodes.set_evidence(node_ids, states)
+        self.__runner.reset_run()
+
+    def clear_evidence(self, var_nodes):
+        """Removes the evidence of variable nodes in this state. See
+        VarNodes.clear_evidence.
+        """
+
+        with self.__state:
+            var_nodes.clear_evidence()
+        self.__runner.reset_run()
+
+    def reset_run(self):
+        """Discards the progress of a stopped message-passing run. See
+        BpGraph.reset_run.
+        """
+
+        self.__runner.reset_run()
+
+    def get_nbytes(self):
+        """Returns the number of bytes held by the messages, beliefs and
+        evidence of this state.
+        """
+
+        return self.__state.nbytes()
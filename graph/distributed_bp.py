@@ -0,0 +1,417 @@
+"""Module for the DistributedBp class. See documentation for DistributedBp
+class."""
+
+import time
+import traceback
+import multiprocessing
+import numpy as np
+from scipy import sparse
+from scipy.sparse import csgraph
+from nodesLib import VarNodes
+from nodesLib import MessageChunk
+from adaptive_damping import AdaptiveDamping
+
+class DistributedBp(object):
+    """This class performs loopy belief propagation on a finalized BpGraph with
+    its nodes partitioned across worker processes.
+
+    Every worker owns a part of the nodes of every scheduled Nodes instance:
+    it computes the messages of its nodes, and it is the only process writing
+    to the incoming messages of its nodes. Messages sent to nodes owned by
+    another worker (the halo) are sent to a coordinator (the calling process)
+    after every step of the schedule, which routes them to their owners. The
+    coordinator also aggregates the changes in beliefs of all workers to
+    decide convergence, and collects the messages of all workers once
+    message-passing stops, so the BpGraph can be used as usual afterwards.
+
+    Workers are started before any part is built, and every worker is then
+    sent its part only: copies of the Nodes instances holding just the nodes
+    it owns, renumbered, with their incoming messages (see
+    Nodes._take_nodes), and the routing of their messages in the new ids.
+    The coordinator holds the BpGraph and the routing of all parts, and
+    copies the messages of the parts one worker at a time, so every worker
+    holds its part only, and the memory of a worker falls with the number
+    of workers.
+
+    Message-passing follows the schedule and damping of the BpGraph, with
+    one pass over the scheduled Nodes instances per iteration, distributing
+    all messages (bp_params['distribute_tol'] is not used). Queries,
+    per-component convergence (bp_params['split_components']), the exact
+    tree schedule and sparse messages are not supported.
+
+    Public methods:
+        do_message_passing: performs loopy belief propagation across the
+            worker processes.
+
+        get_owner: get the worker owning every node of a Nodes instance.
+    """
+
+    def __init__(self, bpg, num_workers):
+        """Initializer. Partitions the nodes of bpg (see partition_nodes).
+
+        Args:
+            bpg (:obj: BpGraph): a finalized BpGraph.
+
+            num_workers (int): number of worker processes.
+        """
+
+        assert bpg.is_finalized, 'BP graph has not been finalized. Call ' + \
+                                 'finalize() before message-passing.'
+        assert num_workers > 0, 'num_workers must be > 0'
+        assert not bpg.bp_params['split_components'], \
+               'DistributedBp does not support split_components'
+        assert not bpg.bp_params['tree_schedule'], \
+               'DistributedBp does not support tree_schedule'
+        assert bpg.bp_params['sparse_k'] is None, \
+               'DistributedBp does not support sparse messages'
+
+        self.bpg = bpg
+        self.num_workers = num_workers
+
+        (self.__owner, self.cut_edges) = partition_nodes(bpg, num_workers)
+
+        #bytes of halo messages exchanged in every iteration of the last run
+        self.comm_volume = []
+
+    def get_owner(self, nodes):
+        """Returns the worker owning every node of a scheduled Nodes instance,
+        as an ndarray of ints.
+        """
+
+        return self.__owner[nodes]
+
+    def do_message_passing(self, query=None):
+        """Performs loopy belief propagation across the worker processes. Uses
+        bp_params['iters'], bp_params['tol'] and bp_params['streak_lim'] of
+        the BpGraph as BpGraph.do_message_passing does.
+
+        Args:
+            query (dict, optional): not supported; must be None.
+
+        Returns:
+            The number of iterations performed.
+        """
+
+        assert query is None, 'DistributedBp does not support queries'
+
+        conns = []
+        workers = []
+        for _ in range(self.num_workers):
+            (conn, worker_conn) = multiprocessing.Pipe()
+            worker = multiprocessing.Process(target=_run_worker, args=(worker_conn,))
+            worker.daemon = True
+            worker.start()
+            conns.append(conn)
+            workers.append(worker)
+
+        try:
+            self.__send_parts(conns)
+
+            num_steps = len(self.bpg.get_scheduled_nodes())
+            bp_params = self.bpg.bp_params
+            self.comm_volume = []
+            streak_count = 0
+            itt = 0
+            while True:
+                time0 = time.time()
+                num_bytes = 0
+                for _ in range(num_steps):
+                    num_bytes += self.__route(conns)
+                self.comm_volume.append(num_bytes)
+
+                max_diff = max([_recv(conn) for conn in conns])
+                if bp_params['verbose']:
+                    print '%d: maxDiff: %f. Time: %f. Halo: %d bytes' \
+                          %(itt, max_diff, time.time()-time0, num_bytes)
+
+                if itt != 0 and max_diff <= bp_params['tol']:
+                    streak_count += 1
+                else:
+                    streak_count = 0
+                itt += 1
+
+                is_done = streak_count >= bp_params['streak_lim'] or \
+                          itt >= bp_params['iters']
+                for conn in conns:
+                    conn.send(is_done)
+                if is_done:
+                    break
+
+            if streak_count >= bp_params['streak_lim'] and bp_params['verbose']:
+                print "Converged on iteration: " + str(itt-1)
+
+            self.__collect_messages(conns)
+        finally:
+            for worker in workers:
+                worker.join(1)
+                if worker.is_alive():
+                    worker.terminate()
+
+        return itt
+
+    def __send_parts(self, conns):
+        """Builds the part of every worker and sends it. A part is a dict
+        with keys 'schedule' (for every scheduled Nodes instance, the copy
+        holding the nodes the worker owns, or None if it owns none), 'steps'
+        (for every step, a list of (key of the MessageChunk, local
+        destinations as (destination MessageChunk id, source rows,
+        destination rows), halo as (destination worker, source rows))),
+        'halo_in' (key: (source worker, step). value: list of (destination
+        MessageChunk id, destination rows), in the order the messages are
+        sent) and 'bp_params'. All rows are in the ids of the parts. The
+        routing of all parts is built first; the copies of the nodes are
+        built right before their part is sent.
+        """
+
+        schedule = self.bpg.get_scheduled_nodes()
+        chunk_nodes = {}
+        for nodes in schedule:
+            for key in nodes.message_chunks:
+                chunk_nodes[nodes.message_chunks[key]] = nodes
+
+        #key: Nodes instance. value: (ids of the nodes of every worker,
+        #position of every node in the part of its owner)
+        placement = {}
+        for nodes in schedule:
+            owned = [np.nonzero(self.__owner[nodes] == worker_idx)[0] \
+                     for worker_idx in range(self.num_workers)]
+            pos = np.zeros(nodes.num_nodes, dtype='int')
+            for node_idxs in owned:
+                pos[node_idxs] = np.arange(node_idxs.size)
+            placement[nodes] = (owned, pos)
+
+        parts = [{'steps': [], 'halo_in': {}} for _ in conns]
+        for (step_idx, nodes) in enumerate(schedule):
+            for worker_idx in range(self.num_workers):
+                node_idxs = placement[nodes][0][worker_idx]
+                step = []
+                for key in nodes.message_chunks:
+                    if node_idxs.size == 0:
+                        continue
+
+                    msg_chunk_dests = self.bpg.graph_edge_info.get_msg_chunk_dests( \
+                        nodes.message_chunks[key], node_idxs)
+                    local_dests = []
+                    halo = []
+                    for msg_dest in msg_chunk_dests:
+                        chunk_entries, to_index = msg_chunk_dests[msg_dest]
+                        source_idxs = chunk_entries[:, to_index[0]]
+                        dest_idxs = chunk_entries[:, to_index[1]]
+
+                        #rows in the part of the owner of every destination
+                        (owned, pos) = placement[chunk_nodes[msg_dest]]
+                        dest_nodes = dest_idxs % msg_dest.num_nodes
+                        dest_owner = self.__owner[chunk_nodes[msg_dest]][dest_nodes]
+                        num_owned = np.asarray([idxs.size for idxs in owned])
+                        dest_idxs = (dest_idxs // msg_dest.num_nodes)*num_owned[dest_owner] + \
+                                    pos[dest_nodes]
+
+                        is_local = dest_owner == worker_idx
+                        if is_local.any():
+                            local_dests.append((msg_dest.message_chunk_id, \
+                                                source_idxs[is_local], dest_idxs[is_local]))
+
+                        for dest_worker in np.unique(dest_owner[~is_local]):
+                            sel = dest_owner == dest_worker
+                            halo.append((dest_worker, source_idxs[sel]))
+                            parts[dest_worker]['halo_in'].setdefault( \
+                                (worker_idx, step_idx), []).append( \
+                                    (msg_dest.message_chunk_id, dest_idxs[sel]))
+                    step.append((key, local_dests, halo))
+                parts[worker_idx]['steps'].append(step)
+
+        for worker_idx in range(self.num_workers):
+            part = parts[worker_idx]
+            part['bp_params'] = self.bpg.bp_params
+            part['schedule'] = []
+            for nodes in schedule:
+                node_idxs = placement[nodes][0][worker_idx]
+                local_nodes = None
+                if node_idxs.size > 0:
+                    #sent as laid out for distribution, which does not copy
+                    local_nodes = nodes._take_nodes(node_idxs)
+                    local_nodes.prepare_msgs_for_distribution()
+                part['schedule'].append(local_nodes)
+            conns[worker_idx].send(part)
+            parts[worker_idx] = None
+
+    def __route(self, conns):
+        """Receives a dict from every worker, mapping a destination worker to
+        a list of arrays, and sends every worker the lists addressed to it, as
+        a dict from source worker.
+
+        Returns:
+            The number of bytes of the routed arrays.
+        """
+
+        inboxes = [{} for _ in conns]
+        num_bytes = 0
+        for (worker_idx, conn) in enumerate(conns):
+            outbox = _recv(conn)
+            for dest_idx in outbox:
+                inboxes[dest_idx][worker_idx] = outbox[dest_idx]
+                num_bytes += sum([arr.nbytes for arr in outbox[dest_idx]])
+
+        for (worker_idx, conn) in enumerate(conns):
+            conn.send(inboxes[worker_idx])
+        return num_bytes
+
+    def __collect_messages(self, conns):
+        """Copies the incoming messages of the nodes owned by every worker
+        into the BpGraph.
+        """
+
+        chunks = _get_chunks(self.bpg)
+        chunk_nodes = {}
+        for nodes in self.bpg.get_scheduled_nodes():
+            for key in nodes.message_chunks:
+                chunk_nodes[nodes.message_chunks[key]] = nodes
+
+        for (worker_idx, conn) in enumerate(conns):
+            for (chunk_id, msgs) in _recv(conn):
+                chunk = chunks[chunk_id]
+                node_idxs = np.nonzero(self.__owner[chunk_nodes[chunk]] == worker_idx)[0]
+                chunk.prepare_msgs_for_computation()
+                chunk.msgs_in[:, :, node_idxs] = msgs
+
+def partition_nodes(bpg, num_parts):
+    """Partitions the nodes of a finalized BpGraph into parts of (nearly)
+    equal size, keeping neighbouring nodes together. Nodes are ordered by the
+    reverse Cuthill-McKee ordering of the factor graph, which places adjacent
+    nodes close to each other, and the ordering is cut into consecutive
+    parts.
+
+    Args:
+        bpg (:obj: BpGraph): a finalized BpGraph.
+
+        num_parts (int): number of parts.
+
+    Returns:
+        A tuple (owner, cut_edges). owner maps each scheduled Nodes instance
+        to an ndarray holding the part of each of its nodes. cut_edges is the
+        number of edges between nodes in different parts.
+    """
+
+    (offsets, num_total, var_g, fac_g, _) = bpg._get_global_graph()
+
+    adj = sparse.csr_matrix((np.ones(var_g.size), (var_g, fac_g)), \
+                            shape=(num_total, num_total))
+    order = csgraph.reverse_cuthill_mckee(adj + adj.T, symmetric_mode=True)
+
+    part = np.zeros(num_total, dtype='int')
+    part[order] = (np.arange(num_total)*num_parts) // num_total
+
+    owner = {}
+    for nodes in offsets:
+        owner[nodes] = part[offsets[nodes]:offsets[nodes]+nodes.num_nodes]
+
+    cut_edges = np.count_nonzero(part[var_g] != part[fac_g])
+    return (owner, cut_edges)
+
+def _get_chunks(bpg):
+    """Returns a dict from message_chunk_id to every MessageChunk of the
+    scheduled Nodes instances of a BpGraph.
+    """
+
+    chunks = {}
+    for nodes in bpg.get_scheduled_nodes():
+        for key in nodes.message_chunks:
+            chunk = nodes.message_chunks[key]
+            chunks[chunk.message_chunk_id] = chunk
+    return chunks
+
+def _recv(conn):
+    """Receives an object from a worker, raising the worker's error if it
+    failed.
+    """
+
+    obj = conn.recv()
+    if isinstance(obj, tuple) and len(obj) == 2 and obj[0] == '__error__':
+        raise RuntimeError('Worker failed:\n' + obj[1])
+    return obj
+
+def _run_worker(conn):
+    """Entry point of a worker process. See DistributedBp."""
+
+    try:
+        _do_run_worker(conn)
+    except Exception:
+        conn.send(('__error__', traceback.format_exc()))
+    conn.close()
+
+def _do_run_worker(conn):
+    """Runs the message-passing of one worker on its part (see
+    DistributedBp.__send_parts).
+    """
+
+    part = conn.recv()
+    schedule = part['schedule']
+    bp_params = part['bp_params']
+
+    chunks = {}
+    for nodes in schedule:
+        if nodes is not None:
+            nodes.prepare_msgs_for_computation()
+            for key in nodes.message_chunks:
+                chunk = nodes.message_chunks[key]
+                chunks[chunk.message_chunk_id] = chunk
+
+    if bp_params['damp_mode'] == 'adaptive':
+        adaptive_damping = AdaptiveDamping(bp_params['damp'], bp_params['damp_min'], \
+                                           bp_params['damp_max'], bp_params['accel'], \
+                                           bp_params['accel_omega'])
+    else:
+        adaptive_damping = None
+
+    def distribute(chunk_id, dest_idxs, msgs):
+        """Damps messages into the incoming messages of a MessageChunk."""
+
+        msg_dest = chunks[chunk_id]
+        msg_dest.prepare_msgs_for_distribution()
+        if adaptive_damping is not None:
+            adaptive_damping.update(msg_dest, dest_idxs, msgs)
+        else:
+            msg_dest.msgs_in[dest_idxs, :] *= bp_params['damp']
+            msg_dest.msgs_in[dest_idxs, :] += (1-bp_params['damp'])*msgs
+        msg_dest.prepare_msgs_for_computation()
+
+    prev_bel = {}
+    while True:
+        for (step_idx, nodes) in enumerate(schedule):
+            outbox = {}
+            if nodes is not None:
+                msgs_hash = nodes.compute_messages()
+                for (key, local_dests, halo) in part['steps'][step_idx]:
+                    flat_msgs = MessageChunk.do_prepare_msgs_for_distribution(msgs_hash[key])
+                    for (dest_worker, source_idxs) in halo:
+                        outbox.setdefault(dest_worker, []).append(flat_msgs[source_idxs, :])
+                    for (chunk_id, source_idxs, dest_idxs) in local_dests:
+                        distribute(chunk_id, dest_idxs, flat_msgs[source_idxs, :])
+
+            conn.send(outbox)
+            inbox = conn.recv()
+            for source_worker in inbox:
+                for (msgs, (chunk_id, dest_idxs)) in \
+                        zip(inbox[source_worker], part['halo_in'][(source_worker, step_idx)]):
+                    distribute(chunk_id, dest_idxs, msgs)
+
+        max_diff = 0
+        for (step_idx, nodes) in enumerate(schedule):
+            if isinstance(nodes, VarNodes):
+                bel = nodes.get_beliefs()
+                if step_idx in prev_bel:
+                    max_diff = max(max_diff, np.abs(prev_bel[step_idx]-bel).max())
+                prev_bel[step_idx] = bel
+        conn.send(max_diff)
+
+        if conn.recv():
+            break
+
+    res = []
+    for nodes in schedule:
+        if nodes is not None:
+            for key in nodes.message_chunks:
+                chunk = nodes.message_chunks[key]
+                chunk.prepare_msgs_for_computation()
+                res.append((chunk.message_chunk_id, chunk.msgs_in))
+    conn.send(res)
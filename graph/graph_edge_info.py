@@ -1,6 +1,8 @@
 """Module for the GraphEdgeInfo class. See documentation for GraphEdgeInfo class."""
 
 import numpy as np
+from scipy.sparse import csgraph
+from scipy import sparse
 
 class GraphEdgeInfo(object):
     """This class represents the edges of a factor graph.
@@ -9,9 +11,39 @@ class GraphEdgeInfo(object):
         add_edge: adds an edge between a variable node and a factor node on a
             particular edge type.
 
+        add_edges: adds many edges between variable nodes and factor nodes on
+            a particular edge type at once.
+
+        add_stencil_edges: adds the edges between image-shaped blocks of
+            variable nodes and factor nodes given by a window of offsets.
+
+        has_stencils: returns whether stencil edges were added.
+
         get_msg_chunk_dests: given a MessageChunk, returns the other
             MessageChunks passes messages to.
 
+        get_chunk_pairs: returns the (variable, factor) MessageChunk pairs
+            that share edges.
+
+        get_edge_ids: returns the node ids at both ends of the edges between
+            a pair of MessageChunks.
+
+        get_edge_entries: returns the node ids and message locations at both
+            ends of the edges between a pair of MessageChunks.
+
+        remove_edges: removes edges before finalization.
+
+        get_global_edges: returns all edges in a numbering of the nodes that
+            is global across MessageChunks.
+
+        get_nbytes: returns the memory held by the edges.
+
+        get_edge_counts: returns the number of edges and index bytes of every
+            pair of MessageChunks, without building them.
+
+        label_components: labels the connected components of the factor
+            graph.
+
         finalize: prepares graph structure for message-passing.
 
     """
@@ -23,8 +55,18 @@ class GraphEdgeInfo(object):
 
         self.edge_hash = {}
         self.edge_hash_count = {}
+        self.edge_ids = {}
         self.to_chunks = {}
 
+        #stencil edges (see add_stencil_edges), stored without per-edge
+        #entries. list of dicts.
+        self.stencils = []
+
+        #factor message locations of stencil edges whose variable node falls
+        #outside of the image. list of (factor MessageChunk, first factor id,
+        #first location, image shape, offsets).
+        self.__stencil_pads = []
+
     def add_edge(self, c_msgs_chunk, c_id, o_msgs_chunk_edge, o_id):
         """Adds an edge between a variable node and a factor node on a
         particular edge type. This is accomplished by "connecting" their
@@ -47,29 +89,258 @@ class GraphEdgeInfo(object):
         o_msgs_edge_loc = o_msgs_chunk_edge.degree[o_id]
 
         key_chunk_pair = (c_msgs_chunk, o_msgs_chunk_edge)
-        entry = [c_id, c_nodes_loc, o_id, o_msgs_edge_loc]
+        row_use = self.__reserve_rows(key_chunk_pair, 1)
 
-        if key_chunk_pair not in self.edge_hash.keys():
-            self.edge_hash_count[key_chunk_pair] = 0
-            self.edge_hash[key_chunk_pair] = tmp = \
-                -1*np.ones((self.__NODE_EDGE_BUFF, 4), dtype='int')
+        self.edge_hash[key_chunk_pair][row_use, :] = [c_id, c_nodes_loc, o_id, o_msgs_edge_loc]
 
-        row_use = self.edge_hash_count[key_chunk_pair]
-        if row_use > self.edge_hash[key_chunk_pair].shape[0]-1:
-            tmp = -1*np.ones_like(self.edge_hash[key_chunk_pair])
+    def add_edges(self, c_msgs_chunk, c_ids, o_msgs_chunk_edge, o_ids):
+        """Adds many edges between variable nodes and factor nodes on a
+        particular edge type at once. Equivalent to calling add_edge for every
+        (c_ids[i], o_ids[i]) pair in order, with the degrees of the nodes
+        updated in between.
+
+        Args:
+            c_msgs_chunk (:obj: MessageChunk): a message chunk representing
+                the messages for a set of variable nodes.
+
+            c_ids (ndarray): ids of the variable nodes, one per edge.
+
+            o_msgs_chunk_edge (:obj: MessageChunk): a message chunk representing
+                the messages on the factor node's edge type.
+
+            o_ids (ndarray): ids of the factor nodes, one per edge.
+        """
+
+        c_ids = np.asarray(c_ids, dtype='int').ravel()
+        o_ids = np.asarray(o_ids, dtype='int').ravel()
+        assert c_ids.size == o_ids.size, 'Must give as many variable as factor ids'
+
+        key_chunk_pair = (c_msgs_chunk, o_msgs_chunk_edge)
+        row_use = self.__reserve_rows(key_chunk_pair, c_ids.size)
+
+        entries = self.edge_hash[key_chunk_pair][row_use:row_use+c_ids.size, :]
+        entries[:, 0] = c_ids
+        entries[:, 1] = c_msgs_chunk.degree[c_ids] + self.__occurrence_rank(c_ids)
+        entries[:, 2] = o_ids
+        entries[:, 3] = o_msgs_chunk_edge.degree[o_ids] + self.__occurrence_rank(o_ids)
+
+    def add_stencil_edges(self, c_msgs_chunk, c_ids, o_msgs_chunk_edge, o_ids, offsets):
+        """Adds the edges between image-shaped blocks of variable nodes and
+        factor nodes given by a window of offsets: for every offset k, the
+        variable node c_ids[k, i, j] is connected to the factor node
+        o_ids[i+offsets[k, 0], j+offsets[k, 1]], if inside the image. The
+        edges are stored as the blocks and offsets only, and messages are
+        distributed with shifted slices of the image-shaped blocks of
+        messages, so memory does not grow with the size of the window.
+
+        Every block of ids must be consecutive, in row-major order (eg, the
+        ids of nodes created in one create_nodes call). The edge of offset k
+        is at location d+k of every factor node, where d is the degree the
+        factor nodes have before the call (the same for all of them). Factor
+        locations without a variable node inside the image hold padding
+        messages. The edge of a variable node is at its degree before the
+        call, which must be the same across each block.
+
+        Args:
+            c_msgs_chunk (:obj: MessageChunk): a message chunk representing
+                the messages for a set of variable nodes.
 
+            c_ids (ndarray): KxHxW ndarray of variable node ids, one HxW
+                block per offset.
+
+            o_msgs_chunk_edge (:obj: MessageChunk): a message chunk representing
+                the messages on the factor node's edge type.
+
+            o_ids (ndarray): HxW ndarray of factor node ids.
+
+            offsets (ndarray): Kx2 ndarray of (row, column) offsets from the
+                variable nodes to the factor nodes.
+
+        Returns:
+            A boolean KxHxW ndarray, True for the variable nodes given an edge.
+        """
+
+        c_ids = np.asarray(c_ids, dtype='int')
+        o_ids = np.asarray(o_ids, dtype='int')
+        offsets = np.asarray(offsets, dtype='int').reshape(-1, 2)
+        assert o_ids.ndim == 2, 'Factor ids must be an HxW ndarray'
+        assert c_ids.shape == (offsets.shape[0],) + o_ids.shape, \
+               'Must give one HxW block of variable ids per offset'
+
+        block = np.arange(o_ids.size).reshape(o_ids.shape)
+        fac_start = o_ids[0, 0]
+        var_starts = c_ids[:, 0, 0]
+        assert (o_ids == fac_start + block).all() and \
+               (c_ids == var_starts[:, np.newaxis, np.newaxis] + block).all(), \
+               'Blocks of ids must be consecutive, in row-major order'
+        assert (np.diff(np.sort(var_starts)) >= o_ids.size).all(), \
+               'Blocks of variable ids cannot overlap'
+
+        fac_degree = o_msgs_chunk_edge.degree[o_ids]
+        var_locs = c_msgs_chunk.degree[var_starts]
+        assert (fac_degree == fac_degree[0, 0]).all() and \
+               (c_msgs_chunk.degree[c_ids] == var_locs[:, np.newaxis, np.newaxis]).all(), \
+               'Nodes of a block must have the same degree'
+
+        self.stencils.append({'chunk_pair': (c_msgs_chunk, o_msgs_chunk_edge), \
+                              'var_starts': var_starts, 'var_locs': var_locs, \
+                              'fac_start': fac_start, 'fac_loc': fac_degree[0, 0], \
+                              'shape': o_ids.shape, 'offsets': offsets})
+        self.__stencil_pads.append((o_msgs_chunk_edge, fac_start, fac_degree[0, 0], \
+                                    o_ids.shape, offsets))
+
+        is_connected = np.zeros(c_ids.shape, dtype='bool')
+        for k in range(offsets.shape[0]):
+            (var_win, _) = _get_windows(o_ids.shape, offsets[k])
+            is_connected[k][var_win] = True
+        return is_connected
+
+    def has_stencils(self):
+        """Returns whether stencil edges (see add_stencil_edges) were added.
+        """
+
+        return len(self.stencils) > 0
+
+    @staticmethod
+    def __get_stencil_entries(stencil):
+        """Returns the edges of a stencil as rows of [variable node id,
+        location at the variable node, factor node id, location at the
+        factor node], in order of offset.
+        """
+
+        shape = stencil['shape']
+        block = np.arange(shape[0]*shape[1]).reshape(shape)
+        all_entries = [np.zeros((0, 4), dtype='int')]
+        for (k, offset) in enumerate(stencil['offsets']):
+            (var_win, fac_win) = _get_windows(shape, offset)
+            entries = np.zeros((block[var_win].size, 4), dtype='int')
+            entries[:, 0] = stencil['var_starts'][k] + block[var_win].ravel()
+            entries[:, 1] = stencil['var_locs'][k]
+            entries[:, 2] = stencil['fac_start'] + block[fac_win].ravel()
+            entries[:, 3] = stencil['fac_loc'] + k
+            all_entries.append(entries)
+
+        return np.concatenate(all_entries)
+
+    def __get_stencils(self, chunk_pair):
+        """Returns the stencils (see add_stencil_edges) between a pair of
+        MessageChunks.
+        """
+
+        return [stencil for stencil in self.stencils if stencil['chunk_pair'] == chunk_pair]
+
+    @staticmethod
+    def __occurrence_rank(ids):
+        """For every entry of ids, counts how many times the same value occurs
+        before it.
+
+        Args:
+            ids (ndarray): 1D ndarray of ints.
+
+        Returns:
+            An ndarray of ints the same size as ids.
+        """
+
+        order = np.argsort(ids, kind='mergesort')
+        sorted_ids = ids[order]
+
+        pos = np.arange(ids.size)
+        is_first = np.ones(ids.size, dtype='bool')
+        is_first[1:] = sorted_ids[1:] != sorted_ids[:-1]
+        first_pos = np.maximum.accumulate(np.where(is_first, pos, 0))
+
+        rank = np.empty(ids.size, dtype='int')
+        rank[order] = pos - first_pos
+        return rank
+
+    def __reserve_rows(self, key_chunk_pair, num_rows):
+        """Reserves rows in the edge buffer of a pair of MessageChunks, growing
+        the buffer geometrically when needed.
+
+        Returns:
+            The index of the first reserved row.
+        """
+
+        if key_chunk_pair not in self.edge_hash:
+            self.edge_hash_count[key_chunk_pair] = 0
             self.edge_hash[key_chunk_pair] = \
-                np.concatenate((self.edge_hash[key_chunk_pair], tmp), axis=0)
+                -1*np.ones((max(self.__NODE_EDGE_BUFF, num_rows), 4), dtype='int')
 
-        self.edge_hash[key_chunk_pair][row_use, :] = entry
-        self.edge_hash_count[key_chunk_pair] += 1
+        row_use = self.edge_hash_count[key_chunk_pair]
+        buff = self.edge_hash[key_chunk_pair]
+        if row_use + num_rows > buff.shape[0]:
+            new_buff = -1*np.ones((max(2*buff.shape[0], row_use + num_rows), 4), dtype='int')
+            new_buff[0:row_use, :] = buff[0:row_use, :]
+            self.edge_hash[key_chunk_pair] = new_buff
+
+        self.edge_hash_count[key_chunk_pair] += num_rows
+        return row_use
+
+    def remove_edges(self, keep):
+        """Removes edges. Only available before finalization. Locations of
+        the remaining edges at the variable nodes are renumbered to stay
+        contiguous. Locations at the factor nodes are kept, as factors may
+        depend on the order of their edges; the caller must make sure the
+        factors stay consistent.
 
-    def get_msg_chunk_dests(self, msg_chunk):
+        Args:
+            keep (dict): maps (variable, factor) MessageChunk pairs, as
+                returned by get_chunk_pairs, to boolean ndarrays indicating
+                which of their edges (see get_edge_entries) to keep. Pairs not
+                present keep all their edges.
+        """
+
+        #stencils of the variable nodes involved become plain edges, as
+        #their locations may change
+        var_chunks = set([chunk_pair[0] for chunk_pair in keep])
+        for stencil in self.stencils:
+            if stencil['chunk_pair'][0] in var_chunks:
+                entries = self.__get_stencil_entries(stencil)
+                row_use = self.__reserve_rows(stencil['chunk_pair'], entries.shape[0])
+                self.edge_hash[stencil['chunk_pair']][row_use:row_use+entries.shape[0], :] = \
+                    entries
+        self.stencils = [stencil for stencil in self.stencils \
+                         if stencil['chunk_pair'][0] not in var_chunks]
+
+        for chunk_pair in keep:
+            entries = self.get_edge_entries(chunk_pair)[keep[chunk_pair], :]
+            if entries.shape[0] == 0:
+                del self.edge_hash[chunk_pair]
+                del self.edge_hash_count[chunk_pair]
+            else:
+                self.edge_hash[chunk_pair] = np.ascontiguousarray(entries)
+                self.edge_hash_count[chunk_pair] = entries.shape[0]
+
+        for var_chunk in var_chunks:
+            chunk_pairs = [chunk_pair for chunk_pair in self.edge_hash \
+                           if chunk_pair[0] == var_chunk]
+            if len(chunk_pairs) == 0:
+                continue
+
+            all_entries = [self.get_edge_entries(chunk_pair) for chunk_pair in chunk_pairs]
+            locs = self.__occurrence_rank(np.concatenate([entries[:, 0] \
+                                                          for entries in all_entries]))
+            start = 0
+            for entries in all_entries:
+                entries[:, 1] = locs[start:start+entries.shape[0]]
+                start += entries.shape[0]
+
+    def get_msg_chunk_dests(self, msg_chunk, node_idxs=None, with_stencils=True):
         """Given a MessageChunk, returns the other MessageChunks it passes
         messages to.
 
         Args:
             msg_chunk (:obj:MessageChunk): the source MessageChunk.
+
+            node_idxs (ndarray, optional): if given, only the messages sent by
+                these nodes of msg_chunk are returned, and source rows refer
+                to messages computed for node_idxs only (see
+                Nodes.compute_messages). Defaults to all nodes.
+
+            with_stencils (bool, optional): whether to include the rows of
+                stencil edges (see add_stencil_edges), which are then built
+                on every call. Otherwise, see get_stencil_dests. Defaults to
+                True.
         Returns:
             A dict where each key is a MessageChunk the source MessageChunk
             sends a message to. The key of the dict accesses a tuple. The
@@ -98,7 +369,249 @@ class GraphEdgeInfo(object):
                 else:
                     raise RuntimeError('Internal error: cannot find source message chunk?')
 
+        if with_stencils:
+            for stencil in self.stencils:
+                (chunk0, chunk1) = stencil['chunk_pair']
+                if msg_chunk != chunk0 and msg_chunk != chunk1:
+                    continue
+
+                entries = self.__get_stencil_entries(stencil)
+                chunk_entries = np.zeros((entries.shape[0], 2), dtype='int')
+                chunk_entries[:, 0] = entries[:, 1]*chunk0.num_nodes + entries[:, 0]
+                chunk_entries[:, 1] = entries[:, 3]*chunk1.num_nodes + entries[:, 2]
+
+                if msg_chunk == chunk0:
+                    (msg_dest, to_index) = (chunk1, (0, 1))
+                else:
+                    (msg_dest, to_index) = (chunk0, (1, 0))
+                if msg_dest in res:
+                    chunk_entries = np.concatenate([res[msg_dest][0], chunk_entries])
+                res[msg_dest] = (chunk_entries, to_index)
+
+        if node_idxs is not None:
+            num_nodes = msg_chunk.num_nodes
+            pos = -np.ones(num_nodes, dtype='int')
+            pos[node_idxs] = np.arange(len(node_idxs))
+
+            for msg_dest in res:
+                chunk_entries, to_index = res[msg_dest]
+                source_idxs = chunk_entries[:, to_index[0]]
+                src_pos = pos[source_idxs % num_nodes]
+                keep = src_pos >= 0
+
+                new_entries = np.zeros((np.count_nonzero(keep), 2), dtype='int')
+                new_entries[:, to_index[0]] = \
+                    (source_idxs[keep] // num_nodes)*len(node_idxs) + src_pos[keep]
+                new_entries[:, to_index[1]] = chunk_entries[keep, to_index[1]]
+                res[msg_dest] = (new_entries, to_index)
+
+        return res
+
+    def get_stencil_dests(self, msg_chunk):
+        """Given a MessageChunk, returns the other MessageChunks it passes
+        messages to on stencil edges (see add_stencil_edges), as windows of
+        image-shaped blocks of messages. Only available once finalized.
+
+        Args:
+            msg_chunk (:obj:MessageChunk): the source MessageChunk.
+
+        Returns:
+            A list of (destination MessageChunk, windows) tuples. windows is a
+            list of (source row, destination row, image shape, source window,
+            destination window) tuples: the HxW messages from the source row
+            on (as prepared for distribution) are sent, within the source
+            window (a tuple of slices), to the HxW messages from the
+            destination row on, within the destination window.
+        """
+
+        res = []
+        for stencil in self.stencils:
+            (chunk0, chunk1) = stencil['chunk_pair']
+            if msg_chunk != chunk0 and msg_chunk != chunk1:
+                continue
+
+            shape = stencil['shape']
+            windows = []
+            for (k, offset) in enumerate(stencil['offsets']):
+                (var_win, fac_win) = _get_windows(shape, offset)
+                var_row = stencil['var_locs'][k]*chunk0.num_nodes + stencil['var_starts'][k]
+                fac_row = (stencil['fac_loc'] + k)*chunk1.num_nodes + stencil['fac_start']
+                if msg_chunk == chunk0:
+                    windows.append((var_row, fac_row, shape, var_win, fac_win))
+                else:
+                    windows.append((fac_row, var_row, shape, fac_win, var_win))
+
+            if msg_chunk == chunk0:
+                res.append((chunk1, windows))
+            else:
+                res.append((chunk0, windows))
+
         return res
+
+    def get_chunk_pairs(self):
+        """Returns the (variable, factor) MessageChunk pairs that share
+        edges, as a list of tuples.
+        """
+
+        chunk_pairs = list(self.edge_hash.keys())
+        for stencil in self.stencils:
+            if stencil['chunk_pair'] not in chunk_pairs:
+                chunk_pairs.append(stencil['chunk_pair'])
+        return chunk_pairs
+
+    def get_edge_ids(self, chunk_pair):
+        """Returns the node ids at both ends of the edges between a pair of
+        MessageChunks. Only available once finalized.
+
+        Args:
+            chunk_pair (tuple): a (variable, factor) MessageChunk pair, as
+                returned by get_chunk_pairs.
+
+        Returns:
+            An Nx2 ndarray. Column 0 holds the variable node ids and column 1
+            the factor node ids of the N edges.
+        """
+
+        all_ids = [self.edge_ids.get(chunk_pair, np.zeros((0, 2), dtype='int'))]
+        for stencil in self.__get_stencils(chunk_pair):
+            all_ids.append(self.__get_stencil_entries(stencil)[:, [0, 2]])
+        return np.concatenate(all_ids)
+
+    def get_edge_entries(self, chunk_pair):
+        """Returns the node ids at both ends of the edges between a pair of
+        MessageChunks, and the location of each edge among the messages of
+        either node. Available before and after finalization.
+
+        Args:
+            chunk_pair (tuple): a (variable, factor) MessageChunk pair, as
+                returned by get_chunk_pairs.
+
+        Returns:
+            An Nx4 ndarray. Columns hold the variable node id, the location of
+            the edge at the variable node, the factor node id and the location
+            of the edge at the factor node, for the N edges in the order they
+            were added.
+        """
+
+        stencils = self.__get_stencils(chunk_pair)
+        if chunk_pair not in self.edge_hash:
+            entries = np.zeros((0, 4), dtype='int')
+        elif chunk_pair not in self.edge_ids:
+            entries = self.edge_hash[chunk_pair][0:self.edge_hash_count[chunk_pair]]
+            if len(stencils) == 0:
+                return entries
+        else:
+            entries = np.zeros((self.edge_ids[chunk_pair].shape[0], 4), dtype='int')
+            entries[:, [0, 2]] = self.edge_ids[chunk_pair]
+            entries[:, 1] = self.edge_hash[chunk_pair][:, 0] // chunk_pair[0].num_nodes
+            entries[:, 3] = self.edge_hash[chunk_pair][:, 1] // chunk_pair[1].num_nodes
+
+        return np.concatenate([entries] + \
+                              [self.__get_stencil_entries(stencil) for stencil in stencils])
+
+    def get_global_edges(self, chunk_offsets):
+        """Returns all edges in a numbering of the nodes that is global across
+        MessageChunks. Only available once finalized.
+
+        Args:
+            chunk_offsets (dict): maps MessageChunks to the global number of
+                their node 0. MessageChunks of the same factors (ie, of
+                different edge types) must share an offset. Edges touching a
+                MessageChunk not in chunk_offsets are left out.
+
+        Returns:
+            A tuple (var_g, fac_g, chunk_idx, chunk_pairs). var_g and fac_g
+            are ndarrays holding the global numbers of the variable and the
+            factor node of every edge. The edges between the MessageChunks
+            chunk_pairs[i] are the ones with chunk_idx == i.
+        """
+
+        var_g = [np.zeros(0, dtype='int')]
+        fac_g = [np.zeros(0, dtype='int')]
+        chunk_idx = [np.zeros(0, dtype='int')]
+        chunk_pairs = []
+        for chunk_pair in self.get_chunk_pairs():
+            if chunk_pair[0] not in chunk_offsets or chunk_pair[1] not in chunk_offsets:
+                continue
+
+            edge_ids = self.get_edge_ids(chunk_pair)
+            var_g.append(edge_ids[:, 0] + chunk_offsets[chunk_pair[0]])
+            fac_g.append(edge_ids[:, 1] + chunk_offsets[chunk_pair[1]])
+            chunk_idx.append(len(chunk_pairs)*np.ones(edge_ids.shape[0], dtype='int'))
+            chunk_pairs.append(chunk_pair)
+
+        return (np.concatenate(var_g), np.concatenate(fac_g), \
+                np.concatenate(chunk_idx), chunk_pairs)
+
+    def get_nbytes(self):
+        """Returns the number of bytes held by the edges: node ids and
+        distribution rows of plain edges, and the (few) arrays of stencils.
+        """
+
+        num_bytes = 0
+        for key in self.edge_hash:
+            num_bytes += self.edge_hash[key].nbytes
+        for key in self.edge_ids:
+            num_bytes += self.edge_ids[key].nbytes
+        for stencil in self.stencils:
+            num_bytes += stencil['var_starts'].nbytes + stencil['var_locs'].nbytes + \
+                         stencil['offsets'].nbytes
+        return num_bytes
+
+    def get_edge_counts(self):
+        """Returns the number of edges between every pair of MessageChunks,
+        and the bytes their indices take once finalized, without building
+        them. Available before and after finalization.
+
+        Returns:
+            A dict from every (variable, factor) MessageChunk pair with edges
+            to a tuple (number of edges, index bytes).
+        """
+
+        int_bytes = np.dtype('int').itemsize
+        counts = {}
+        for chunk_pair in self.edge_hash:
+            if chunk_pair in self.edge_ids:
+                num_edges = self.edge_ids[chunk_pair].shape[0]
+            else:
+                num_edges = self.edge_hash_count[chunk_pair]
+            #node ids and distribution rows at both ends of every edge
+            counts[chunk_pair] = (num_edges, 4*int_bytes*num_edges)
+
+        for stencil in self.stencils:
+            num_edges = 0
+            for offset in stencil['offsets']:
+                var_win = _get_windows(stencil['shape'], offset)[0]
+                num_edges += np.prod([max(win.stop - win.start, 0) for win in var_win])
+            index_bytes = stencil['var_starts'].nbytes + stencil['var_locs'].nbytes + \
+                          stencil['offsets'].nbytes
+
+            (prev_edges, prev_bytes) = counts.get(stencil['chunk_pair'], (0, 0))
+            counts[stencil['chunk_pair']] = (prev_edges + int(num_edges), \
+                                             prev_bytes + index_bytes)
+
+        return counts
+
+    def label_components(self, chunk_offsets, num_total):
+        """Labels the connected components of the factor graph. Only
+        available once finalized.
+
+        Args:
+            chunk_offsets (dict): see get_global_edges.
+
+            num_total (int): total number of nodes in the global numbering.
+
+        Returns:
+            A tuple (num_components, labels), where labels is an ndarray
+            holding the component of every node in the global numbering.
+        """
+
+        (var_g, fac_g, _, _) = self.get_global_edges(chunk_offsets)
+        adj = sparse.coo_matrix((np.ones(var_g.size), (var_g, fac_g)), \
+                                shape=(num_total, num_total))
+
+        return csgraph.connected_components(adj, directed=False)
+
     def finalize(self):
         """Prepares graph structure for message-passing. In particular, removes
         excess pre-allocated buffers and prepares fancy-indexing operations
@@ -114,6 +627,7 @@ class GraphEdgeInfo(object):
             chunk1 = key[1]
 
             tmp = self.edge_hash[key]
+            self.edge_ids[key] = tmp[:, [0, 2]]
             new_idx = np.zeros((self.edge_hash[key].shape[0], 2), dtype='int')
 
             new_idx[:, 0] = tmp[:, 1]*chunk0.num_nodes
@@ -128,3 +642,31 @@ class GraphEdgeInfo(object):
                     self.to_chunks[chunk].append(key)
                 else:
                     self.to_chunks[chunk] = [key]
+
+        #factor locations of stencil edges without a variable node inside the
+        #image hold padding messages, though within the degree of the factor
+        for (chunk, fac_start, fac_loc, shape, offsets) in self.__stencil_pads:
+            block = np.arange(shape[0]*shape[1]).reshape(shape)
+            pad_msg_val = chunk.pad_msg_val*np.ones(chunk.num_states)
+            for (k, offset) in enumerate(offsets):
+                is_pad = np.ones(shape, dtype='bool')
+                is_pad[_get_windows(shape, offset)[1]] = False
+                chunk.msgs_in[fac_loc+k][:, fac_start + block[is_pad]] = \
+                    pad_msg_val[:, np.newaxis]
+
+def _get_windows(shape, offset):
+    """Returns the windows of an image of the given shape holding the
+    variable nodes of a stencil offset (see
+    GraphEdgeInfo.add_stencil_edges) that fall inside the image, and their
+    factor nodes.
+
+    Returns:
+        A tuple (var_win, fac_win) of tuples of slices, one per axis.
+    """
+
+    var_win = []
+    fac_win = []
+    for (size, off) in zip(shape, offset):
+        var_win.append(slice(max(-off, 0), size - max(off, 0)))
+        fac_win.append(slice(max(off, 0), size + min(off, 0)))
+    return (tuple(var_win), tuple(fac_win))
@@ -0,0 +1,314 @@
+"""Module for the GraphPacker class. See documentation for GraphPacker
+class."""
+
+import numpy as np
+from nodesLib import VarNodes
+from bp_graph import BpGraph
+
+class GraphPacker(object):
+    """This class packs many small, independently built BpGraphs (of possibly
+    different topologies) into one block-diagonal BpGraph, so that they are
+    solved by a single message-passing run instead of one run each.
+
+    Nodes instances of the same class and with the same parameters (and
+    number of states) are packed into one Nodes instance, with the node ids
+    of every graph offset past the ids of the graphs before it. Unary
+    potentials (including condition_on) and edges are copied. Evidence set
+    with VarNodes.set_evidence is not, so added graphs must not have any; set
+    it on the packed Nodes instances instead (see get_nodes).
+
+    The packed BpGraph always splits connected components (see
+    BpGraph.get_components). Every packed graph is made of one or more
+    components, so every graph converges on its own and leaves the batched
+    message computations once it has, while larger graphs keep iterating.
+
+    Public methods:
+        add_graph: adds a BpGraph to pack.
+
+        finalize: builds and finalizes the packed BpGraph.
+
+        do_message_passing: performs message-passing on the packed BpGraph.
+
+        get_residuals: get the final change in beliefs of every graph.
+
+        get_beliefs: get the beliefs of the variable nodes of a graph.
+
+        get_nodes: get the packed Nodes instance of a Nodes instance of a
+            graph, and the offset of its ids.
+
+        unpack: get the beliefs of the variable nodes of every graph.
+    """
+
+    def __init__(self, bp_params=None):
+        """Initializer.
+
+        Args:
+            bp_params (dict, optional): parameters of the packed BpGraph. See
+                BpGraph. 'split_components' is turned on, and cannot be
+                turned off.
+        """
+
+        if bp_params is None:
+            bp_params = {}
+
+        assert bp_params.get('split_components', True), \
+               'Packed graphs require split_components'
+
+        bp_params = dict(bp_params)
+        bp_params['split_components'] = True
+
+        self.bp_params = bp_params
+        self.graphs = []
+
+        #the packed BpGraph. None until finalized.
+        self.bpg = None
+
+        #one dict per graph. key: scheduled Nodes instance of the graph.
+        #value: (packed Nodes instance, offset of its ids).
+        self.__placement = []
+
+        #components of the packed BpGraph making up every graph
+        self.__graph_comps = []
+        self.__residuals = None
+
+    def add_graph(self, bpg):
+        """Adds a BpGraph to pack. The BpGraph itself is left unchanged, and
+        may or may not be finalized.
+
+        Args:
+            bpg (:obj: BpGraph): the BpGraph to pack.
+
+        Returns:
+            The index of the graph, to refer to it once packed.
+        """
+
+        assert self.bpg is None, 'Cannot add graphs once finalized.'
+        assert not any([isinstance(nodes, VarNodes) and nodes.has_evidence() \
+                        for nodes in bpg.get_scheduled_nodes()]), \
+               'Cannot pack graphs with evidence set by set_evidence.'
+
+        self.graphs.append(bpg)
+        return len(self.graphs)-1
+
+    def finalize(self):
+        """Builds and finalizes the packed BpGraph."""
+
+        assert self.bpg is None, 'GraphPacker can only be finalized once.'
+        assert len(self.graphs) > 0, 'No graphs added to pack.'
+
+        packed_bpg = BpGraph(dict(self.bp_params))
+
+        #key: see _get_params_key. value: packed Nodes instance.
+        groups = {}
+        schedule = []
+        for bpg in self.graphs:
+            placement = {}
+            for nodes in bpg.get_scheduled_nodes():
+                key = _get_params_key(nodes)
+                if key not in groups:
+                    groups[key] = nodes._new_empty('packed%d_%s' %(len(schedule), nodes.name))
+                    schedule.append(groups[key])
+
+                packed_nodes = groups[key]
+                offset = packed_nodes.num_nodes
+                packed_nodes.create_nodes(nodes.num_nodes)
+                placement[nodes] = (packed_nodes, offset)
+            self.__placement.append(placement)
+
+        self.__pack_unaries()
+        self.__pack_edges(packed_bpg)
+
+        for packed_nodes in schedule:
+            packed_bpg.add_nodes_to_schedule(packed_nodes)
+        packed_bpg.finalize()
+
+        (_, labels) = packed_bpg.get_components()
+        for placement in self.__placement:
+            comps = [np.zeros(0, dtype='int')]
+            for nodes in placement:
+                (packed_nodes, offset) = placement[nodes]
+                comps.append(labels[packed_nodes][offset:offset+nodes.num_nodes])
+            self.__graph_comps.append(np.unique(np.concatenate(comps)))
+
+        self.bpg = packed_bpg
+
+    def __pack_unaries(self):
+        """Copies the unary potentials of every graph to the packed VarNodes
+        instances.
+        """
+
+        #key: packed VarNodes instance. value: list of (ids, log_vals)
+        unaries = {}
+        for placement in self.__placement:
+            for nodes in placement:
+                if isinstance(nodes, VarNodes):
+                    (packed_nodes, offset) = placement[nodes]
+                    (node_ids, log_vals) = nodes.get_unaries()
+                    unaries.setdefault(packed_nodes, []).append((node_ids+offset, log_vals))
+
+        for packed_nodes in unaries:
+            node_ids = np.concatenate([unary[0] for unary in unaries[packed_nodes]])
+            if node_ids.size > 0:
+                log_vals = np.concatenate([unary[1] for unary in unaries[packed_nodes]])
+                packed_nodes._add_log_unaries(node_ids, log_vals)
+
+    def __pack_edges(self, packed_bpg):
+        """Copies the edges of every graph to the packed BpGraph. Edges are
+        added in order of their location at the factor node, so every factor
+        keeps the order of its edges (eg, the outputs of a CatNodes factor).
+        """
+
+        #key: (packed VarNodes instance, packed FactorNodes instance, edge
+        #type). value: list of (variable ids, factor ids, factor locations)
+        edges = {}
+        edge_keys = []
+        for (graph_idx, bpg) in enumerate(self.graphs):
+            placement = self.__placement[graph_idx]
+
+            chunk_owner = {}
+            for nodes in placement:
+                for key in nodes.message_chunks:
+                    chunk_owner[nodes.message_chunks[key]] = (nodes, key)
+
+            edge_info = bpg.graph_edge_info
+            assert not edge_info.has_stencils(), 'Cannot pack graphs with stencil edges'
+            for chunk_pair in edge_info.get_chunk_pairs():
+                if chunk_pair[0] not in chunk_owner or chunk_pair[1] not in chunk_owner:
+                    continue
+
+                (var_nodes, _) = chunk_owner[chunk_pair[0]]
+                (fac_nodes, edge_type) = chunk_owner[chunk_pair[1]]
+                (packed_var, var_offset) = placement[var_nodes]
+                (packed_fac, fac_offset) = placement[fac_nodes]
+
+                edge_key = (packed_var, packed_fac, edge_type)
+                if edge_key not in edges:
+                    edges[edge_key] = []
+                    edge_keys.append(edge_key)
+
+                entries = edge_info.get_edge_entries(chunk_pair)
+                edges[edge_key].append((entries[:, 0] + var_offset, \
+                                        entries[:, 2] + fac_offset, entries[:, 3]))
+
+        packed_edges = []
+        max_loc = -1
+        for edge_key in edge_keys:
+            var_ids = np.concatenate([edge[0] for edge in edges[edge_key]])
+            fac_ids = np.concatenate([edge[1] for edge in edges[edge_key]])
+            fac_locs = np.concatenate([edge[2] for edge in edges[edge_key]])
+            packed_edges.append((edge_key, var_ids, fac_ids, fac_locs))
+            max_loc = max(max_loc, fac_locs.max())
+
+        for loc in range(max_loc+1):
+            for ((packed_var, packed_fac, edge_type), var_ids, fac_ids, fac_locs) \
+                    in packed_edges:
+                at_loc = fac_locs == loc
+                packed_bpg.add_edges(packed_var, var_ids[at_loc], packed_fac, \
+                                     fac_ids[at_loc], edge_type)
+
+    def do_message_passing(self, max_seconds=None, max_iters=None):
+        """Performs message-passing on the packed BpGraph. See
+        BpGraph.do_message_passing.
+
+        Returns:
+            The last snapshot of the run. See BpGraph.iter_message_passing.
+        """
+
+        assert self.bpg is not None, 'GraphPacker has not been finalized.'
+
+        snapshot = self.bpg.do_message_passing(max_seconds, max_iters)
+
+        comp_residuals = snapshot['component_residuals']
+        self.__residuals = np.zeros(len(self.graphs))
+        for (graph_idx, comps) in enumerate(self.__graph_comps):
+            if comps.size > 0 and comp_residuals.size > 0:
+                self.__residuals[graph_idx] = comp_residuals[comps].max()
+
+        return snapshot
+
+    def get_residuals(self):
+        """Returns the maximum absolute change in beliefs of every graph over
+        the last iteration of the last run, as an ndarray.
+        """
+
+        return self.__residuals
+
+    def get_nodes(self, graph_idx, nodes):
+        """Returns where a scheduled Nodes instance of a graph was packed.
+
+        Args:
+            graph_idx (int): index of the graph, as returned by add_graph.
+
+            nodes (:obj: Nodes): a scheduled Nodes instance of the graph.
+
+        Returns:
+            A tuple (packed Nodes instance, offset of the ids of nodes in it).
+        """
+
+        assert self.bpg is not None, 'GraphPacker has not been finalized.'
+        return self.__placement[graph_idx][nodes]
+
+    def get_beliefs(self, graph_idx):
+        """Returns the beliefs of the variable nodes of a graph.
+
+        Args:
+            graph_idx (int): index of the graph, as returned by add_graph.
+
+        Returns:
+            A dict from every scheduled VarNodes instance of the graph to the
+            beliefs of its variable nodes (see VarNodes.get_beliefs).
+        """
+
+        assert self.bpg is not None, 'GraphPacker has not been finalized.'
+
+        res = {}
+        placement = self.__placement[graph_idx]
+        for nodes in placement:
+            if isinstance(nodes, VarNodes):
+                (packed_nodes, offset) = placement[nodes]
+                res[nodes] = packed_nodes.get_beliefs(np.arange(offset, offset+nodes.num_nodes))
+        return res
+
+    def unpack(self):
+        """Returns the beliefs of the variable nodes of every graph, as a list
+        with one dict per graph (see get_beliefs).
+        """
+
+        assert self.bpg is not None, 'GraphPacker has not been finalized.'
+
+        packed_bel = {}
+        res = []
+        for placement in self.__placement:
+            graph_bel = {}
+            for nodes in placement:
+                if isinstance(nodes, VarNodes):
+                    (packed_nodes, offset) = placement[nodes]
+                    if packed_nodes not in packed_bel:
+                        packed_bel[packed_nodes] = packed_nodes.get_beliefs()
+                    graph_bel[nodes] = \
+                        packed_bel[packed_nodes][:, :, offset:offset+nodes.num_nodes]
+            res.append(graph_bel)
+        return res
+
+def _get_params_key(nodes):
+    """Returns a hashable key of the class, parameters and number of states of
+    a Nodes instance. Nodes instances with the same key can be packed into
+    one.
+    """
+
+    init_params = nodes._get_init_params()
+    params = []
+    for name in sorted(init_params.keys()):
+        val = init_params[name]
+        if isinstance(val, np.ndarray):
+            params.append((name, val.dtype.str, val.shape, val.tobytes()))
+        else:
+            params.append((name, repr(val)))
+
+    chunks = []
+    for key in sorted(nodes.message_chunks.keys()):
+        chunk = nodes.message_chunks[key]
+        chunks.append((key, chunk.num_states, repr(chunk.msgs_init_strat), \
+                       chunk.msgs_init_min, repr(chunk.msgs_init_range)))
+
+    return (type(nodes), tuple(params), tuple(chunks))
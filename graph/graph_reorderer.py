@@ -0,0 +1,323 @@
+"""Module for the GraphReorderer class. See documentation for GraphReorderer
+class."""
+
+import numpy as np
+from scipy import sparse
+from scipy.sparse import csgraph
+from nodesLib import VarNodes
+from bp_graph import BpGraph
+
+class GraphReorderer(object):
+    """This class renumbers the nodes of a BpGraph so that nodes close in the
+    factor graph get close ids, and builds a renumbered copy of it to run
+    message-passing on. Messages are laid out by node id, and every edge is
+    a gather and a scatter of message rows during distribution (see
+    BpGraph._distribute_messages), so renumbering turns random memory
+    accesses for graphs built in an arbitrary order into near-sequential
+    ones.
+
+    Nodes are ordered either by reverse Cuthill-McKee on the whole factor
+    graph ('rcm'), or, for grid models, by a Z-order (Morton) curve over the
+    grid position of the variable nodes ('curve'); factor nodes then follow
+    the mean position of their variable nodes. The edges of every factor are
+    added in order of the new factor ids, so the rows of every edge type are
+    visited in increasing order.
+
+    The renumbered copy has new Nodes instances (with the same classes and
+    parameters), the unary potentials (including condition_on) and edges of
+    the original; evidence set with VarNodes.set_evidence, stencil edges and
+    edge multiplicities are not supported. Messages start from their initial
+    values. All ids taken and returned by the methods below are the original
+    ids.
+
+    Public methods:
+        finalize: builds and finalizes the renumbered BpGraph.
+
+        do_message_passing: performs message-passing on the renumbered
+            BpGraph.
+
+        get_nodes: get the renumbered Nodes instance of an original one.
+
+        get_new_ids: translate original node ids to renumbered ones.
+
+        get_beliefs: get the beliefs of original variable nodes.
+
+        condition_on: condition on the state of original variable nodes.
+
+        set_evidence: sets hard evidence on original variable nodes.
+
+        clear_evidence: removes the evidence of original variable nodes.
+    """
+
+    ORDERS = frozenset({'rcm', 'curve'})
+
+    def __init__(self, bpg, order='rcm', shapes=None):
+        """Initializer.
+
+        Args:
+            bpg (:obj: BpGraph): the BpGraph to renumber. It is left unchanged,
+                and may or may not be finalized. Its bp_params are used for
+                the renumbered BpGraph.
+
+            order (:obj:`str', optional): one of ORDERS. Defaults to 'rcm'.
+
+            shapes (dict, optional): for order 'curve', maps VarNodes
+                instances to the shape of their grid. Node ids must number
+                the grid positions in row-major order. Nodes instances not
+                given are placed at the mean position of their neighbours.
+        """
+
+        assert order in self.ORDERS, 'Invalid order: ' + str(order)
+        assert order != 'curve' or shapes, "order 'curve' requires shapes"
+        assert not bpg.graph_edge_info.has_stencils(), \
+               'Cannot renumber graphs with stencil edges'
+
+        self.orig_bpg = bpg
+        self.order = order
+        self.shapes = {} if shapes is None else shapes
+
+        #the renumbered BpGraph. None until finalized.
+        self.bpg = None
+
+        #key: original Nodes instance. value: (renumbered Nodes instance, new
+        #id of every original id).
+        self.__placement = {}
+
+    def finalize(self):
+        """Builds and finalizes the renumbered BpGraph."""
+
+        assert self.bpg is None, 'GraphReorderer can only be finalized once.'
+
+        new_bpg = BpGraph(dict(self.orig_bpg.bp_params))
+
+        new_ids = self.__get_new_ids()
+        for nodes in self.orig_bpg.get_scheduled_nodes():
+            new_nodes = nodes._new_empty(nodes.name)
+            new_nodes.create_nodes(nodes.num_nodes)
+            self.__placement[nodes] = (new_nodes, new_ids[nodes])
+
+            if isinstance(nodes, VarNodes):
+                (node_ids, log_vals) = nodes.get_unaries()
+                if node_ids.size > 0:
+                    new_nodes._add_log_unaries(new_ids[nodes][node_ids], log_vals)
+
+        self.__copy_edges(new_bpg)
+
+        for nodes in self.orig_bpg.get_scheduled_nodes():
+            new_bpg.add_nodes_to_schedule(self.__placement[nodes][0])
+        new_bpg.finalize()
+
+        self.bpg = new_bpg
+
+    def __get_edges(self):
+        """Returns the edges of the original BpGraph, as a list of (VarNodes
+        instance, FactorNodes instance, edge type, edge entries; see
+        GraphEdgeInfo.get_edge_entries).
+        """
+
+        chunk_owner = {}
+        for nodes in self.orig_bpg.get_scheduled_nodes():
+            for key in nodes.message_chunks:
+                chunk_owner[nodes.message_chunks[key]] = (nodes, key)
+
+        edges = []
+        edge_info = self.orig_bpg.graph_edge_info
+        for chunk_pair in edge_info.get_chunk_pairs():
+            if chunk_pair[0] not in chunk_owner or chunk_pair[1] not in chunk_owner:
+                continue
+
+            (var_nodes, _) = chunk_owner[chunk_pair[0]]
+            (fac_nodes, edge_type) = chunk_owner[chunk_pair[1]]
+            edges.append((var_nodes, fac_nodes, edge_type, \
+                          edge_info.get_edge_entries(chunk_pair)))
+        return edges
+
+    def __get_new_ids(self):
+        """Returns the new id of every node, as a dict from original Nodes
+        instances to ndarrays indexed by original id. See order.
+        """
+
+        offsets = {}
+        num_total = 0
+        for nodes in self.orig_bpg.get_scheduled_nodes():
+            offsets[nodes] = num_total
+            num_total += nodes.num_nodes
+
+        var_g = [np.zeros(0, dtype='int')]
+        fac_g = [np.zeros(0, dtype='int')]
+        for (var_nodes, fac_nodes, _, entries) in self.__get_edges():
+            var_g.append(entries[:, 0] + offsets[var_nodes])
+            fac_g.append(entries[:, 2] + offsets[fac_nodes])
+        var_g = np.concatenate(var_g)
+        fac_g = np.concatenate(fac_g)
+
+        if self.order == 'rcm':
+            adj = sparse.coo_matrix((np.ones(var_g.size), (var_g, fac_g)), \
+                                    shape=(num_total, num_total))
+            adj = (adj + adj.T).tocsr()
+            key = np.zeros(num_total)
+            key[csgraph.reverse_cuthill_mckee(adj, symmetric_mode=True)] = \
+                np.arange(num_total)
+        else:
+            key = self.__get_curve_keys(offsets, num_total, var_g, fac_g)
+
+        new_ids = {}
+        for nodes in offsets:
+            nodes_key = key[offsets[nodes]:offsets[nodes]+nodes.num_nodes]
+            new_ids[nodes] = np.zeros(nodes.num_nodes, dtype='int')
+            new_ids[nodes][np.argsort(nodes_key, kind='mergesort')] = \
+                np.arange(nodes.num_nodes)
+        return new_ids
+
+    def __get_curve_keys(self, offsets, num_total, var_g, fac_g):
+        """Returns the position of every node along a Z-order curve. Nodes of
+        the VarNodes instances in self.shapes take the position of their grid
+        cell; the other nodes take the mean position of their placed
+        neighbours, repeatedly, and nodes never placed go last.
+        """
+
+        key = np.nan*np.ones(num_total)
+        for nodes in self.shapes:
+            shape = tuple(self.shapes[nodes])
+            assert int(np.prod(shape)) == nodes.num_nodes, \
+                   'Shape does not match the number of nodes: ' + str(shape)
+            key[offsets[nodes]:offsets[nodes]+nodes.num_nodes] = \
+                _get_morton_codes(shape)
+
+        ends = np.concatenate([np.stack([var_g, fac_g], axis=1), \
+                               np.stack([fac_g, var_g], axis=1)])
+        while True:
+            is_placed = ~np.isnan(key[ends[:, 1]])
+            to_place = np.isnan(key[ends[:, 0]]) & is_placed
+            if not to_place.any():
+                break
+
+            sums = np.bincount(ends[to_place, 0], key[ends[to_place, 1]], minlength=num_total)
+            counts = np.bincount(ends[to_place, 0], minlength=num_total)
+            key[counts > 0] = sums[counts > 0]/counts[counts > 0]
+
+        key[np.isnan(key)] = np.inf
+        return key
+
+    def __copy_edges(self, new_bpg):
+        """Copies the edges of the original BpGraph to the renumbered one.
+        Edges are added in order of their location at the factor node, so
+        every factor keeps the order of its edges (eg, the outputs of a
+        CatNodes factor), and then of the new factor ids.
+        """
+
+        new_edges = []
+        max_loc = -1
+        for (var_nodes, fac_nodes, edge_type, entries) in self.__get_edges():
+            (new_var, var_ids) = self.__placement[var_nodes]
+            (new_fac, fac_ids) = self.__placement[fac_nodes]
+            new_edges.append((new_var, var_ids[entries[:, 0]], new_fac, \
+                              fac_ids[entries[:, 2]], entries[:, 3], edge_type))
+            if entries.shape[0] > 0:
+                max_loc = max(max_loc, entries[:, 3].max())
+
+        for loc in range(max_loc+1):
+            for (new_var, var_ids, new_fac, fac_ids, fac_locs, edge_type) in new_edges:
+                at_loc = np.nonzero(fac_locs == loc)[0]
+                at_loc = at_loc[np.argsort(fac_ids[at_loc], kind='mergesort')]
+                new_bpg.add_edges(new_var, var_ids[at_loc], new_fac, fac_ids[at_loc], \
+                                  edge_type)
+
+    def do_message_passing(self, max_seconds=None, max_iters=None, query=None):
+        """Performs message-passing on the renumbered BpGraph. See
+        BpGraph.do_message_passing.
+
+        Args:
+            query (dict, optional): maps original VarNodes instances to
+                original ids (None for all of them).
+        """
+
+        assert self.bpg is not None, 'GraphReorderer has not been finalized.'
+
+        new_query = None
+        if query is not None:
+            new_query = {}
+            for nodes in query:
+                if query[nodes] is None:
+                    new_query[self.get_nodes(nodes)] = None
+                else:
+                    new_query[self.get_nodes(nodes)] = self.get_new_ids(nodes, query[nodes])
+
+        return self.bpg.do_message_passing(max_seconds, max_iters, new_query)
+
+    def get_nodes(self, nodes):
+        """Returns the renumbered Nodes instance of an original Nodes
+        instance.
+        """
+
+        assert self.bpg is not None, 'GraphReorderer has not been finalized.'
+        return self.__placement[nodes][0]
+
+    def get_new_ids(self, nodes, node_ids=None):
+        """Translates original node ids to renumbered ones.
+
+        Args:
+            nodes (:obj: Nodes): an original Nodes instance.
+
+            node_ids (ndarray, optional): original ids. Defaults to all ids.
+
+        Returns:
+            An ndarray of the renumbered ids.
+        """
+
+        assert self.bpg is not None, 'GraphReorderer has not been finalized.'
+
+        new_ids = self.__placement[nodes][1]
+        if node_ids is None:
+            return new_ids
+        return new_ids[np.asarray(node_ids, dtype='int')]
+
+    def get_beliefs(self, nodes, node_ids=None):
+        """Returns the beliefs of original variable nodes, in the order of
+        node_ids. See VarNodes.get_beliefs.
+
+        Args:
+            nodes (:obj: VarNodes): an original VarNodes instance.
+
+            node_ids (ndarray, optional): original ids. Defaults to all ids.
+        """
+
+        if node_ids is None:
+            return self.get_nodes(nodes).get_beliefs()[:, :, self.get_new_ids(nodes)]
+        return self.get_nodes(nodes).get_beliefs(self.get_new_ids(nodes, node_ids))
+
+    def condition_on(self, nodes, node_ids, state):
+        """Conditions on the state of original variable nodes. See
+        VarNodes.condition_on.
+        """
+
+        self.get_nodes(nodes).condition_on(self.get_new_ids(nodes, node_ids), state)
+
+    def set_evidence(self, nodes, node_ids, states):
+        """Sets hard evidence on original variable nodes. See
+        VarNodes.set_evidence.
+        """
+
+        self.get_nodes(nodes).set_evidence(self.get_new_ids(nodes, node_ids), states)
+
+    def clear_evidence(self, nodes):
+        """Removes the evidence of original variable nodes. See
+        VarNodes.clear_evidence.
+        """
+
+        self.get_nodes(nodes).clear_evidence()
+
+def _get_morton_codes(shape):
+    """Returns the position along a Z-order (Morton) curve of every cell of
+    a grid of the given shape, in row-major order of the cells. The bits of
+    the coordinates of a cell are interleaved, most significant first.
+    """
+
+    coords = np.indices(shape).reshape(len(shape), -1)
+    num_bits = int(np.ceil(np.log2(max(max(shape), 2))))
+
+    codes = np.zeros(coords.shape[1], dtype='int64')
+    for bit in reversed(range(num_bits)):
+        for axis in range(len(shape)):
+            codes = (codes << 1) | ((coords[axis] >> bit) & 1)
+    return codes
@@ -0,0 +1,532 @@
+"""Module for the InferenceServer and LocalClient classes. See documentation for
+InferenceServer class."""
+
+import time
+import threading
+import Queue
+from collections import OrderedDict, deque
+import numpy as np
+from nodesLib import VarNodes
+from graph_packer import GraphPacker
+
+class InferenceServer(object):
+    """This class serves inference queries on registered models.
+
+    A model is registered with a function that builds its BpGraph. Finalized
+    models are kept in a cache keyed by model id and topology hash (see
+    BpGraph.topology_hash), from which the least recently used models are
+    evicted once the cache holds more than max_cache_bytes (see
+    BpGraph.get_nbytes). Evicted models are rebuilt when queried again.
+
+    Requests are served by a worker thread. Requests waiting in the queue
+    are taken in batches, and requests in a batch on the same model are
+    answered by a single message-passing run. Requests with the same
+    evidence share a copy of the model, whose query is the union of their
+    queries. If the batch holds several distinct evidence sets, the run is on
+    one BpGraph packing a copy of the model per evidence set (see
+    GraphPacker), in which every copy converges on its own. Packed models
+    are cached like single models, by model id and number of copies. Every
+    request may have a deadline; the run answering it stops by the earliest
+    deadline of its requests, and requests whose deadline passed before
+    their run started fail.
+
+    Served models do not print progress (bp_params['verbose'] is turned
+    off).
+
+    Evidence is given as a dict from the name of a VarNodes instance of the
+    model to a dict from variable node id to observed state. Queries are
+    given as a dict from the name of a VarNodes instance to the ids of the
+    variable nodes of interest (None for all of them).
+
+    Public methods:
+        register_model: registers a model to be served.
+
+        start: starts serving requests.
+
+        stop: stops serving requests.
+
+        submit: queues a request and returns a handle to wait on.
+
+        get_stats: get request, latency, queue and cache statistics.
+    """
+
+    __DEFAULT_PARAMS = {'max_cache_bytes': 1 << 30, 'max_batch': 64, \
+                        'batch_window': 0.0, 'num_latencies': 1000}
+
+    def __init__(self, server_params=None):
+        """Initializer.
+
+        Args:
+            server_params (dict, optional): parameters of the server. Any
+                unspecified parameter takes its default value. See
+                __DEFAULT_PARAMS for a listing of parameters and their default
+                values. 'batch_window' is the number of seconds the worker
+                waits for more requests to batch with the first one, unless
+                a request in the batch has a deadline.
+                'num_latencies' is the number of most recent requests latency
+                percentiles are computed over.
+        """
+
+        if server_params is None:
+            server_params = {}
+
+        for field in InferenceServer.__DEFAULT_PARAMS:
+            if field not in server_params:
+                server_params[field] = InferenceServer.__DEFAULT_PARAMS[field]
+        self.server_params = server_params
+
+        #key: model id. value: (build function, topology hash)
+        self.__registry = {}
+        #key: (model id, topology hash, number of copies). value:
+        #_CompiledModel. in LRU order.
+        self.__cache = OrderedDict()
+        self.__cache_lock = threading.Lock()
+
+        self.__queue = Queue.Queue()
+        self.__worker = None
+        self.__is_running = False
+
+        self.__stats_lock = threading.Lock()
+        self.__latencies = deque(maxlen=server_params['num_latencies'])
+        self.__counts = {'requests': 0, 'failed': 0, 'deadline_misses': 0, \
+                         'batches': 0, 'runs': 0, 'cache_hits': 0, \
+                         'cache_misses': 0, 'cache_evictions': 0}
+
+    def register_model(self, model_id, build_fn):
+        """Registers a model to be served, replacing any model registered
+        with the same id. The model is built and cached right away.
+
+        Args:
+            model_id: identifier of the model.
+
+            build_fn (callable): function without arguments that returns the
+                BpGraph of the model, finalized or not. Must return a graph of
+                the same structure every time it is called.
+        """
+
+        model = _CompiledModel(build_fn())
+        with self.__cache_lock:
+            self.__registry[model_id] = (build_fn, model.topology_hash)
+            self.__insert_model((model_id, model.topology_hash, 1), model)
+
+    def start(self):
+        """Starts serving requests."""
+
+        assert not self.__is_running, 'Server is already running.'
+        self.__is_running = True
+        self.__worker = threading.Thread(target=self.__serve)
+        self.__worker.daemon = True
+        self.__worker.start()
+
+    def stop(self):
+        """Stops serving requests, once the requests in the queue are
+        served.
+        """
+
+        if not self.__is_running:
+            return
+        self.__is_running = False
+        self.__queue.put(None)
+        self.__worker.join()
+
+    def submit(self, model_id, evidence=None, query=None, deadline=None):
+        """Queues a request.
+
+        Args:
+            model_id: identifier of a registered model.
+
+            evidence (dict, optional): evidence of the request. See
+                InferenceServer.
+
+            query (dict, optional): query of the request. See InferenceServer.
+                Defaults to all variable nodes.
+
+            deadline (double, optional): number of seconds from now by which
+                the request must be answered.
+
+        Returns:
+            A request handle. Call its wait method to get the result.
+        """
+
+        assert model_id in self.__registry, 'Unknown model: ' + str(model_id)
+
+        request = _Request(model_id, evidence, query, deadline)
+        with self.__stats_lock:
+            self.__counts['requests'] += 1
+        self.__queue.put(request)
+        return request
+
+    def get_stats(self):
+        """Returns request, latency, queue and cache statistics.
+
+        Returns:
+            A dict with the counts of requests, failed requests, missed
+            deadlines, batches, message-passing runs, cache hits, misses and
+            evictions, and keys:
+                'queue_depth': number of requests waiting.
+                'latency': dict with the 50th, 90th and 99th percentile ('p50',
+                    'p90', 'p99') of the latency, in seconds, of recent
+                    requests.
+                'cache_models': number of cached models.
+                'cache_bytes': number of bytes held by cached models.
+        """
+
+        with self.__stats_lock:
+            stats = dict(self.__counts)
+            latencies = np.asarray(self.__latencies)
+
+        stats['queue_depth'] = self.__queue.qsize()
+        stats['latency'] = {}
+        for pct in (50, 90, 99):
+            if latencies.size > 0:
+                stats['latency']['p%d' %pct] = np.percentile(latencies, pct)
+            else:
+                stats['latency']['p%d' %pct] = 0.0
+
+        with self.__cache_lock:
+            stats['cache_models'] = len(self.__cache)
+            stats['cache_bytes'] = sum([model.nbytes for model in self.__cache.values()])
+        return stats
+
+    def __serve(self):
+        """Main loop of the worker thread."""
+
+        while True:
+            request = self.__queue.get()
+            if request is None:
+                return
+
+            batch = [request]
+            window_end = time.time() + self.server_params['batch_window']
+            while len(batch) < self.server_params['max_batch']:
+                #requests with a deadline don't wait for more requests
+                if request.deadline is not None:
+                    window_end = 0
+                try:
+                    timeout = window_end - time.time()
+                    if timeout > 0:
+                        request = self.__queue.get(timeout=timeout)
+                    else:
+                        request = self.__queue.get_nowait()
+                except Queue.Empty:
+                    break
+                if request is None:
+                    #stop once this batch is served
+                    self.__queue.put(None)
+                    break
+                batch.append(request)
+
+            with self.__stats_lock:
+                self.__counts['batches'] += 1
+            self.__serve_batch(batch)
+
+    def __serve_batch(self, batch):
+        """Serves a batch of requests, with one message-passing run for the
+        requests on the same model.
+        """
+
+        groups = OrderedDict()
+        for request in batch:
+            groups.setdefault(request.model_id, []).append(request)
+
+        for model_id in groups:
+            requests = groups[model_id]
+            try:
+                self.__serve_group(model_id, requests)
+            except Exception as err:
+                for request in requests:
+                    if not request.is_done():
+                        self.__finish(request, error=err)
+
+    def __serve_group(self, model_id, requests):
+        """Serves requests on the same model with one message-passing run,
+        on a copy of the model per distinct evidence set.
+        """
+
+        now = time.time()
+        live = []
+        for request in requests:
+            if request.deadline is not None and request.deadline <= now:
+                with self.__stats_lock:
+                    self.__counts['deadline_misses'] += 1
+                self.__finish(request, error=RuntimeError('Deadline exceeded'))
+            else:
+                live.append(request)
+        if len(live) == 0:
+            return
+
+        deadlines = [request.deadline for request in live if request.deadline is not None]
+        max_seconds = None
+        if len(deadlines) > 0:
+            max_seconds = max(0.0, min(deadlines) - now)
+
+        #requests of every distinct evidence set, each served by a copy
+        groups = OrderedDict()
+        for request in live:
+            groups.setdefault(request.evidence_key, []).append(request)
+        groups = groups.values()
+
+        model = self.__get_model(model_id, len(groups))
+        query = model.get_query([[request.query for request in group] for group in groups])
+        model.set_evidence([group[0].evidence for group in groups])
+
+        bpg = model.bpg
+        bpg.reset_run()
+        snapshot = bpg.do_message_passing(max_seconds=max_seconds, query=query)
+        with self.__stats_lock:
+            self.__counts['runs'] += 1
+
+        for (copy_idx, group) in enumerate(groups):
+            for request in group:
+                beliefs = model.get_beliefs(copy_idx, request.query)
+                self.__finish(request, result={'beliefs': beliefs, \
+                                               'status': snapshot['status'], \
+                                               'iter': snapshot['iter']})
+
+    def __finish(self, request, result=None, error=None):
+        """Completes a request and records its latency."""
+
+        request.finish(result, error)
+        with self.__stats_lock:
+            self.__latencies.append(time.time() - request.submit_time)
+            if error is not None:
+                self.__counts['failed'] += 1
+
+    def __get_model(self, model_id, num_copies=1):
+        """Returns the compiled model of a registered model, with a given
+        number of copies, building it if it is not cached.
+        """
+
+        with self.__cache_lock:
+            (build_fn, topology_hash) = self.__registry[model_id]
+            key = (model_id, topology_hash, num_copies)
+            if key in self.__cache:
+                model = self.__cache.pop(key)
+                self.__cache[key] = model
+                with self.__stats_lock:
+                    self.__counts['cache_hits'] += 1
+                return model
+
+        with self.__stats_lock:
+            self.__counts['cache_misses'] += 1
+
+        if num_copies > 1:
+            #copies are packed from the single model
+            model = _CompiledModel(self.__get_model(model_id).bpg, num_copies)
+        else:
+            model = _CompiledModel(build_fn())
+
+        assert model.topology_hash == topology_hash, \
+               'Model %s was rebuilt with a different structure.' %str(model_id)
+
+        with self.__cache_lock:
+            self.__insert_model(key, model)
+        return model
+
+    def __insert_model(self, key, model):
+        """Inserts a model in the cache and evicts least recently used models
+        while the cache is over budget. The cache lock must be held.
+        """
+
+        self.__cache.pop(key, None)
+        self.__cache[key] = model
+
+        num_bytes = sum([cached.nbytes for cached in self.__cache.values()])
+        while num_bytes > self.server_params['max_cache_bytes'] and len(self.__cache) > 1:
+            (_, evicted) = self.__cache.popitem(last=False)
+            num_bytes -= evicted.nbytes
+            with self.__stats_lock:
+                self.__counts['cache_evictions'] += 1
+
+class LocalClient(object):
+    """This class is an in-process client of an InferenceServer.
+
+    Public methods:
+        query: sends a request and waits for its result.
+
+        stats: get the statistics of the server.
+    """
+
+    def __init__(self, server):
+        """Initializer.
+
+        Args:
+            server (:obj: InferenceServer): the server to send requests to.
+        """
+
+        self.server = server
+
+    def query(self, model_id, evidence=None, query=None, deadline=None):
+        """Sends a request and waits for its result. See
+        InferenceServer.submit for the arguments.
+
+        Returns:
+            A dict with keys 'beliefs' (dict from the name of each queried
+            VarNodes instance to the beliefs of the queried variable nodes),
+            'status' and 'iter' (see BpGraph.iter_message_passing).
+        """
+
+        return self.server.submit(model_id, evidence, query, deadline).wait()
+
+    def stats(self):
+        """Returns the statistics of the server. See InferenceServer.get_stats."""
+
+        return self.server.get_stats()
+
+class _Request(object):
+    """A request queued on an InferenceServer. Call wait to get its result."""
+
+    def __init__(self, model_id, evidence, query, deadline):
+        self.model_id = model_id
+        self.evidence = evidence if evidence is not None else {}
+        self.query = query
+        self.submit_time = time.time()
+        self.deadline = None if deadline is None else self.submit_time + deadline
+
+        #requests with equal keys have equal evidence
+        self.evidence_key = tuple(sorted([(name, tuple(sorted(self.evidence[name].items()))) \
+                                          for name in self.evidence]))
+
+        self.__done = threading.Event()
+        self.__result = None
+        self.__error = None
+
+    def finish(self, result, error):
+        """Sets the result (or error) of the request."""
+
+        self.__result = result
+        self.__error = error
+        self.__done.set()
+
+    def is_done(self):
+        """Returns whether the request is complete."""
+
+        return self.__done.is_set()
+
+    def wait(self, timeout=None):
+        """Waits for the result of the request. Raises the error of the
+        request if it failed.
+
+        Args:
+            timeout (double, optional): seconds to wait. Defaults to waiting
+                until the request completes.
+        """
+
+        if not self.__done.wait(timeout):
+            raise RuntimeError('Timed out waiting for request')
+        if self.__error is not None:
+            raise self.__error
+        return self.__result
+
+class _CompiledModel(object):
+    """A finalized BpGraph of a model, with its VarNodes instances by name.
+    With more than one copy, the BpGraph packs that many copies of the model
+    (see GraphPacker), each with its own evidence.
+    """
+
+    def __init__(self, bpg, num_copies=1):
+        if not bpg.is_finalized:
+            bpg.finalize()
+
+        packer = None
+        if num_copies > 1:
+            bp_params = dict(bpg.bp_params)
+            bp_params['split_components'] = True
+            packer = GraphPacker(bp_params)
+            for _ in range(num_copies):
+                packer.add_graph(bpg)
+            packer.finalize()
+
+        #key: VarNodes name. value: list of (VarNodes instance, offset of the
+        #ids of the model in it), one per copy.
+        self.var_nodes = {}
+        for nodes in bpg.get_scheduled_nodes():
+            if isinstance(nodes, VarNodes):
+                assert nodes.name not in self.var_nodes, \
+                       'VarNodes of a served model must have unique names.'
+                if packer is None:
+                    self.var_nodes[nodes.name] = [(nodes, 0)]
+                else:
+                    self.var_nodes[nodes.name] = [packer.get_nodes(copy_idx, nodes) \
+                                                  for copy_idx in range(num_copies)]
+
+        self.num_copies = num_copies
+        self.topology_hash = bpg.topology_hash()
+        #number of variable nodes of every VarNodes instance of the model
+        self.__num_nodes = dict([(nodes.name, nodes.num_nodes) \
+                                 for nodes in bpg.get_scheduled_nodes()])
+
+        self.bpg = bpg if packer is None else packer.bpg
+        self.bpg.bp_params['verbose'] = False
+        self.nbytes = self.bpg.get_nbytes()
+
+    def set_evidence(self, evidences):
+        """Replaces the evidence on the model.
+
+        Args:
+            evidences (list): evidence of every copy. See InferenceServer.
+        """
+
+        #key: VarNodes instance. value: (node ids, states)
+        packed = {}
+        for (copy_idx, evidence) in enumerate(evidences):
+            for name in evidence:
+                assert name in self.var_nodes, 'Unknown VarNodes: ' + str(name)
+                (nodes, offset) = self.var_nodes[name][copy_idx]
+                node_ids = evidence[name].keys()
+                (packed_ids, states) = packed.setdefault(nodes, ([], []))
+                packed_ids += [offset + i for i in node_ids]
+                states += [evidence[name][i] for i in node_ids]
+
+        for name in self.var_nodes:
+            for (nodes, _) in self.var_nodes[name]:
+                if nodes in packed:
+                    nodes.set_evidence(packed[nodes][0], packed[nodes][1])
+                else:
+                    nodes.clear_evidence()
+
+    def get_query(self, copy_queries):
+        """Returns the BpGraph query (see BpGraph.do_message_passing) that is
+        the union of the given queries, or None for all variable nodes.
+
+        Args:
+            copy_queries (list): list of the queries on every copy.
+        """
+
+        if self.num_copies == 1 and any([query is None for query in copy_queries[0]]):
+            return None
+
+        res = {}
+        for (copy_idx, queries) in enumerate(copy_queries):
+            for query in queries:
+                if query is None:
+                    query = dict([(name, None) for name in self.var_nodes])
+
+                for name in query:
+                    assert name in self.var_nodes, 'Unknown VarNodes: ' + str(name)
+                    (nodes, offset) = self.var_nodes[name][copy_idx]
+                    if query[name] is None:
+                        node_ids = np.arange(self.__num_nodes[name])
+                    else:
+                        node_ids = np.asarray(query[name], dtype='int').ravel()
+                    res[nodes] = np.union1d(res.get(nodes, np.zeros(0, dtype='int')), \
+                                            node_ids + offset)
+        return res
+
+    def get_beliefs(self, copy_idx, query):
+        """Returns the beliefs of the variable nodes of a query on a copy, as
+        a dict from VarNodes name to beliefs.
+        """
+
+        if query is None:
+            query = dict([(name, None) for name in self.var_nodes])
+
+        beliefs = {}
+        for name in query:
+            (nodes, offset) = self.var_nodes[name][copy_idx]
+            node_ids = query[name]
+            if node_ids is None:
+                node_ids = np.arange(self.__num_nodes[name])
+            node_ids = np.asarray(node_ids, dtype='int').ravel()
+            beliefs[name] = nodes.get_beliefs(node_ids + offset)
+        return beliefs
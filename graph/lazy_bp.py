@@ -0,0 +1,534 @@
+"""Module for the LazyBp class. See documentation for LazyBp class."""
+
+import numpy as np
+from nodesLib import VarNodes
+from bp_graph import BpGraph
+from graph_edge_info import _get_windows
+
+class LazyBp(object):
+    """This class performs belief propagation on a translation-invariant
+    factor graph over an image (or any grid), instantiating only the part of
+    it near the evidence.
+
+    The factor graph is described by templates rather than built: every
+    template is an empty Nodes instance standing for one node per location of
+    the grid (and per channel, for variable nodes; eg, one channel per output
+    of a categorical factor), and edges are given as stencils, like
+    BpGraph.add_stencil_edges. Evidence is given per location.
+
+    Message-passing runs on a region of variable nodes: first those within
+    'radius' hops (a hop being a factor shared by two variable nodes) of the
+    evidence and of seed locations. The BpGraph built holds the factors of
+    the region's variable nodes and all variable nodes of these factors;
+    other factors of the variable nodes outside the region are left out (see
+    below). Every BpGraph runs message-passing twice, without and with the
+    evidence, so every expansion costs two runs. The region then grows by
+    'radius' hops around every variable node whose belief the evidence
+    changes by more than 'expand_tol', and message-passing runs again on the
+    larger BpGraph, starting from the messages of the previous one. This
+    repeats until the region stops growing, so memory and time scale with
+    the region the evidence influences rather than with the grid.
+
+    Variable nodes are always instantiated along with their ancestors (the
+    factors they are children of, see FactorNodes.CHILD_EDGE_TYPES, and
+    recursively the variable nodes of these). The factors left out then only
+    have children outside the BpGraph, and leaving them out is exact if their
+    children carry no evidence, eg the noisy-or factors of symbols far from
+    any conditioned point. The method is exact only in that case. Leaving
+    out other factors (eg, Potts factors) is an approximation that
+    'expand_tol' does not bound: it measures the influence of the evidence,
+    not the error of the factors left out, which can be much larger (eg,
+    for a Potts grid whose variable nodes all carry unary potentials).
+    Beliefs of the variable nodes that lost factors (see get_frontier) are
+    then approximate, and so are the other beliefs of the region, less so the
+    farther they are from the frontier.
+
+    Public methods:
+        add_nodes: add a template of nodes.
+
+        add_stencil_edges: add a template of edges.
+
+        condition_on: condition on the state of variable nodes.
+
+        add_seeds: add variable nodes the region must hold.
+
+        do_message_passing: performs message-passing on a growing region.
+
+        get_beliefs: get the beliefs of the variable nodes of a template.
+
+        get_region: get the nodes of a template instantiated.
+
+        get_frontier: get the variable nodes of a template instantiated
+            without all their factors.
+
+        get_bpg: get the BpGraph of the last run.
+
+        get_num_expansions: get the number of times the region grew.
+    """
+
+    def __init__(self, shape, bp_params=None, radius=2, expand_tol=1e-3, \
+                 max_expansions=None):
+        """Initializer.
+
+        Args:
+            shape (tuple): shape of the grid.
+
+            bp_params (dict, optional): parameters of the BpGraphs built. See
+                BpGraph.
+
+            radius (int, optional): number of hops the region holds around
+                the evidence, and grows by. Defaults to 2.
+
+            expand_tol (double, optional): change of belief (maximum absolute
+                difference) by the evidence of a variable node above which the
+                region grows around it. Defaults to 1e-3.
+
+            max_expansions (int, optional): maximum number of times the region
+                grows. Defaults to no maximum.
+        """
+
+        assert radius >= 1, 'radius must be >= 1'
+
+        self.shape = tuple(shape)
+        self.bp_params = bp_params
+        self.radius = radius
+        self.expand_tol = expand_tol
+        self.max_expansions = max_expansions
+
+        #templates in the order they were added. every template is a dict
+        #with keys 'nodes' (the empty Nodes instance), 'num_channels',
+        #'unary_fn' and, once built, 'built' (the Nodes instance of the
+        #last BpGraph), 'mask' (boolean [num_channels]+shape ndarray of the
+        #nodes instantiated) and 'ids' (ndarray of their ids, -1 elsewhere).
+        self.__names = []
+        self.__templates = {}
+
+        #tuples (var_name, channels, fac_name, offsets, edge_type)
+        self.__edges = []
+
+        #tuples (name, flat indices, state)
+        self.__conditions = []
+
+        #key: template name. value: boolean mask of the seed variable nodes
+        self.__seeds = {}
+
+        #key: template name. value: boolean mask of the variable nodes of the
+        #region
+        self.__region = {}
+
+        self.__bpg = None
+        self.__num_expansions = 0
+
+    def add_nodes(self, name, nodes, num_channels=1, unary_fn=None):
+        """Adds a template of nodes: one node of nodes per channel and
+        location of the grid.
+
+        Args:
+            name (str): name of the template.
+
+            nodes (:obj: Nodes): empty Nodes instance. Instances with the same
+                class and parameters are built for every run.
+
+            num_channels (int, optional): number of nodes per location. Must
+                be 1 for factor nodes. Defaults to 1.
+
+            unary_fn (callable, optional): for variable nodes, function
+                mapping an [n, 1+#dims] ndarray of (channel, location...)
+                rows to the [n, num_states] ndarray of the unary potentials
+                of these variable nodes. Defaults to no unary potentials.
+        """
+
+        assert name not in self.__templates, 'Template already added: ' + name
+        assert nodes.num_nodes == 0, 'Templates must not have nodes'
+        assert isinstance(nodes, VarNodes) or (num_channels == 1 and unary_fn is None), \
+               'Factor templates have one channel and no unary potentials'
+
+        self.__names.append(name)
+        self.__templates[name] = {'nodes': nodes, 'num_channels': num_channels, \
+                                  'unary_fn': unary_fn}
+
+    def add_stencil_edges(self, var_name, channels, fac_name, offsets, edge_type=None):
+        """Adds a template of edges: for every k, the variable node of
+        channel channels[k] at every location q is connected to the factor
+        node at q+offsets[k], if inside the grid. See
+        BpGraph.add_stencil_edges.
+
+        Args:
+            var_name (str): name of the template of the variable nodes.
+
+            channels (list): channel of the variable nodes of every offset.
+
+            fac_name (str): name of the template of the factor nodes.
+
+            offsets (ndarray): [K, #dims] ndarray of offsets from the variable
+                nodes to the factor nodes.
+
+            edge_type (str, optional): type of the edges at the factor nodes.
+        """
+
+        assert isinstance(self.__templates[var_name]['nodes'], VarNodes), \
+               'Edges go from variable nodes'
+        assert not isinstance(self.__templates[fac_name]['nodes'], VarNodes), \
+               'Edges go to factor nodes'
+
+        channels = np.asarray(channels, dtype='int').ravel()
+        offsets = np.asarray(offsets, dtype='int').reshape(-1, len(self.shape))
+        assert channels.size == offsets.shape[0], 'Must give one channel per offset'
+        assert np.all(channels < self.__templates[var_name]['num_channels'])
+
+        self.__edges.append((var_name, channels, fac_name, offsets, edge_type))
+
+    def condition_on(self, name, locations, state):
+        """Conditions on the state of variable nodes, as evidence (see
+        VarNodes.set_evidence). The region always holds them.
+
+        Args:
+            name (str): name of the template of the variable nodes.
+
+            locations (ndarray): [n, 1+#dims] ndarray of the (channel,
+                location...) of the variable nodes.
+
+            state (int): state to condition on.
+        """
+
+        flat = self.__flat_idxs(name, locations)
+        self.__conditions.append((name, flat, state))
+        self.__add_seed_idxs(name, flat)
+
+    def add_seeds(self, name, locations):
+        """Adds variable nodes the region must hold, eg nodes whose beliefs
+        are of interest.
+
+        Args:
+            name (str): name of the template of the variable nodes.
+
+            locations (ndarray): see condition_on.
+        """
+
+        self.__add_seed_idxs(name, self.__flat_idxs(name, locations))
+
+    def __flat_idxs(self, name, locations):
+        """Returns the flat indices of (channel, location...) rows."""
+
+        assert isinstance(self.__templates[name]['nodes'], VarNodes), \
+               'Only variable nodes can be conditioned on or seeded'
+
+        locations = np.asarray(locations, dtype='int').reshape(-1, 1+len(self.shape))
+        return np.ravel_multi_index(tuple(locations.T), self.__get_shape(name))
+
+    def __add_seed_idxs(self, name, flat):
+        """Adds the variable nodes of flat indices to the seeds."""
+
+        if name not in self.__seeds:
+            self.__seeds[name] = np.zeros(self.__get_shape(name), dtype='bool')
+        self.__seeds[name].flat[flat] = True
+
+    def __get_shape(self, name):
+        """Returns the shape of the nodes of a template, [num_channels]+shape."""
+
+        return (self.__templates[name]['num_channels'],) + self.shape
+
+    def __var_names(self):
+        """Returns the names of the templates of variable nodes."""
+
+        return [name for name in self.__names \
+                if isinstance(self.__templates[name]['nodes'], VarNodes)]
+
+    def __to_factors(self, var_masks, child_only=False):
+        """Returns the masks of the factor nodes of the variable nodes of the
+        given masks. With child_only, only factors the variable nodes are
+        children of (see FactorNodes.CHILD_EDGE_TYPES) are returned.
+        """
+
+        fac_masks = {}
+        for (var_name, channels, fac_name, offsets, edge_type) in self.__edges:
+            if fac_name not in fac_masks:
+                fac_masks[fac_name] = np.zeros(self.__get_shape(fac_name), dtype='bool')
+            child_types = self.__templates[fac_name]['nodes'].CHILD_EDGE_TYPES
+            if child_only and (edge_type or 'default') not in child_types:
+                continue
+            for (channel, offset) in zip(channels, offsets):
+                (var_win, fac_win) = _get_windows(self.shape, offset)
+                fac_masks[fac_name][0][fac_win] |= var_masks[var_name][channel][var_win]
+        return fac_masks
+
+    def __to_vars(self, fac_masks):
+        """Returns the masks of the variable nodes of the factor nodes of the
+        given masks.
+        """
+
+        var_masks = dict((name, np.zeros(self.__get_shape(name), dtype='bool')) \
+                         for name in self.__var_names())
+        for (var_name, channels, fac_name, offsets, _) in self.__edges:
+            for (channel, offset) in zip(channels, offsets):
+                (var_win, fac_win) = _get_windows(self.shape, offset)
+                var_masks[var_name][channel][var_win] |= fac_masks[fac_name][0][fac_win]
+        return var_masks
+
+    def __grow(self, var_masks, hops):
+        """Returns the masks of the variable nodes at most hops hops from
+        those of the given masks.
+        """
+
+        var_masks = dict((name, var_masks[name].copy()) for name in var_masks)
+        for _ in range(hops):
+            reached = self.__to_vars(self.__to_factors(var_masks))
+            for name in var_masks:
+                var_masks[name] |= reached[name]
+        return var_masks
+
+    def __build(self):
+        """Builds and finalizes the BpGraph of the region: the factor nodes
+        of its variable nodes and the variable nodes of these factors, along
+        with their ancestors: the factor nodes any of these variable nodes is
+        a child of, and their variable nodes, recursively.
+        """
+
+        fac_masks = self.__to_factors(self.__region)
+        masks = self.__to_vars(fac_masks)
+        for name in self.__var_names():
+            masks[name] |= self.__region[name]
+
+        num_nodes = -1
+        while num_nodes < sum(np.sum(mask) for mask in masks.values()):
+            num_nodes = sum(np.sum(mask) for mask in masks.values())
+            parents = self.__to_factors(masks, child_only=True)
+            for name in fac_masks:
+                fac_masks[name] |= parents[name]
+            ancestors = self.__to_vars(fac_masks)
+            for name in masks:
+                masks[name] |= ancestors[name]
+        masks.update(fac_masks)
+
+        bpg = BpGraph(None if self.bp_params is None else dict(self.bp_params))
+        for name in self.__names:
+            template = self.__templates[name]
+            nodes = template['nodes']._new_empty(template['nodes'].name)
+            mask = masks.get(name, np.zeros(self.__get_shape(name), dtype='bool'))
+
+            ids = -np.ones(mask.shape, dtype='int')
+            if np.any(mask):
+                ids[mask] = nodes.create_nodes(int(mask.sum()))
+            (template['built'], template['mask'], template['ids']) = (nodes, mask, ids)
+
+            if template['unary_fn'] is not None and np.any(mask):
+                nodes.add_unaries(ids[mask], template['unary_fn'](np.argwhere(mask)))
+
+
+        for (var_name, channels, fac_name, offsets, edge_type) in self.__edges:
+            var_ids = self.__templates[var_name]['ids']
+            fac_ids = self.__templates[fac_name]['ids'][0]
+            for (channel, offset) in zip(channels, offsets):
+                (var_win, fac_win) = _get_windows(self.shape, offset)
+                c_ids = var_ids[channel][var_win]
+                o_ids = fac_ids[fac_win]
+                is_edge = (c_ids >= 0) & (o_ids >= 0)
+                if np.any(is_edge):
+                    bpg.add_edges(self.__templates[var_name]['built'], c_ids[is_edge], \
+                                  self.__templates[fac_name]['built'], o_ids[is_edge], \
+                                  edge_type)
+
+        for name in self.__names:
+            if np.any(self.__templates[name]['mask']):
+                bpg.add_nodes_to_schedule(self.__templates[name]['built'])
+
+        bpg.finalize()
+        return bpg
+
+    def __get_edges(self):
+        """Returns the edges of the BpGraph last built: a list with, per
+        template of edges, None if it has no edges, or a tuple (keys,
+        var_chunk, var_entries, fac_chunk, fac_entries). keys identify every
+        edge by the locations of its variable node and factor node; entries
+        are (location, id) tuples of ndarrays indexing the messages of every
+        edge in the MessageChunk of each side.
+        """
+
+        edge_info = self.__bpg.graph_edge_info
+        edges = []
+        for (var_name, _, fac_name, _, edge_type) in self.__edges:
+            var_template = self.__templates[var_name]
+            fac_template = self.__templates[fac_name]
+            var_chunk = var_template['built'].get_msg_chunk()
+            fac_chunk = fac_template['built'].message_chunks[edge_type or 'default']
+            if (var_chunk, fac_chunk) not in edge_info.get_chunk_pairs():
+                edges.append(None)
+                continue
+
+            entries = edge_info.get_edge_entries((var_chunk, fac_chunk))
+            var_flat = np.flatnonzero(var_template['mask'])[entries[:, 0]]
+            fac_flat = np.flatnonzero(fac_template['mask'])[entries[:, 2]]
+            keys = var_flat.astype('int64')*fac_template['mask'].size + fac_flat
+            edges.append((keys, var_chunk, (entries[:, 1], entries[:, 0]), \
+                          fac_chunk, (entries[:, 3], entries[:, 2])))
+        return edges
+
+    def __get_edge_msgs(self):
+        """Returns the messages on the edges of the BpGraph last built: a
+        list with, per template of edges, None if it has no edges, or a tuple
+        (keys, var msgs, fac msgs) of the keys of the edges (see __get_edges)
+        and the [#edges, num_states] ndarrays of the messages to their
+        variable nodes and factor nodes.
+        """
+
+        edge_msgs = []
+        for edges in self.__get_edges():
+            if edges is None:
+                edge_msgs.append(None)
+                continue
+
+            (keys, var_chunk, var_entries, fac_chunk, fac_entries) = edges
+            for chunk in (var_chunk, fac_chunk):
+                chunk.prepare_msgs_for_computation()
+            edge_msgs.append((keys, var_chunk.msgs_in[var_entries[0], :, var_entries[1]], \
+                              fac_chunk.msgs_in[fac_entries[0], :, fac_entries[1]]))
+        return edge_msgs
+
+    def __set_edge_msgs(self, edge_msgs):
+        """Sets the messages on the edges of the BpGraph last built that were
+        in the BpGraph before to their messages there, as returned by
+        __get_edge_msgs.
+        """
+
+        for (old, edges) in zip(edge_msgs, self.__get_edges()):
+            if old is None or edges is None:
+                continue
+
+            (keys, var_chunk, var_entries, fac_chunk, fac_entries) = edges
+            (_, old_idx, new_idx) = np.intersect1d(old[0], keys, assume_unique=True, \
+                                                   return_indices=True)
+            for chunk in (var_chunk, fac_chunk):
+                chunk.prepare_msgs_for_computation()
+            var_chunk.msgs_in[var_entries[0][new_idx], :, var_entries[1][new_idx]] = \
+                old[1][old_idx]
+            fac_chunk.msgs_in[fac_entries[0][new_idx], :, fac_entries[1][new_idx]] = \
+                old[2][old_idx]
+
+    def __set_evidence(self, is_set):
+        """Sets (or clears) the evidence given by condition_on on the
+        variable nodes of the BpGraph last built.
+        """
+
+        for name in self.__var_names():
+            self.__templates[name]['built'].clear_evidence()
+
+        if not is_set:
+            return
+
+        for name in set(cond[0] for cond in self.__conditions):
+            conds = [cond for cond in self.__conditions if cond[0] == name]
+            flat = np.concatenate([cond[1] for cond in conds])
+            states = np.concatenate([cond[2]*np.ones(cond[1].size, dtype='int') \
+                                     for cond in conds])
+            self.__templates[name]['built'].set_evidence(self.__templates[name]['ids'].flat[flat], \
+                                                         states)
+
+    def do_message_passing(self, max_seconds=None, max_iters=None):
+        """Performs message-passing on the region, growing it until the
+        evidence changes no belief by more than expand_tol near its boundary.
+        Every expansion runs message-passing twice, without and with the
+        evidence. See BpGraph.do_message_passing.
+
+        Args:
+            max_seconds (double, optional): see BpGraph.do_message_passing.
+                Applies to every run.
+
+            max_iters (int, optional): see BpGraph.do_message_passing.
+                Applies to every run.
+
+        Returns:
+            The last snapshot of the last run. See
+            BpGraph.iter_message_passing.
+        """
+
+        assert len(self.__seeds) > 0, 'Must condition on or seed variable nodes'
+
+        seeds = dict((name, self.__seeds.get(name, np.zeros(self.__get_shape(name), \
+                                                            dtype='bool'))) \
+                     for name in self.__var_names())
+        self.__region = self.__grow(seeds, self.radius)
+        self.__num_expansions = 0
+        self.__bpg = None
+
+        while True:
+            edge_msgs = None if self.__bpg is None else self.__get_edge_msgs()
+            self.__bpg = self.__build()
+            if edge_msgs is not None:
+                self.__set_edge_msgs(edge_msgs)
+
+            #influence of the evidence: change of the beliefs it makes
+            self.__set_evidence(False)
+            self.__bpg.do_message_passing(max_seconds, max_iters)
+            prior_bel = dict((name, self.get_beliefs(name)) for name in self.__var_names())
+
+            self.__set_evidence(True)
+            self.__bpg.reset_run()
+            snapshot = self.__bpg.do_message_passing(max_seconds, max_iters)
+
+            influenced = {}
+            for name in prior_bel:
+                diff = np.max(np.abs(self.get_beliefs(name) - prior_bel[name]), axis=-1)
+                influenced[name] = self.__templates[name]['mask'].copy()
+                influenced[name][influenced[name]] = diff[influenced[name]] > self.expand_tol
+
+            if self.max_expansions is not None and \
+               self.__num_expansions >= self.max_expansions:
+                break
+
+            grown = self.__grow(influenced, self.radius)
+            is_grown = False
+            for name in grown:
+                is_grown |= np.any(grown[name] & ~self.__region[name])
+                self.__region[name] |= grown[name]
+            if not is_grown:
+                break
+            self.__num_expansions += 1
+
+        return snapshot
+
+    def get_beliefs(self, name):
+        """Returns the beliefs of the variable nodes of a template, as a
+        [num_channels]+shape+[num_states] ndarray. Beliefs of variable nodes
+        not instantiated by the last run are NaN, and those near the frontier
+        may be approximate (see get_frontier).
+        """
+
+        template = self.__templates[name]
+        nodes = template['built']
+        bel = np.nan*np.ones(self.__get_shape(name) + (nodes.num_states,))
+        if np.any(template['mask']):
+            bel[template['mask']] = nodes.get_beliefs()[0].T[template['ids'][template['mask']]]
+        return bel
+
+    def get_region(self, name):
+        """Returns the boolean [num_channels]+shape mask of the nodes of a
+        template instantiated by the last run.
+        """
+
+        return self.__templates[name]['mask'].copy()
+
+    def get_frontier(self, name):
+        """Returns the boolean [num_channels]+shape mask of the variable
+        nodes of a template instantiated by the last run without all their
+        factors. Unless the factors left out only have children without
+        evidence, their beliefs are approximate.
+        """
+
+        masks = dict((var_name, self.__templates[var_name]['mask']) \
+                     for var_name in self.__var_names())
+        fac_masks = self.__to_factors(masks)
+        for fac_name in fac_masks:
+            fac_masks[fac_name] &= ~self.__templates[fac_name]['mask']
+        return self.__to_vars(fac_masks)[name] & masks[name]
+
+    def get_bpg(self):
+        """Returns the BpGraph of the last run."""
+
+        return self.__bpg
+
+    def get_num_expansions(self):
+        """Returns the number of times the region grew in the last call to
+        do_message_passing.
+        """
+
+        return self.__num_expansions
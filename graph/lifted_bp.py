@@ -0,0 +1,295 @@
+"""Module for the LiftedBp class. See documentation for LiftedBp class."""
+
+import numpy as np
+from nodesLib import VarNodes
+from bp_graph import BpGraph
+
+class LiftedBp(object):
+    """This class performs lifted belief propagation: message-passing on a
+    compressed version of a factor graph in which indistinguishable nodes are
+    merged.
+
+    Nodes are grouped by color passing. Initially, variable nodes are colored
+    by their Nodes instance and unary potentials, and factor nodes by their
+    Nodes instance (whose parameters all its factors share). Every round, a
+    node's color is refined by the multiset of colors of its neighbours,
+    along with the edge types and the location of every edge at its factor.
+    Once no color splits any further, nodes of one color exchange identical
+    messages at every fixed point of the message-passing.
+
+    The lifted BpGraph holds one node per color. A lifted factor keeps the
+    edges of one of its factors, each connected to the lifted node of the
+    variable node's color. A lifted variable node has one edge per (factor
+    color, location at the factor) of its neighbours, and counts the message
+    on that edge as many times as it has such neighbours (see
+    VarNodes.set_edge_multiplicities). Message-passing then takes time and
+    memory in the number of colors, not of nodes.
+
+    Evidence set with VarNodes.set_evidence is not supported: the variable
+    nodes of the lifted graph must not have any.
+
+    Public methods:
+        do_message_passing: performs message-passing on the lifted BpGraph.
+
+        get_beliefs: get the beliefs of the variable nodes of the original
+            factor graph.
+
+        get_colors: get the color of every node of a Nodes instance.
+
+        get_num_nodes: get the number of nodes of the original and of the
+            lifted factor graph.
+    """
+
+    #seed of the random 64-bit values hashing multisets of neighbour colors
+    __HASH_SEED = 0
+
+    def __init__(self, bpg, bp_params=None):
+        """Initializer. Runs color passing and builds and finalizes the lifted
+        BpGraph.
+
+        Args:
+            bpg (:obj: BpGraph): the factor graph to lift. It may or may not
+                be finalized; it is left unchanged.
+
+            bp_params (dict, optional): parameters of the lifted BpGraph. See
+                BpGraph. Defaults to the parameters of bpg.
+        """
+
+        if bp_params is None:
+            bp_params = dict(bpg.bp_params)
+
+        assert not any([isinstance(nodes, VarNodes) and nodes.has_evidence() \
+                        for nodes in bpg.get_scheduled_nodes()]), \
+               'Cannot lift graphs with evidence set by set_evidence'
+
+        self.bpg = bpg
+
+        #key: Nodes instance of bpg. value: global number of its node 0
+        self.__offsets = {}
+        num_total = 0
+        for nodes in bpg.get_scheduled_nodes():
+            self.__offsets[nodes] = num_total
+            num_total += nodes.num_nodes
+        self.__num_total = num_total
+
+        self.__colors = self.__color_nodes()
+
+        #key: Nodes instance of bpg. value: lifted Nodes instance.
+        self.__lifted = {}
+        #lifted node id of every color
+        self.__lifted_ids = np.zeros(self.__colors.max()+1, dtype='int')
+
+        self.lifted_bpg = self.__build_lifted(BpGraph(bp_params))
+
+    def __get_edges(self):
+        """Returns the edges of the scheduled Nodes instances of bpg, as a
+        tuple (var_g, fac_g, pair_idx, fac_loc, chunk_pairs) of ndarrays: the
+        global numbers of the variable and factor node of every edge, the
+        index of its pair of MessageChunks in chunk_pairs, and the location of
+        the edge at the factor.
+        """
+
+        chunk_offsets = {}
+        for nodes in self.__offsets:
+            for key in nodes.message_chunks:
+                chunk_offsets[nodes.message_chunks[key]] = self.__offsets[nodes]
+
+        edge_info = self.bpg.graph_edge_info
+        assert not edge_info.has_stencils(), 'Cannot lift graphs with stencil edges'
+        var_g = [np.zeros(0, dtype='int')]
+        fac_g = [np.zeros(0, dtype='int')]
+        pair_idx = [np.zeros(0, dtype='int')]
+        fac_loc = [np.zeros(0, dtype='int')]
+        chunk_pairs = []
+        for chunk_pair in edge_info.get_chunk_pairs():
+            if chunk_pair[0] not in chunk_offsets or chunk_pair[1] not in chunk_offsets:
+                continue
+
+            entries = edge_info.get_edge_entries(chunk_pair)
+            var_g.append(entries[:, 0] + chunk_offsets[chunk_pair[0]])
+            fac_g.append(entries[:, 2] + chunk_offsets[chunk_pair[1]])
+            pair_idx.append(len(chunk_pairs)*np.ones(entries.shape[0], dtype='int'))
+            fac_loc.append(entries[:, 3])
+            chunk_pairs.append(chunk_pair)
+
+        return (np.concatenate(var_g), np.concatenate(fac_g), \
+                np.concatenate(pair_idx), np.concatenate(fac_loc), chunk_pairs)
+
+    def __color_nodes(self):
+        """Runs color passing. Returns the color of every node in the global
+        numbering, as an ndarray of ints numbered from 0.
+        """
+
+        #initial colors: Nodes instance, and class of unary potential
+        init = np.zeros((self.__num_total, 2), dtype='int')
+        for (nodes_idx, nodes) in enumerate(self.bpg.get_scheduled_nodes()):
+            offset = self.__offsets[nodes]
+            init[offset:offset+nodes.num_nodes, 0] = nodes_idx
+            if isinstance(nodes, VarNodes):
+                (node_ids, log_vals) = nodes.get_unaries()
+                if node_ids.size > 0:
+                    (_, unary_class) = np.unique(log_vals, axis=0, return_inverse=True)
+                    init[offset+node_ids, 1] = unary_class.ravel() + 1
+        (_, colors) = np.unique(init, axis=0, return_inverse=True)
+        colors = colors.ravel()
+
+        (var_g, fac_g, pair_idx, fac_loc, _) = self.__get_edges()
+        rng = np.random.RandomState(self.__HASH_SEED)
+
+        #(edge type, location at the factor) of every edge, as one number
+        edge_slot = pair_idx*(fac_loc.max()+1 if fac_loc.size else 1) + fac_loc
+
+        num_colors = colors.max()+1
+        while True:
+            #hash the multiset of (edge slot, neighbour color) of every node
+            #as a sum of random 64-bit values, wrapping around
+            sig = np.zeros(self.__num_total, dtype=np.uint64)
+            for (own_g, other_g) in ((var_g, fac_g), (fac_g, var_g)):
+                (_, key_idx) = np.unique(edge_slot*num_colors + colors[other_g], \
+                                         return_inverse=True)
+                key_hash = rng.randint(0, 2**62, size=key_idx.size and key_idx.max()+1)
+                np.add.at(sig, own_g, key_hash[key_idx].astype(np.uint64))
+
+            #new color: (old color, hash)
+            order = np.lexsort((sig, colors))
+            is_new = np.ones(self.__num_total, dtype='bool')
+            is_new[1:] = (colors[order][1:] != colors[order][:-1]) | \
+                         (sig[order][1:] != sig[order][:-1])
+            colors = np.empty(self.__num_total, dtype='int')
+            colors[order] = np.cumsum(is_new) - 1
+
+            if colors.max()+1 == num_colors:
+                return colors
+            num_colors = colors.max()+1
+
+    def __build_lifted(self, lifted_bpg):
+        """Builds and finalizes the lifted BpGraph."""
+
+        colors = self.__colors
+        (_, rep_of) = np.unique(colors, return_index=True)
+
+        for nodes in self.bpg.get_scheduled_nodes():
+            offset = self.__offsets[nodes]
+            node_colors = np.unique(colors[offset:offset+nodes.num_nodes])
+
+            lifted_nodes = nodes._new_empty(nodes.name)
+            lifted_nodes.create_nodes(node_colors.size)
+            self.__lifted[nodes] = lifted_nodes
+            self.__lifted_ids[node_colors] = np.arange(node_colors.size)
+
+            if isinstance(nodes, VarNodes):
+                (node_ids, log_vals) = nodes.get_unaries()
+                pos = -np.ones(nodes.num_nodes, dtype='int')
+                pos[node_ids] = np.arange(node_ids.size)
+                rep_pos = pos[rep_of[node_colors] - offset]
+                has_unary = rep_pos >= 0
+                if has_unary.any():
+                    lifted_nodes._add_log_unaries(np.nonzero(has_unary)[0], \
+                                                  log_vals[rep_pos[has_unary], :])
+
+        (var_g, fac_g, pair_idx, fac_loc, chunk_pairs) = self.__get_edges()
+
+        #multiplicity of every (pair, variable color, factor color, location)
+        #at the representative of the variable color
+        is_var_rep = rep_of[colors[var_g]] == var_g
+        (mult_keys, mult_counts) = \
+            np.unique(np.column_stack((pair_idx, colors[var_g], colors[fac_g], \
+                                       fac_loc))[is_var_rep, :], \
+                      axis=0, return_counts=True)
+
+        #lifted edges: the edges of the representatives of factor colors
+        is_fac_rep = rep_of[colors[fac_g]] == fac_g
+        lifted_keys = np.column_stack((pair_idx, colors[var_g], colors[fac_g], \
+                                       fac_loc))[is_fac_rep, :]
+        mult_idx = _find_rows(mult_keys, lifted_keys)
+
+        chunk_owner = {}
+        for nodes in self.__offsets:
+            for key in nodes.message_chunks:
+                chunk_owner[nodes.message_chunks[key]] = (nodes, key)
+
+        #key: lifted VarNodes instance. value: list of (lifted factor chunk,
+        #lifted factor ids, locations, multiplicities)
+        mults = {}
+        max_loc = lifted_keys[:, 3].max() if lifted_keys.shape[0] > 0 else -1
+        for loc in range(max_loc+1):
+            for (pair, chunk_pair) in enumerate(chunk_pairs):
+                sel = (lifted_keys[:, 0] == pair) & (lifted_keys[:, 3] == loc)
+                if not sel.any():
+                    continue
+
+                (var_nodes, _) = chunk_owner[chunk_pair[0]]
+                (fac_nodes, edge_type) = chunk_owner[chunk_pair[1]]
+                lifted_var = self.__lifted[var_nodes]
+                lifted_fac = self.__lifted[fac_nodes]
+
+                var_ids = self.__lifted_ids[lifted_keys[sel, 1]]
+                fac_ids = self.__lifted_ids[lifted_keys[sel, 2]]
+                lifted_bpg.add_edges(lifted_var, var_ids, lifted_fac, fac_ids, edge_type)
+
+                mults.setdefault(lifted_var, []).append( \
+                    (lifted_fac.message_chunks[edge_type], fac_ids, \
+                     loc*np.ones(fac_ids.size, dtype='int'), mult_counts[mult_idx[sel]]))
+
+        #multiplicities are set at the location of the edge at the lifted
+        #variable node, found from the factor end of the edge
+        edge_info = lifted_bpg.graph_edge_info
+        for lifted_var in mults:
+            var_chunk = lifted_var.get_msg_chunk()
+            for (fac_chunk, fac_ids, locs, counts) in mults[lifted_var]:
+                entries = edge_info.get_edge_entries((var_chunk, fac_chunk))
+                num_fac = fac_chunk.num_nodes
+                slot_pos = np.zeros((entries[:, 3].max()+1)*num_fac, dtype='int')
+                slot_pos[entries[:, 3]*num_fac + entries[:, 2]] = np.arange(entries.shape[0])
+                rows = slot_pos[locs*num_fac + fac_ids]
+                lifted_var.set_edge_multiplicities(entries[rows, 0], entries[rows, 1], counts)
+
+        for nodes in self.bpg.get_scheduled_nodes():
+            lifted_bpg.add_nodes_to_schedule(self.__lifted[nodes])
+        lifted_bpg.finalize()
+
+        return lifted_bpg
+
+    def do_message_passing(self, max_seconds=None, max_iters=None):
+        """Performs message-passing on the lifted BpGraph. See
+        BpGraph.do_message_passing.
+        """
+
+        return self.lifted_bpg.do_message_passing(max_seconds, max_iters)
+
+    def get_beliefs(self, var_nodes):
+        """Returns the beliefs of the variable nodes of a scheduled VarNodes
+        instance of the original factor graph, expanded from the lifted
+        BpGraph. See VarNodes.get_beliefs.
+        """
+
+        offset = self.__offsets[var_nodes]
+        lifted_ids = self.__lifted_ids[self.__colors[offset:offset+var_nodes.num_nodes]]
+        return self.__lifted[var_nodes].get_beliefs()[:, :, lifted_ids]
+
+    def get_colors(self, nodes):
+        """Returns the color of every node of a scheduled Nodes instance of
+        the original factor graph, as an ndarray of ints. Nodes of the same
+        color are merged in the lifted BpGraph.
+        """
+
+        offset = self.__offsets[nodes]
+        return self.__colors[offset:offset+nodes.num_nodes]
+
+    def get_num_nodes(self):
+        """Returns a tuple (number of nodes of the original factor graph,
+        number of nodes of the lifted BpGraph).
+        """
+
+        return (self.__num_total, self.__colors.max()+1)
+
+def _find_rows(keys, rows):
+    """Returns the index in keys (unique, sorted rows, as returned by
+    np.unique) of every row of rows. Every row must be present in keys.
+    """
+
+    (all_keys, inverse) = np.unique(np.vstack((keys, rows)), axis=0, return_inverse=True)
+    inverse = inverse.ravel()
+    pos = np.zeros(all_keys.shape[0], dtype='int')
+    pos[inverse[0:keys.shape[0]]] = np.arange(keys.shape[0])
+    return pos[inverse[keys.shape[0]:]]
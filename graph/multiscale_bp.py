@@ -0,0 +1,304 @@
+"""Module for the MultiscaleBp class. See documentation for MultiscaleBp
+class."""
+
+import time
+import numpy as np
+from nodesLib import VarNodes
+from bp_graph import BpGraph
+
+class MultiscaleBp(object):
+    """This class performs coarse-to-fine belief propagation on a grid
+    model: variable nodes laid out on an image, and pairwise factors (eg,
+    PottsNodes) between them.
+
+    A pyramid of coarser grids is built, every level merging 2x2 blocks of
+    variable nodes of the level below into one variable node. A coarse
+    variable node has the product of the unary potentials of its block. Two
+    coarse variable nodes are connected by one factor, with the parameters of
+    the factors of the level below, if any factor connects their blocks;
+    factors inside one block are dropped.
+
+    Message-passing runs on the coarsest level first. Every finer level then
+    starts from the messages of the level above: the messages on an edge
+    between two blocks are those on the edge between the coarse variable
+    nodes (messages on factors inside one block keep their initial values).
+    Information then travels across the image in a few iterations of the
+    coarse levels rather than one pixel per iteration of the finest level.
+
+    This pays off for max-product, and for sum-product only on strongly
+    coupled grids. On 48x48 grids with 16 states and damping 0.5, the
+    iterations per level (finest first) compared with flat message-passing
+    were (for max-product, with two noise seeds):
+
+        max-product, alpha 0.3: 127/92/73/45 vs 326, 111/117/74/72 vs 285
+        max-product, alpha 0.7: 291/351/55/36 vs 579, 269/130/176/37 vs 291
+        sum-product, alpha 0.1: 528/228/271/61 vs 1000 (not converged)
+        sum-product, alpha 0.3: 130/277/126/36 vs 138
+        sum-product, alpha 0.5: 30/35/34/29 vs 32
+
+    For sum-product with weaker coupling, the finest level then needs about
+    as many iterations as flat message-passing, and the coarse levels come
+    on top. On other grids it needed more: 1000 (the iteration cap) instead
+    of 816 with fixed damping and 905 instead of 311 with adaptive damping;
+    max-product went from 458 to 480 iterations on one of them.
+
+    Evidence set with VarNodes.set_evidence is not taken into account on the
+    coarse levels.
+
+    Public methods:
+        do_message_passing: performs message-passing from the coarsest to the
+            finest level.
+
+        get_levels: get the BpGraph of every level.
+
+        get_level_iters: get the number of iterations run on every level.
+    """
+
+    def __init__(self, bpg, var_nodes, grid_ids, bp_params=None, num_levels=None, \
+                 min_size=4):
+        """Initializer. Builds and finalizes the coarse levels. bpg is
+        finalized if it has not been finalized yet.
+
+        Args:
+            bpg (:obj: BpGraph): the factor graph of the finest level. Every
+                scheduled FactorNodes instance must only hold factors of two
+                variable nodes of var_nodes.
+
+            var_nodes (:obj: VarNodes): the variable nodes of the grid.
+
+            grid_ids (ndarray): HxW ndarray of the ids of the variable nodes
+                of var_nodes at every pixel.
+
+            bp_params (dict, optional): parameters of the BpGraph of the
+                coarse levels. See BpGraph. Defaults to the parameters of
+                bpg.
+
+            num_levels (int, optional): number of levels, including the
+                finest one. Defaults to halving the grid until either side
+                would be smaller than min_size.
+
+            min_size (int, optional): see num_levels. Defaults to 4.
+        """
+
+        if bp_params is None:
+            bp_params = dict(bpg.bp_params)
+
+        grid_ids = np.asarray(grid_ids, dtype='int')
+        assert grid_ids.ndim == 2, 'grid_ids must be an HxW ndarray'
+
+        if num_levels is None:
+            num_levels = 1
+            shape = grid_ids.shape
+            while min((shape[0]+1)//2, (shape[1]+1)//2) >= min_size:
+                shape = ((shape[0]+1)//2, (shape[1]+1)//2)
+                num_levels += 1
+
+        #one dict per level, finest first. keys: 'bpg', 'var_nodes',
+        #'grid_ids', 'factors' (list of (FactorNodes instance, edge type,
+        #Fx2 ndarray of the variable node ids at locations 0 and 1 of every
+        #factor)), for all levels but the coarsest, 'coarse' (list of
+        #ndarrays: for every factor, the coarse factor it maps to, or -1) and,
+        #for all levels but the finest, 'block' (the variable node of every
+        #variable node of the level below).
+        self.__levels = [{'bpg': bpg, 'var_nodes': var_nodes, 'grid_ids': grid_ids, \
+                          'factors': self.__get_factors(bpg, var_nodes)}]
+        for _ in range(num_levels-1):
+            self.__levels.append(self.__build_coarse(self.__levels[-1], dict(bp_params)))
+
+        for level in self.__levels:
+            if not level['bpg'].is_finalized:
+                level['bpg'].finalize()
+
+        self.__level_iters = []
+
+    @staticmethod
+    def __get_factors(bpg, var_nodes):
+        """Returns the factors of a level, as stored in the 'factors' key of
+        a level.
+        """
+
+        var_chunk = var_nodes.get_msg_chunk()
+        edge_info = bpg.graph_edge_info
+        factors = []
+        for fac_nodes in bpg.get_scheduled_nodes():
+            if fac_nodes is var_nodes:
+                continue
+            assert not isinstance(fac_nodes, VarNodes), \
+                   'Grid models can only have one VarNodes instance'
+
+            for edge_type in fac_nodes.message_chunks:
+                chunk_pair = (var_chunk, fac_nodes.message_chunks[edge_type])
+                if chunk_pair not in edge_info.get_chunk_pairs():
+                    continue
+
+                entries = edge_info.get_edge_entries(chunk_pair)
+                assert entries[:, 3].max() <= 1 and \
+                       entries.shape[0] == 2*fac_nodes.num_nodes, \
+                       'Factors of grid models must be pairwise'
+
+                fac_vars = -np.ones((fac_nodes.num_nodes, 2), dtype='int')
+                fac_vars[entries[:, 2], entries[:, 3]] = entries[:, 0]
+                factors.append((fac_nodes, edge_type, fac_vars))
+
+        return factors
+
+    def __build_coarse(self, level, bp_params):
+        """Builds the level above a level, and records in level the coarse
+        factor of every factor of level. The BpGraph is not finalized.
+        """
+
+        grid_ids = level['grid_ids']
+        fine_nodes = level['var_nodes']
+        coarse_shape = ((grid_ids.shape[0]+1)//2, (grid_ids.shape[1]+1)//2)
+
+        bpg = BpGraph(bp_params)
+        var_nodes = fine_nodes._new_empty(fine_nodes.name + '_coarse')
+        coarse_ids = np.reshape(var_nodes.create_nodes(coarse_shape[0]*coarse_shape[1]), \
+                                coarse_shape)
+
+        #coarse variable node of every fine variable node
+        (rows, cols) = np.mgrid[0:grid_ids.shape[0], 0:grid_ids.shape[1]]
+        block = -np.ones(fine_nodes.num_nodes, dtype='int')
+        block[grid_ids] = coarse_ids[rows//2, cols//2]
+
+        (node_ids, log_vals) = fine_nodes.get_unaries()
+        if node_ids.size > 0:
+            coarse_log_vals = np.zeros((var_nodes.num_nodes, log_vals.shape[1]))
+            np.add.at(coarse_log_vals, block[node_ids], log_vals)
+            has_unary = np.unique(block[node_ids])
+            var_nodes._add_log_unaries(has_unary, coarse_log_vals[has_unary, :])
+
+        level['coarse'] = []
+        factors = []
+        for (fac_nodes, edge_type, fac_vars) in level['factors']:
+            coarse_vars = block[fac_vars]
+            is_across = coarse_vars[:, 0] != coarse_vars[:, 1]
+
+            #one coarse factor per pair of blocks, with the orientation of the
+            #first factor between them
+            pairs = np.sort(coarse_vars, axis=1)
+            pair_keys = pairs[:, 0]*var_nodes.num_nodes + pairs[:, 1]
+            (_, first, inverse) = np.unique(pair_keys[is_across], return_index=True, \
+                                            return_inverse=True)
+
+            coarse_fac = -np.ones(fac_nodes.num_nodes, dtype='int')
+            coarse_fac[is_across] = inverse
+            level['coarse'].append(coarse_fac)
+
+            coarse_nodes = fac_nodes._new_empty(fac_nodes.name + '_coarse')
+            coarse_vars = coarse_vars[is_across][first]
+            fac_ids = np.asarray(coarse_nodes.create_nodes(first.size), dtype='int')
+            for loc in range(2):
+                bpg.add_edges(var_nodes, coarse_vars[:, loc], coarse_nodes, fac_ids, edge_type)
+            factors.append((coarse_nodes, edge_type, coarse_vars))
+
+            bpg.add_nodes_to_schedule(coarse_nodes)
+        bpg.add_nodes_to_schedule(var_nodes)
+
+        return {'bpg': bpg, 'var_nodes': var_nodes, 'grid_ids': coarse_ids, \
+                'factors': factors, 'block': block}
+
+    def __init_from_coarse(self, level, coarse_level):
+        """Sets the messages on the edges of a level between blocks to the
+        messages on the edges of the level above.
+        """
+
+        fine_chunk = level['var_nodes'].get_msg_chunk()
+        coarse_chunk = coarse_level['var_nodes'].get_msg_chunk()
+        block = coarse_level['block']
+        for chunk in (fine_chunk, coarse_chunk):
+            chunk.prepare_msgs_for_computation()
+
+        fine_info = level['bpg'].graph_edge_info
+        coarse_info = coarse_level['bpg'].graph_edge_info
+        for (idx, (fac_nodes, edge_type, _)) in enumerate(level['factors']):
+            coarse_nodes = coarse_level['factors'][idx][0]
+            coarse_vars = coarse_level['factors'][idx][2]
+            fac_chunk = fac_nodes.message_chunks[edge_type]
+            coarse_fac_chunk = coarse_nodes.message_chunks[edge_type]
+            for chunk in (fac_chunk, coarse_fac_chunk):
+                chunk.prepare_msgs_for_computation()
+
+            #location of every coarse edge at its variable node
+            coarse_entries = coarse_info.get_edge_entries((coarse_chunk, coarse_fac_chunk))
+            coarse_var_loc = np.zeros(coarse_vars.shape, dtype='int')
+            coarse_var_loc[coarse_entries[:, 2], coarse_entries[:, 3]] = coarse_entries[:, 1]
+
+            entries = fine_info.get_edge_entries((fine_chunk, fac_chunk))
+            coarse_fac = level['coarse'][idx][entries[:, 2]]
+            entries = entries[coarse_fac >= 0, :]
+            coarse_fac = coarse_fac[coarse_fac >= 0]
+
+            #location at the coarse factor of the block of the variable node
+            coarse_loc = (coarse_vars[coarse_fac, 1] == block[entries[:, 0]]).astype('int')
+
+            fine_chunk.msgs_in[entries[:, 1], :, entries[:, 0]] = \
+                coarse_chunk.msgs_in[coarse_var_loc[coarse_fac, coarse_loc], :, \
+                                     block[entries[:, 0]]]
+            fac_chunk.msgs_in[entries[:, 3], :, entries[:, 2]] = \
+                coarse_fac_chunk.msgs_in[coarse_loc, :, coarse_fac]
+
+    def do_message_passing(self, max_seconds=None, max_iters=None):
+        """Performs message-passing on every level, from the coarsest to the
+        finest, each starting from the messages of the level above. Every
+        call starts over from the coarsest level (from its last messages).
+        See BpGraph.do_message_passing.
+
+        Args:
+            max_seconds (double, optional): wall-clock budget for the whole
+                call, shared by all levels. Defaults to no budget.
+
+            max_iters (int, optional): maximum number of iterations for the
+                whole call, summed over all levels. Defaults to no budget.
+
+        Returns:
+            The last snapshot of the last level run. See
+            BpGraph.iter_message_passing. Its status is 'max_seconds' or
+            'max_iters' if the budget ran out before the finest level
+            finished.
+        """
+
+        assert max_seconds is None or max_seconds >= 0, 'max_seconds must be >= 0'
+        assert max_iters is None or max_iters > 0, 'max_iters must be > 0'
+
+        time0 = time.time()
+        self.__level_iters = [0]*len(self.__levels)
+        snapshot = None
+        for idx in reversed(range(len(self.__levels))):
+            seconds_left = None
+            if max_seconds is not None:
+                seconds_left = max(max_seconds - (time.time()-time0), 0)
+            iters_left = None
+            if max_iters is not None:
+                iters_left = max_iters - sum(self.__level_iters)
+
+            #the budget ran out on a coarser level
+            if snapshot is not None and (iters_left == 0 or \
+                                         (seconds_left is not None and seconds_left <= 0)):
+                snapshot['status'] = 'max_iters' if iters_left == 0 else 'max_seconds'
+                break
+
+            level = self.__levels[idx]
+            if idx < len(self.__levels)-1:
+                self.__init_from_coarse(level, self.__levels[idx+1])
+            level['bpg'].reset_run()
+
+            snapshot = level['bpg'].do_message_passing(seconds_left, iters_left)
+            self.__level_iters[idx] = snapshot['iter']
+            if snapshot['status'] in ('max_seconds', 'max_iters'):
+                break
+
+        return snapshot
+
+    def get_levels(self):
+        """Returns the BpGraph of every level, finest first."""
+
+        return [level['bpg'] for level in self.__levels]
+
+    def get_level_iters(self):
+        """Returns the number of iterations run on every level by the last
+        call to do_message_passing, finest first (0 for levels not reached
+        within the budget).
+        """
+
+        return list(self.__level_iters)
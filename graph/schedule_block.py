@@ -0,0 +1,91 @@
+"""Module for the ScheduleBlock class. See documentation for ScheduleBlock
+class."""
+
+from nodesLib import VarNodes
+
+class ScheduleBlock(object):
+    """This class describes a block of a hierarchical message-passing
+    schedule. A block is a list of steps, each a Nodes instance (whose nodes
+    are all updated) or a nested ScheduleBlock. Every pass over a block runs
+    its steps in order, and a block is passed over up to 'repeat' times every
+    time it is reached. Eg, for a model mixing a fast-mixing grid with
+    expensive categorical factors,
+
+        ScheduleBlock([ScheduleBlock([grid_vars, potts], repeat=5, tol=1e-3),
+                       cat_nodes])
+
+    sweeps the grid up to 5 times for every update of the categorical factors.
+    See BpGraph.set_schedule.
+
+    Public methods:
+        get_nodes: get the Nodes instances in the block.
+
+        get_blocks: get the block and all blocks nested in it.
+    """
+
+    def __init__(self, steps, repeat=1, tol=None, damp=None, name=None):
+        """Initializer.
+
+        Args:
+            steps (list): steps of the block, in order. Every step is a Nodes
+                instance or a ScheduleBlock.
+
+            repeat (int, optional): maximum number of passes over the block
+                every time it is reached. Defaults to 1.
+
+            tol (double, optional): if not None, passes over the block stop
+                early once the beliefs of the VarNodes instances in the block
+                change by at most tol from one pass to the next. Defaults to
+                None.
+
+            damp (double, optional): if not None, fixed damping of the messages
+                computed in the block, instead of the damping given by
+                bp_params. Applies to nested blocks that do not set their own.
+                Defaults to None.
+
+            name (:obj:`str', optional): name of the block, for
+                BpGraph.get_schedule_stats. Defaults to a name given by
+                BpGraph.set_schedule.
+        """
+
+        assert len(steps) > 0, 'A schedule block must have at least one step'
+        assert repeat >= 1, 'repeat must be >= 1'
+        assert damp is None or 0 <= damp < 1, 'damp must be in [0, 1)'
+
+        self.steps = list(steps)
+        self.repeat = repeat
+        self.tol = tol
+        self.damp = damp
+        self.name = name
+
+        assert tol is None or \
+               any([isinstance(nodes, VarNodes) for nodes in self.get_nodes()]), \
+               'A schedule block with a tol must hold VarNodes'
+
+    def get_nodes(self):
+        """Get the Nodes instances in the block and the blocks nested in it,
+        in order of their first step, without duplicates.
+        """
+
+        nodes_list = []
+        for step in self.steps:
+            if isinstance(step, ScheduleBlock):
+                inner = step.get_nodes()
+            else:
+                inner = [step]
+
+            for nodes in inner:
+                if nodes not in nodes_list:
+                    nodes_list.append(nodes)
+
+        return nodes_list
+
+    def get_blocks(self):
+        """Get the block and all blocks nested in it, in depth-first order."""
+
+        blocks = [self]
+        for step in self.steps:
+            if isinstance(step, ScheduleBlock):
+                blocks += step.get_blocks()
+
+        return blocks
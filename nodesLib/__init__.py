@@ -1,10 +1,16 @@
+from sparse_msgs import SparseMsgs
 from message_chunk import MessageChunk
+from buffer_pool import BufferPool
+from run_state import RunState
+from run_state import StateAttr
 from factor_nodes import FactorNodes
 from var_nodes import VarNodes
 
 from cat_nodes import CatNodes
 from potts_nodes import PottsNodes
+from diff_nodes import DiffNodes
 from noisy_or_nodes import NoisyOrNodes
+from cardinality_nodes import CardinalityNodes
 
-__all__ = ['cat_nodes', 'factor_nodes', 'message_chunk', 'nodes', \
-           'noisy_or_nodes', 'potts_nodes', 'var_nodes']
\ No newline at end of file
+__all__ = ['buffer_pool', 'cardinality_nodes', 'cat_nodes', 'diff_nodes', 'factor_nodes', \
+           'message_chunk', 'nodes', 'noisy_or_nodes', 'potts_nodes', 'run_state', 'sparse_msgs', 'var_nodes']
\ No newline at end of file
@@ -0,0 +1,75 @@
+"""Module for the BufferPool class. See documentation for BufferPool class."""
+
+import numpy as np
+
+class BufferPool(object):
+    """This class keeps named, persistent buffers of doubles so that
+    message computations can write into preallocated memory instead of
+    allocating new arrays on every call. A buffer only grows (geometrically),
+    so requesting buffers of varying sizes does not cause repeated
+    allocation.
+
+    Note: a buffer is reused by the next request with the same name. Its
+    contents must be consumed before then.
+
+    Public methods:
+        get: returns a C-contiguous buffer of a given shape.
+
+        get_msgs: returns a buffer laid out for message distribution.
+
+        nbytes: returns the number of bytes held by the pool.
+    """
+
+    def __init__(self):
+        """Initializer."""
+
+        self.__buffers = {}
+
+    def get(self, name, shape):
+        """Returns a C-contiguous buffer of a given shape. The contents of the
+        buffer are undefined.
+
+        Args:
+            name (str): name of the buffer.
+
+            shape (tuple): shape of the buffer.
+
+        Returns:
+            The buffer as an ndarray of doubles.
+        """
+
+        size = int(np.prod(shape))
+        buff = self.__buffers.get(name)
+        if buff is None or buff.size < size:
+            if buff is not None:
+                size_alloc = max(size, 2*buff.size)
+            else:
+                size_alloc = size
+            buff = np.empty(size_alloc)
+            self.__buffers[name] = buff
+
+        return buff[0:size].reshape(shape)
+
+    def get_msgs(self, name, shape):
+        """Returns a buffer of size [max_degree, num_states, num_nodes] for
+        messages. The buffer is a view of C-contiguous memory of size
+        [max_degree, num_nodes, num_states], so it can be prepared for
+        distribution (see MessageChunk.do_prepare_msgs_for_distribution)
+        without copying. The contents of the buffer are undefined.
+
+        Args:
+            name (str): name of the buffer.
+
+            shape (tuple): shape of the buffer.
+
+        Returns:
+            The buffer as an ndarray of doubles.
+        """
+
+        buff = self.get(name, (shape[0], shape[2], shape[1]))
+        return buff.swapaxes(1, 2)
+
+    def nbytes(self):
+        """Returns the number of bytes held by the pool."""
+
+        return sum([buff.nbytes for buff in self.__buffers.values()])
@@ -0,0 +1,154 @@
+"""Module for the CardinalityNodes class. Models cardinality factor nodes. A
+cardinality factor has many binary-valued "input" variable nodes, and only
+depends on how many of them take value 1. Let Y be the set of input variable
+nodes, and let c(Y) indicate how many input variable nodes take value 1. A
+cardinality factor is defined by
+
+F(Y) = \phi(c(Y))
+
+for a potential \phi on counts. Eg, "exactly k inputs are on" is \phi(c) = 1
+if c==k and 0 otherwise, and "at most k inputs are on" is \phi(c) = 1 if c<=k
+and 0 otherwise.
+"""
+
+import numpy as np
+from nodesLib.factor_nodes import FactorNodes
+
+class CardinalityNodes(FactorNodes):
+    """This class represents a collection of cardinality factor nodes.
+    Message-passing is performed using loopy belief propagation, either in the
+    sum-product or max-product setting, as specified by the user. This class is
+    a concrete implemention of the FactorNodes class. Cardinality factors have
+    one kind of edge: "input".
+
+    Messages are computed exactly by dynamic programming over the number of
+    inputs on, in O(n*K) per factor for n inputs and a potential over K
+    counts, rather than O(2^n).
+
+    Public methods:
+        finalize: Prepares contained variable nodes for message-passing.
+    """
+
+    EDGE_TYPES = frozenset({'input'})
+    BP_ALGO_TYPES = frozenset({'max', 'sum'})
+
+    def __init__(self, name='', nodes_params=None):
+        """Initializer.
+
+        Args:
+            name (:obj:`str', optional): name of this CardinalityNodes object.
+                Defaults to the emptry string.
+
+            nodes_params (dict): parameters for this CardinalityNodes object.
+                Mandatory keys are:
+                    'bp_algo': takes value either 'max' or 'sum' corresponding
+                        to the type of loopy belief propagation that is to be
+                        used.
+
+                    'potential': ndarray of K non-negative values.
+                        potential[c] is \phi(c) (see module definition) for
+                        c < K; \phi(c) is 0 for c >= K. Shared by all factors
+                        in this object instance.
+        """
+
+        assert nodes_params is not None, \
+               'Must specify a potential for making CardinalityNodes object.'
+
+        assert 'potential' in nodes_params.keys(), \
+                          'No "potential" parameter found for CardinalityNodes object.'
+
+        assert 'bp_algo' in nodes_params.keys(), \
+                          'No "bp_algo" parameters found for CardinalityNodes object.'
+
+        assert nodes_params['bp_algo'] in self.BP_ALGO_TYPES, \
+                   'Must specify valid bp_algo type'
+
+        potential = np.asarray(nodes_params['potential'], dtype=float)
+        assert potential.ndim == 1 and potential.size > 0, \
+               'potential must be a non-empty 1D array'
+        assert np.all(potential >= 0) and np.any(potential > 0), \
+               'potential must be >= 0, and > 0 for some count'
+
+        nodes_params = dict(nodes_params)
+        nodes_params['potential'] = potential
+
+        if nodes_params['bp_algo'] == 'max':
+            self.max_or_sum = np.max
+            self.max_or_add = np.maximum
+        else:
+            self.max_or_sum = np.sum
+            self.max_or_add = np.add
+
+        super(CardinalityNodes, self).__init__(name, nodes_params)
+
+        #setup padded message values so non-existent input variable nodes have
+        # no effect: they are never on.
+        self.message_chunks['input'].pad_msg_val = np.asarray([1.0, 0.0])
+
+    def _do_compute_messages(self):
+        msgs = self.get_msgs_on_edge('input')
+        (max_degree, _, num_nodes) = msgs.shape
+
+        #no more than max_degree inputs can be on. counts beyond the potential
+        #have value 0
+        potential = np.append(self.nodes_params['potential'], 0.0)[0:max_degree+1]
+        num_counts = potential.size
+
+        #backward pass. after[j, c] is the potential summed (maxed) over the
+        #inputs from j on, weighted by their messages, when c inputs before j
+        #are on
+        after = self._get_scratch_buffer('after', (max_degree+1, num_counts, num_nodes))
+        after[max_degree, :, :] = potential[:, np.newaxis]
+        for j in reversed(range(max_degree)):
+            on_term = after[j+1, 1:, :]*msgs[j, 1:2, :]
+            np.multiply(after[j+1, :, :], msgs[j, 0:1, :], out=after[j, :, :])
+            self.max_or_add(after[j, 0:-1, :], on_term, out=after[j, 0:-1, :])
+            self.__rescale(after[j, :, :])
+
+        #forward pass. before[c] is the weight of c inputs before j being on
+        before = self._get_scratch_buffer('before', (num_counts, num_nodes))
+        before.fill(0.0)
+        before[0, :] = 1.0
+
+        res = self._get_out_buffer('input', msgs.shape)
+        for j in range(max_degree):
+            self.max_or_sum(before*after[j+1, :, :], axis=0, out=res[j, 0, :])
+            self.max_or_sum(before[0:-1, :]*after[j+1, 1:, :], axis=0, out=res[j, 1, :])
+
+            on_term = before[0:-1, :]*msgs[j, 1:2, :]
+            before *= msgs[j, 0:1, :]
+            self.max_or_add(before[1:, :], on_term, out=before[1:, :])
+            self.__rescale(before)
+
+        res /= np.sum(res, axis=1, keepdims=True)
+        return {'input': res}
+
+    @staticmethod
+    def __rescale(weights):
+        """Rescales the weights over counts of every factor in place, so that
+        their maximum is 1. Messages do not depend on the scale of either
+        pass, which would otherwise underflow with many inputs.
+        """
+
+        scale = np.max(weights, axis=0)
+        scale[scale == 0] = 1.0
+        weights /= scale
+
+    def _estimate_flops(self):
+        """Returns a rough estimate of the floating-point operations of one
+        update of all factors: the forward and backward passes take O(n)
+        operations for every count and every input, for n inputs.
+        """
+
+        max_degree = self.message_chunks['input'].max_degree
+        return 12*max_degree*(max_degree+1)*self.num_nodes
+
+    def finalize(self):
+        """Prepares contained factor nodes for message passing and performs
+        error-checking. Must be called once before message passing can be done
+        on this object.
+        """
+
+        super(CardinalityNodes, self).finalize()
+        assert self.message_chunks['input'].num_states == 2, \
+               'Inputs of cardinality factors must be binary'
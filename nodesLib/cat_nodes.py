@@ -16,6 +16,7 @@ class CatNodes(FactorNodes):
     """
 
     EDGE_TYPES = frozenset({'input', 'output'})
+    CHILD_EDGE_TYPES = frozenset({'output'})
     BP_ALGO_TYPES = frozenset({'max', 'sum'})
 
     #nodes_params[probs]: a list of lists of success parameters. The list
@@ -68,17 +69,32 @@ class CatNodes(FactorNodes):
 
         super(CatNodes, self).__init__(name, nodes_params)
 
+    def _get_init_params(self):
+        init_params = dict(self.nodes_params)
+        init_params['probs'] = self.nodes_params['probs'][:, :, 0].transpose()
+        return init_params
+
     def _do_compute_messages(self):
         probs = self.nodes_params['probs']
         res = {}
 
         #compute message to input
         msg_from_outputs = self.get_msgs_on_edge('output')
+        msg_from_input = self.get_msgs_on_edge('input')
+
+        output_ratio = self._get_scratch_buffer('output_ratio', \
+                                                (msg_from_outputs.shape[0], 1, \
+                                                 msg_from_outputs.shape[2]))
+        np.divide(msg_from_outputs[:, 1:2, :], msg_from_outputs[:, 0:1, :], \
+                  out=output_ratio)
 
-        output_ratio = msg_from_outputs[:, [1], :] / msg_from_outputs[:, [0], :]
+        weighted = self._get_scratch_buffer('weighted', \
+                                            (probs.shape[0], probs.shape[1], \
+                                             msg_from_outputs.shape[2]))
+        np.multiply(probs, output_ratio, out=weighted)
 
-        weighted_out = probs*output_ratio
-        msg = self.max_or_sum(weighted_out, axis=0, keepdims=True)
+        msg = self._get_out_buffer('input', msg_from_input.shape)
+        self.max_or_sum(weighted, axis=0, keepdims=True, out=msg)
 
         msg /= np.sum(msg, axis=1, keepdims=True)
 
@@ -86,16 +102,14 @@ class CatNodes(FactorNodes):
         #compute message to input
 
         #compute message to outputs
-        msg_from_input = self.get_msgs_on_edge('input')
-
-        weighted_in = probs*msg_from_input
-        msg = np.zeros(msg_from_outputs.shape)
+        np.multiply(probs, msg_from_input, out=weighted)
+        msg = self._get_out_buffer('output', msg_from_outputs.shape)
 
-        msg[:, [1], :] = self.max_or_sum(weighted_in, axis=1, keepdims=True)
+        self.max_or_sum(weighted, axis=1, keepdims=True, out=msg[:, 1:2, :])
 
-
-        msg[:, [0], :] = output_ratio*msg[:, [1], :]
-        msg[:, [0], :] = self.max_or_sum(msg[:, [0], :], axis=0, keepdims=True) - msg[:, [0], :]
+        np.multiply(output_ratio, msg[:, 1:2, :], out=msg[:, 0:1, :])
+        np.subtract(self.max_or_sum(msg[:, 0:1, :], axis=0, keepdims=True), \
+                    msg[:, 0:1, :], out=msg[:, 0:1, :])
 
         msg /= np.sum(msg, axis=1, keepdims=True)
 
@@ -104,6 +118,15 @@ class CatNodes(FactorNodes):
 
         return res
 
+    def _estimate_flops(self):
+        """Returns a rough estimate of the floating-point operations of one
+        update of all factors: two products with, and reductions of, the
+        probability table per factor, and the normalization of the messages.
+        """
+
+        return 4*self.nodes_params['probs'].size*self.num_nodes + \
+               super(CatNodes, self)._estimate_flops()
+
     def finalize(self):
         """Prepares contained factor nodes for message passing and performs
         error-checking. Must be called once before message passing can be done
@@ -0,0 +1,192 @@
+"""Module for the DiffNodes class. Models pairwise factor nodes whose value
+only depends on the difference of the states of their two variables, X and Y,
+that have the same discrete number of states K:
+
+F(X,Y) = f(Y-X),   Y-X in {-(K-1), ..., K-1}.
+
+Such factors model smoothness over ordered states, eg gray levels (Gaussian or
+robust penalties on the difference of neighbouring pixels).
+"""
+
+import numpy as np
+from nodesLib.factor_nodes import FactorNodes
+
+class DiffNodes(FactorNodes):
+    """This class represents a collection of difference-based pairwise factor
+    nodes. Message-passing is performed using loopy belief propagation, either
+    in the sum-product or max-product setting, as specified by the user. This
+    class is a concrete implemention of the FactorNodes class. Difference
+    factors have one kind of edge: "default". The first variable node added
+    to a factor is X, the second Y.
+
+    A sum-product message is a convolution of the incoming message with f.
+    With many states, it is computed for all factors at once with FFTs, in
+    O(K log K) rather than O(K^2) per factor.
+
+    Public methods:
+        finalize: Prepares contained variable nodes for message-passing.
+    """
+
+    EDGE_TYPES = frozenset({'default'})
+    BP_ALGO_TYPES = frozenset({'max', 'sum'})
+
+    #smallest number of states for which sum-product messages are computed
+    #with FFTs. below, the direct computation (a matrix product) is faster
+    FFT_MIN_STATES = 1024
+
+    def __init__(self, name='', nodes_params=None):
+        """Initializer.
+
+        Args:
+            name (:obj:`str', optional): name of this DiffNodes object.
+                Defaults to the emptry string.
+
+            nodes_params (dict): parameters for this DiffNodes object.
+                Mandatory keys are:
+                    'bp_algo': takes value either 'max' or 'sum' corresponding
+                        to the type of loopy belief propagation that is to be
+                        used.
+                    'potential': ndarray of 2K-1 positive values. potential[d]
+                        is f(d-(K-1)), the value of the factor when Y-X is
+                        d-(K-1). Shared by all factors in this object
+                        instance.
+                Optional keys are:
+                    'fft_min_states': smallest number of states for which
+                        sum-product messages are computed with FFTs. Defaults
+                        to FFT_MIN_STATES.
+        """
+
+        assert nodes_params is not None, 'nodes_params cannot be None for DiffNodes'
+        assert 'potential' in nodes_params, 'nodes_params must contain key "potential"'
+
+        assert 'bp_algo' in nodes_params.keys(), \
+                          'No "bp_algo" parameters found for DiffNodes object.'
+
+        assert nodes_params['bp_algo'] in self.BP_ALGO_TYPES, \
+                   'Must specify valid bp_algo type.'
+
+        potential = np.asarray(nodes_params['potential'], dtype=float)
+        assert potential.ndim == 1 and potential.size % 2 == 1, \
+               'potential must hold 2K-1 values'
+        assert np.all(potential > 0), 'potential must be > 0.'
+
+        nodes_params = dict(nodes_params)
+        nodes_params['potential'] = potential
+        if 'fft_min_states' not in nodes_params:
+            nodes_params['fft_min_states'] = self.FFT_MIN_STATES
+
+        super(DiffNodes, self).__init__(name, nodes_params)
+
+        #FFTs of the potential, to compute messages to X and to Y. set at
+        #finalization
+        self.__potential_fft = None
+
+    def __get_table(self):
+        """Returns the factor as a KxK ndarray, indexed by [X, Y]."""
+
+        num_states = self.message_chunks['default'].num_states
+        diff = np.arange(num_states)[np.newaxis, :] - np.arange(num_states)[:, np.newaxis]
+        return self.nodes_params['potential'][diff + num_states-1]
+
+    def _do_compute_messages(self):
+        msgs = self.get_msgs_on_edge('default')
+        res = self._get_out_buffer('default', msgs.shape)
+
+        if self.nodes_params['bp_algo'] == 'sum':
+            if self.__potential_fft is not None:
+                self.__convolve(msgs, res)
+            else:
+                table = self.__get_table()
+                res[0, :, :] = np.dot(table, msgs[1, :, :])
+                res[1, :, :] = np.dot(table.T, msgs[0, :, :])
+        else:
+            table = self.__get_table()
+            prod = self._get_scratch_buffer('prod', msgs.shape[1:])
+            for state in range(msgs.shape[1]):
+                np.multiply(table[state, :, np.newaxis], msgs[1, :, :], out=prod)
+                np.max(prod, axis=0, out=res[0, state, :])
+                np.multiply(table[:, state, np.newaxis], msgs[0, :, :], out=prod)
+                np.max(prod, axis=0, out=res[1, state, :])
+
+        res /= res.sum(axis=1, keepdims=True)
+        return {'default': res}
+
+    def __convolve(self, msgs, res):
+        """Computes sum-product messages with FFTs. The message to X at state
+        x is sum_y f(y-x) m_Y(y), the entry x+K-1 of the convolution of m_Y
+        with f reversed; the message to Y at state y is sum_x f(y-x) m_X(x),
+        the entry y+K-1 of the convolution of m_X with f.
+        """
+
+        num_states = msgs.shape[1]
+        fft_len = 2*(self.__potential_fft.shape[1]-1)
+
+        #FFTs are faster along the last axis
+        msgs_fft = np.fft.rfft(np.transpose(msgs, (0, 2, 1)), n=fft_len, axis=2)
+        msgs_fft = msgs_fft[::-1, :, :]
+        msgs_fft *= self.__potential_fft[:, np.newaxis, :]
+
+        conv = np.fft.irfft(msgs_fft, n=fft_len, axis=2)
+        res[...] = np.transpose(conv[:, :, num_states-1:2*num_states-1], (0, 2, 1))
+
+        #round-off can leave tiny negative values
+        np.maximum(res, 0.0, out=res)
+
+    def _estimate_flops(self):
+        """Returns a rough estimate of the floating-point operations of one
+        update of all factors: a product with the KxK factor per message, or
+        with FFTs, three transforms of fft_len values per message.
+        """
+
+        chunk = self.message_chunks['default']
+        num_states = max(2, chunk.num_states)
+        num_msgs = chunk.max_degree*chunk.num_nodes
+
+        if self.nodes_params['bp_algo'] == 'sum' and \
+           num_states >= self.nodes_params['fft_min_states']:
+            fft_len = 1
+            while fft_len < 2*num_states-1:
+                fft_len *= 2
+            return int(8*fft_len*np.log2(fft_len))*num_msgs
+        return 2*num_states*num_states*num_msgs
+
+    def _absorb_evidence(self, pinned):
+        """Absorbs every factor with an observed variable node: the factor
+        becomes a unary potential on its other variable node, f(Y-x) when X
+        is observed at x, and f(y-X) when Y is observed at y.
+        """
+
+        (factor_ids, locs, states) = pinned['default']
+        (absorbed, first) = np.unique(factor_ids, return_index=True)
+
+        table = self.__get_table()
+        unary_vals = np.where((locs[first] == 0)[:, np.newaxis], \
+                              table[states[first], :], table[:, states[first]].T)
+        return (absorbed, [('default', absorbed, unary_vals)])
+
+    def finalize(self):
+        """Prepares contained factor nodes for message passing and performs
+        error-checking. Must be called once before message passing can be done
+        on this object.
+        """
+
+        super(DiffNodes, self).finalize()
+        assert self.nodes_params['bp_algo'] in self.BP_ALGO_TYPES, \
+               'Internal error: Invalid BP algorithm specified?'
+
+        chunk = self.message_chunks['default']
+        assert chunk.msgs_in.shape[0] == 2, str(chunk.msgs_in.shape)
+
+        potential = self.nodes_params['potential']
+        assert potential.size == 2*chunk.num_states-1, \
+               'potential must hold 2K-1 values for K states: %d vs %d' \
+               %(potential.size, 2*chunk.num_states-1)
+
+        if self.nodes_params['bp_algo'] == 'sum' and \
+           chunk.num_states >= self.nodes_params['fft_min_states']:
+            #the entries of the convolutions kept must not wrap around
+            fft_len = 1
+            while fft_len < 2*chunk.num_states-1:
+                fft_len *= 2
+            self.__potential_fft = np.fft.rfft(np.stack([potential[::-1], potential]), \
+                                               n=fft_len, axis=1)
@@ -1,5 +1,6 @@
 """Module for the FactorNodes class. See documentation for FactorNodes class."""
 
+import numpy as np
 from nodesLib import MessageChunk
 from nodesLib.nodes import Nodes
 
@@ -14,6 +15,12 @@ class FactorNodes(Nodes):
     probabilistic-OR distribution, and another might represent the single 
     output of a probabilistic-OR.
 
+    Factors that are conditional distributions list the edge types of their
+    conditioned (child) variables in CHILD_EDGE_TYPES. Such a factor sums to
+    one over its child variables, so it sends uniform messages to its other
+    variables when its children carry no evidence. This is used to prune
+    barren parts of the graph.
+
     This class is an abstract subclass of the Nodes class. The following
     functions must be implemented by a concrete subclass:
 
@@ -26,6 +33,7 @@ class FactorNodes(Nodes):
 
     """
     EDGE_TYPES = frozenset({'default'})
+    CHILD_EDGE_TYPES = frozenset()
 
     def __init__(self, name='', nodes_params=None):
         """Initializer.
@@ -53,9 +61,34 @@ class FactorNodes(Nodes):
             edge_type (self.EDGE_TYPES): type of edge to retrieve
 
         Returns:
-            The messages associated with the given edge_type
+            The messages associated with the given edge_type. While messages
+            are computed for a subset of the factors, only the messages of
+            that subset are returned.
         """
 
         assert edge_type in self.EDGE_TYPES, 'Invalid edge type'
-        return self.message_chunks[edge_type].msgs_in
+        return self._get_msgs_in(edge_type)
+
+    def _absorb_evidence(self, pinned):
+        """Specializes factors to observed variable nodes (see
+        BpGraph.finalize). Edges to observed variable nodes are removed; by
+        default, factors then keep receiving a fixed message of the observed
+        state on those edges. A subclass may instead absorb a factor entirely,
+        if, given the observed states, it factorizes into unary potentials on
+        its remaining variable nodes.
+
+        Args:
+            pinned (dict): maps edge types to tuples (factor ids, locations,
+                observed states) of the edges to observed variable nodes.
+
+        Returns:
+            A tuple (absorbed, unaries). absorbed is an ndarray of the ids of
+            the factor nodes absorbed entirely; all their edges are removed.
+            unaries is a list of tuples (edge type, factor ids, unary
+            potentials) giving the unary potential, of size
+            [#factor ids, num_states], to attach to the unobserved variable
+            nodes on every edge of that type of each absorbed factor.
+        """
+
+        return (np.zeros(0, dtype='int'), [])
 
@@ -25,6 +25,7 @@ class LeakyOrNodes(FactorNodes):
     """
 
     EDGE_TYPES = frozenset({'input', 'output'})
+    CHILD_EDGE_TYPES = frozenset({'output'})
 
     def __init__(self, name='', nodes_params=None):
         """Initializer.
@@ -71,26 +72,30 @@ class LeakyOrNodes(FactorNodes):
         msg_from_output = self.get_msgs_on_edge('output')
 
         #compute message to output
-        prod_msg_0 = np.prod(msg_from_input[:, [0], :], axis=0, keepdims=True)
+        prod_msg_0 = self._get_scratch_buffer('prod_msg_0', \
+                                              (1, 1, msg_from_input.shape[2]))
+        np.prod(msg_from_input[:, 0:1, :], axis=0, keepdims=True, out=prod_msg_0)
 
-        msg = np.zeros(msg_from_output.shape)
-        msg[:, [0], :] = (1-leak_prob)*prod_msg_0
-        msg[:, [1], :] = 1-msg[:, [0], :]
+        msg = self._get_out_buffer('output', msg_from_output.shape)
+        np.multiply(prod_msg_0, 1-leak_prob, out=msg[:, 0:1, :])
+        np.subtract(1, msg[:, 0:1, :], out=msg[:, 1:2, :])
 
         res['output'] = msg
         #compute message to output
 
         #compute message to input
-        msg = np.zeros(msg_from_input.shape)
-        msg[:, [1], :] = msg_from_output[:, [1], :]
+        msg = self._get_out_buffer('input', msg_from_input.shape)
+        msg[:, 1:2, :] = msg_from_output[:, 1:2, :]
 
-        r_j = prod_msg_0 / msg_from_input[:, [0], :]
+        r_j = np.divide(prod_msg_0, msg_from_input[:, 0:1, :], out=msg[:, 0:1, :])
 
-        diff = (msg_from_output[:, [0], :] - msg_from_output[:, [1], :])
-        msg[:, [0], :] = msg_from_output[:, [1], :] + (1-leak_prob)*r_j*diff
+        diff = self._get_scratch_buffer('diff', prod_msg_0.shape)
+        np.subtract(msg_from_output[:, 0:1, :], msg_from_output[:, 1:2, :], out=diff)
+        diff *= (1-leak_prob)
+        r_j *= diff
+        r_j += msg_from_output[:, 1:2, :]
 
-
-        msg = msg / np.sum(msg, axis=1, keepdims=True)
+        msg /= np.sum(msg, axis=1, keepdims=True)
 
         res['input'] = msg
 
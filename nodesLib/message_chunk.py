@@ -1,7 +1,14 @@
 """Module for the MessageChunk class."""
 
+import copy
 import numpy as np
 from enum import Enum
+from nodesLib.run_state import StateAttr
+from nodesLib.sparse_msgs import SparseMsgs
+
+#see MessageChunk.MSGS_INIT_ENUM. defined at module level, under its own name,
+#so that its values can be pickled (see DistributedBp)
+_MSGS_INIT_ENUM = Enum('_MSGS_INIT_ENUM', 'random uniform')
 
 class MessageChunk(object):
     """This class represents a group of messages in the factor graph and
@@ -18,6 +25,8 @@ class MessageChunk(object):
 
         set_num_states: set the number of states for the message entities.
 
+        set_sparse: store messages as sparse (top-k) messages.
+
         clamp_messages: clamps a given message to a range of values, before
             normalization
 
@@ -30,7 +39,7 @@ class MessageChunk(object):
     """
 
     #Strategies to initialize messages. Either randomly or uniformly.
-    MSGS_INIT_ENUM = Enum('msgs_init_enum', 'random uniform')
+    MSGS_INIT_ENUM = _MSGS_INIT_ENUM
 
     __message_chunk_count = 0
     _MSG_MIN_VAL = 1e-8 #minimum value a message may have
@@ -39,6 +48,12 @@ class MessageChunk(object):
     #used to facilitate creation of buffers to speed-up MessageChunk creation.
     __NODE_BUFF_SZ = 10000
 
+    #state of message-passing runs (see RunState). copies keep the layout of
+    #the messages (rolled or prepared for distribution).
+    msgs_in = StateAttr('msgs_in', lambda msgs: msgs.copy(order='K'))
+    msgs_sparse = StateAttr('msgs_sparse', lambda msgs: None if msgs is None else msgs.copy())
+    __is_rolled = StateAttr('_MessageChunk__is_rolled')
+
     def __init__(self, name='', num_states=2):
         """Initializer.
 
@@ -69,6 +84,13 @@ class MessageChunk(object):
         #size: [#degree,#states,#nodes]. keeps track of incoming messages
         self.msgs_in = np.zeros([0, 0, 0])
 
+        #sparse messages (see set_sparse), used instead of msgs_in. None for
+        #dense messages.
+        self.sparse_k = 0
+        self.sparse_k_max = 0
+        self.sparse_tol = 0.0
+        self.msgs_sparse = None
+
         #keeps track of node's current degree
         self.degree = np.zeros([self.__NODE_BUFF_SZ], dtype='int')
         self.__is_rolled = True
@@ -90,9 +112,10 @@ class MessageChunk(object):
         node_ids = range(self.__num_entries, self.__num_entries+num_entries_to_create)
         self.__num_entries += num_entries_to_create
 
-        while self.degree.size < self.__num_entries:
-            tmp = np.zeros_like(self.degree, dtype='int')
-            self.degree = np.concatenate((self.degree, tmp), axis=0)
+        if self.degree.size < self.__num_entries:
+            new_degree = np.zeros(max(2*self.degree.size, self.__num_entries), dtype='int')
+            new_degree[0:self.degree.size] = self.degree
+            self.degree = new_degree
 
         return node_ids
 
@@ -113,16 +136,30 @@ class MessageChunk(object):
 
         self.degree = self.degree[0:self.__num_entries]
 
-        self.msgs_in = self.__alloc_message()
-
-        if self.pad_msg_val == []:
+        if np.size(self.pad_msg_val) == 0:
             self.pad_msg_val = 1.0/self.num_states
 
         pad_msg_val = self.pad_msg_val*np.ones(self.num_states)
 
-        for i in range(0, self.msgs_in.shape[2]):
-            for j in range(0, self.num_states):
-                self.msgs_in[self.degree[i]:, j, i] = pad_msg_val[j]
+        if self.sparse_k > 0:
+            #sparse messages are the dense initial messages truncated, one
+            #location at a time (drawing the same random values)
+            self.msgs_in = np.zeros([self.max_degree, self.num_states, 0])
+            msgs_sparse = [SparseMsgs.uniform(0, self.num_states, self.sparse_k)]
+            for loc in range(self.max_degree):
+                msgs = self.__alloc_message([1, self.num_states, self.__num_entries])[0].T
+                msgs[self.degree <= loc] = pad_msg_val
+                msgs_sparse.append(SparseMsgs.from_dense(msgs, self.sparse_k, self.sparse_tol, \
+                                                         normalize=False))
+            self.msgs_sparse = SparseMsgs.concatenate(msgs_sparse)
+            self._finalized = True
+            return
+
+        self.msgs_in = self.__alloc_message()
+
+        #entries beyond a node's degree hold padding messages
+        is_pad = np.arange(self.max_degree)[:, np.newaxis] >= self.degree[np.newaxis, :]
+        self.msgs_in.swapaxes(1, 2)[is_pad] = pad_msg_val
 
         self._finalized = True
 
@@ -140,14 +177,45 @@ class MessageChunk(object):
 
         self.num_states = num_states
 
-    def __alloc_message(self):
+    def set_sparse(self, k, mass_tol=0.0, k_max=None):
+        """Stores the messages of this MessageChunk as SparseMsgs (in
+        msgs_sparse) instead of dense messages (msgs_in), keeping k states
+        per message, or up to k_max once messages need more. Must be called
+        before finalization. Sparse messages start from the dense initial
+        messages (see msgs_init_strat), truncated.
+
+        Args:
+            k (int): number of states stored per message at first.
+
+            mass_tol (double, optional): mass the states kept by a message
+                may leave out. See SparseMsgs.truncate. Defaults to 0.
+
+            k_max (int, optional): maximum number of states stored per
+                message. Defaults to k.
+        """
+
+        assert not self._finalized, \
+        'Cannot make changes to a finalized MessageChunk'
+        assert k > 0, 'k must be > 0'
+        assert k_max is None or k_max >= k, 'k_max must be >= k'
+
+        self.sparse_k = k
+        self.sparse_k_max = k if k_max is None else k_max
+        self.sparse_tol = mass_tol
+
+    def __alloc_message(self, sz_msg=None):
         """Allocates the message data structure (msgs_in).
 
+        Args:
+            sz_msg (list, optional): size of the messages to allocate.
+                Defaults to the size of msgs_in.
+
         Returns:
             The initialized messages as an ndarray
         """
 
-        sz_msg = [self.max_degree, self.num_states, self.__num_entries]
+        if sz_msg is None:
+            sz_msg = [self.max_degree, self.num_states, self.__num_entries]
 
         if np.prod(sz_msg) == 0:
             return np.random.random_sample(size=sz_msg)
@@ -171,28 +239,32 @@ class MessageChunk(object):
 
         return msg_min + msg_range*np.random.random_sample(size=sz_msg)
 
-    def clamp_messages(self, msg):
+    def clamp_messages(self, msg, norm_buff=None):
         """Clamp the given messages to be in the range
         [self._MSG_MIN_VAL, self._MSG_MAX_VAL], and then normalize them to sum
-        to 1 across axis 1.
+        to 1 across axis 1. Both steps are done in place.
 
         Args:
-            msg (ndarray): ndarray of doubles to be clamped
+            msg (ndarray or SparseMsgs): ndarray of doubles, or sparse
+                messages, to be clamped
+
+            norm_buff (ndarray, optional): buffer to hold the normalizers, of
+                size [msg.shape[0], 1, msg.shape[2]]. Allocated if not given.
 
         Returns:
             The clamped and normalized messages
         """
 
-        changed = False
+        if isinstance(msg, SparseMsgs):
+            return msg.clamp(self._MSG_MIN_VAL, self._MSG_MAX_VAL)
+
         if msg.size > 0:
-            if np.max(msg) > self._MSG_MAX_VAL:
-                msg[msg > self._MSG_MAX_VAL] = self._MSG_MAX_VAL
-                changed = True
-            if np.min(msg) < self._MSG_MIN_VAL:
-                msg[msg < self._MSG_MIN_VAL] = self._MSG_MIN_VAL
-                changed = True
-        if changed:
-            msg /= np.sum(msg, axis=1, keepdims=True)
+            np.clip(msg, self._MSG_MIN_VAL, self._MSG_MAX_VAL, out=msg)
+            if norm_buff is None:
+                norm_buff = np.sum(msg, axis=1, keepdims=True)
+            else:
+                np.sum(msg, axis=1, keepdims=True, out=norm_buff)
+            msg /= norm_buff
         return msg
 
     @staticmethod
@@ -228,7 +300,7 @@ class MessageChunk(object):
 
         assert self._finalized, 'Cannot unroll. MessageChunk must be finalized'
 
-        if self.__is_rolled:
+        if self.__is_rolled and self.sparse_k == 0:
             self.msgs_in = MessageChunk.do_prepare_msgs_for_distribution(self.msgs_in)
             self.__is_rolled = False
 
@@ -243,7 +315,7 @@ class MessageChunk(object):
 
         assert self._finalized, 'Cannot roll. MessageChunk must be finalized'
 
-        if not self.__is_rolled:
+        if not self.__is_rolled and self.sparse_k == 0:
             self.msgs_in = np.reshape(self.msgs_in, [self.max_degree, \
                                                      self.__num_entries, \
                                                      self.num_states] \
@@ -251,6 +323,40 @@ class MessageChunk(object):
             self.msgs_in = np.swapaxes(self.msgs_in, 1, 2)
             self.__is_rolled = True
 
+    def _take_entries(self, node_idxs):
+        """Returns a finalized copy of this MessageChunk holding only the
+        given nodes, renumbered in the order of node_idxs, with their incoming
+        messages. The copy keeps the message_chunk_id of this MessageChunk.
+        Its messages are laid out so that preparing them for distribution
+        does not copy them, and only the messages of the given nodes are
+        copied. Sparse messages are not supported.
+
+        Args:
+            node_idxs (ndarray): ids of the nodes to keep.
+
+        Returns:
+            The new MessageChunk
+        """
+
+        assert self._finalized, 'MessageChunk must be finalized'
+        assert self.sparse_k == 0, 'Cannot take the entries of sparse messages'
+
+        node_idxs = np.asarray(node_idxs, dtype='int')
+
+        #[max_degree, num_nodes, num_states] view of the messages
+        if self.__is_rolled:
+            msgs = np.swapaxes(self.msgs_in, 1, 2)
+        else:
+            msgs = np.reshape(self.msgs_in, [self.max_degree, self.__num_entries, \
+                                             self.num_states])
+
+        new_chunk = copy.copy(self)
+        new_chunk.__num_entries = node_idxs.size
+        new_chunk.degree = self.degree[node_idxs]
+        new_chunk.msgs_in = np.swapaxes(np.take(msgs, node_idxs, axis=1), 1, 2)
+        new_chunk.__is_rolled = True
+        return new_chunk
+
     @property
     def message_chunk_id(self):
         """ Get message_chunk_id. Guaranteed to be unique. """
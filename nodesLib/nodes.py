@@ -1,5 +1,10 @@
 """Module for the Nodes class. See documentation for Nodes class."""
 
+import copy
+import numpy as np
+from nodesLib.buffer_pool import BufferPool
+from nodesLib.run_state import StateAttr
+
 class Nodes(object):
     """This class represents a collection of nodes in a factor graph (stored as
     MessageChunks) and provides methods to perform operations on these
@@ -9,8 +14,14 @@ class Nodes(object):
 
     _do_compute_messages
 
+    Implementations should write outgoing messages into the buffers returned
+    by _get_out_buffer, and temporaries into the buffers returned by
+    _get_scratch_buffer, so that no memory is allocated per call once the
+    buffers have been sized.
+
     Public methods:
-        compute_messages: computes messages from the collection of nodes
+        compute_messages: computes messages from the collection of nodes, or
+            from a subset of them
 
         create_nodes: creates a given number of nodes
 
@@ -20,8 +31,22 @@ class Nodes(object):
         prepare_msgs_for_distribution: prepare nodes for message distribution
 
         prepare_msgs_for_computation: prepare nodes for message computation
+
+        buffer_nbytes: returns the memory held by message computation buffers
     """
 
+    #whether message computation supports sparse messages (see
+    #MessageChunk.set_sparse)
+    SPARSE_MSGS = False
+
+    #estimated floating-point operations per incoming message entry of an
+    #update (see _estimate_flops)
+    FLOPS_PER_ENTRY = 4
+
+    #state of message-passing runs (see RunState)
+    _node_idxs = StateAttr('_node_idxs')
+    __buffers = StateAttr('_Nodes__buffers', lambda _: BufferPool())
+
     def __init__(self, name='', nodes_params=None):
         """Initializer.
 
@@ -43,21 +68,43 @@ class Nodes(object):
 
         self.__finalized = False
 
-    def compute_messages(self):
+        #ids of the nodes messages are currently being computed for. None
+        #means all nodes.
+        self._node_idxs = None
+
+        #persistent output and scratch buffers for message computation
+        self.__buffers = BufferPool()
+
+    def compute_messages(self, node_idxs=None):
         """Function to perform message computation for all MessageChunks in this
         Nodes instance.
 
         Note: Messages of a MessageChunk are clamped to a minimum/maximum value,
             as indicated by the MessageChunk instance.
 
+        Note: The computed messages may be held in buffers that are reused by
+            the next call to compute_messages.
+
+        Args:
+            node_idxs (ndarray, optional): ids of the nodes to compute
+                messages for. Defaults to all nodes. The last axis of the
+                computed messages follows the order of node_idxs.
+
         Returns:
             A dictionary containing the computed messages.
         """
 
+        self._node_idxs = node_idxs
         msgs_dict = self._do_compute_messages()
+        self._node_idxs = None
 
         for key in msgs_dict.keys():
-            msgs_dict[key] = self.message_chunks[key].clamp_messages(msgs_dict[key])
+            msgs = msgs_dict[key]
+            norm_buff = None
+            if self.message_chunks[key].sparse_k == 0:
+                norm_buff = self._get_scratch_buffer('norm', \
+                                                     (msgs.shape[0], 1, msgs.shape[2]))
+            msgs_dict[key] = self.message_chunks[key].clamp_messages(msgs, norm_buff)
 
         return msgs_dict
 
@@ -102,8 +149,163 @@ class Nodes(object):
         for key in self.message_chunks.keys():
             self.message_chunks[key].prepare_msgs_for_computation()
 
+    @property
+    def num_nodes(self):
+        """ Get the number of nodes in this Nodes instance. """
+
+        return self.message_chunks.values()[0].num_nodes
+
+    def _get_msgs_in(self, key):
+        """Returns the incoming messages of a MessageChunk, restricted to the
+        nodes messages are currently being computed for.
+
+        Args:
+            key: key of the MessageChunk in self.message_chunks
+
+        Returns:
+            The incoming messages as an ndarray of size
+            [max_degree, num_states, number of nodes]
+        """
+
+        msgs = self.message_chunks[key].msgs_in
+        if self._node_idxs is not None:
+            buff = self._get_scratch_buffer('in_' + key, msgs.shape[0:2] + \
+                                            (len(self._node_idxs),))
+            msgs = np.take(msgs, self._node_idxs, axis=2, out=buff)
+        return msgs
+
+    def _get_sparse_msgs_in(self, key):
+        """Returns the incoming sparse messages of a MessageChunk (see
+        MessageChunk.set_sparse), restricted to the nodes messages are
+        currently being computed for.
+
+        Args:
+            key: key of the MessageChunk in self.message_chunks
+
+        Returns:
+            The incoming messages as SparseMsgs, with the messages of location
+            i at rows [i*n, (i+1)*n) for n nodes.
+        """
+
+        chunk = self.message_chunks[key]
+        if self._node_idxs is None:
+            return chunk.msgs_sparse
+
+        rows = np.arange(chunk.max_degree)[:, np.newaxis]*chunk.num_nodes + \
+               np.asarray(self._node_idxs)[np.newaxis, :]
+        return chunk.msgs_sparse.take(rows.ravel())
+
+    def _get_out_buffer(self, key, shape):
+        """Returns a persistent buffer to write the outgoing messages of a
+        MessageChunk into. The buffer is laid out so that it can be prepared
+        for distribution without copying (see BufferPool.get_msgs). Its
+        contents are undefined.
+
+        Args:
+            key: key of the MessageChunk in self.message_chunks
+
+            shape (tuple): size of the messages,
+                [max_degree, num_states, number of nodes]
+
+        Returns:
+            The buffer as an ndarray of doubles
+        """
+
+        return self.__buffers.get_msgs('out_' + key, shape)
+
+    def _get_scratch_buffer(self, name, shape):
+        """Returns a persistent, C-contiguous buffer for temporaries of the
+        message computation. Its contents are undefined.
+
+        Args:
+            name (str): name of the buffer. Buffers of different names never
+                overlap.
+
+            shape (tuple): size of the buffer
+
+        Returns:
+            The buffer as an ndarray of doubles
+        """
+
+        return self.__buffers.get('scratch_' + name, shape)
+
+    def buffer_nbytes(self):
+        """Returns the number of bytes held by the message computation buffers
+        of this Nodes instance.
+        """
+
+        return self.__buffers.nbytes()
+
+    def _get_init_params(self):
+        """Returns nodes_params as they are to be given to the initializer
+        to create another instance with the same parameters. Subclasses whose
+        initializer transforms nodes_params, or which keep per-node values in
+        nodes_params, must override this.
+        """
+
+        return dict(self.nodes_params)
+
+    def _new_empty(self, name):
+        """Returns a new instance of the same class, with the same parameters
+        and message initialization settings as this one, but without nodes.
+
+        Args:
+            name (str): name of the new instance.
+        """
+
+        new_nodes = type(self)(name, self._get_init_params())
+        for key in self.message_chunks:
+            chunk = self.message_chunks[key]
+            new_chunk = new_nodes.message_chunks[key]
+            new_chunk.msgs_init_strat = chunk.msgs_init_strat
+            new_chunk.msgs_init_min = chunk.msgs_init_min
+            new_chunk.msgs_init_range = chunk.msgs_init_range
+        return new_nodes
+
+    def _take_nodes(self, node_idxs):
+        """Returns a finalized copy of this Nodes instance holding only the
+        given nodes, renumbered in the order of node_idxs, with their incoming
+        messages (see MessageChunk._take_entries). Used to hand a part of a
+        factor graph to another process (see DistributedBp). Subclasses that
+        keep per-node values must override this to take theirs.
+
+        Args:
+            node_idxs (ndarray): ids of the nodes to keep.
+
+        Returns:
+            The new Nodes instance
+        """
+
+        assert self.__finalized, 'Nodes must be finalized'
+
+        new_nodes = copy.copy(self)
+        new_nodes.nodes_params = dict(self.nodes_params)
+        new_nodes.message_chunks = {}
+        for key in self.message_chunks:
+            new_nodes.message_chunks[key] = self.message_chunks[key]._take_entries(node_idxs)
+        new_nodes._node_idxs = None
+        new_nodes.__buffers = BufferPool()
+        return new_nodes
+
+    def _estimate_flops(self):
+        """Returns a rough estimate of the floating-point operations of one
+        update of all nodes (see compute_messages), from the sizes of the
+        MessageChunks alone, so it is available before finalization. By
+        default, FLOPS_PER_ENTRY per incoming message entry (padding
+        included). Subclasses whose cost is not linear in the message sizes
+        should override this.
+        """
+
+        num_entries = 0
+        for key in self.message_chunks:
+            chunk = self.message_chunks[key]
+            num_entries += chunk.max_degree*max(2, chunk.num_states)*chunk.num_nodes
+        return self.FLOPS_PER_ENTRY*num_entries
+
     def _do_compute_messages(self):
         """Helper function to compute messages. Must be overriden in a subclass.
+        Incoming messages should be read with _get_msgs_in, so that messages
+        can be computed for a subset of the nodes.
         """
 
         raise RuntimeError('No implementation for _do_compute_messages given')
@@ -30,6 +30,7 @@ class NoisyOrNodes(FactorNodes):
     """
 
     EDGE_TYPES = frozenset({'input', 'output'})
+    CHILD_EDGE_TYPES = frozenset({'output'})
     BP_ALGO_TYPES = frozenset({'max', 'sum'})
 
     def __init__(self, name='', nodes_params=None):
@@ -102,36 +103,60 @@ class NoisyOrNodes(FactorNodes):
         msg_from_output = self.get_msgs_on_edge('output')
 
         #compute message to output
-        tmp_weighted = msg_from_input[:, [0], :] + \
-                       exp_neg_beta*msg_from_input[:, [1], :]
+        tmp_weighted = self._get_scratch_buffer('weighted', \
+                                                (msg_from_input.shape[0], 1, \
+                                                 msg_from_input.shape[2]))
+        np.multiply(msg_from_input[:, 1:2, :], exp_neg_beta, out=tmp_weighted)
+        tmp_weighted += msg_from_input[:, 0:1, :]
 
-        tmp_prod_weighted = np.prod(tmp_weighted, axis=0, keepdims=True)
+        tmp_prod_weighted = self._get_scratch_buffer('prod_weighted', \
+                                                     (1, 1, msg_from_input.shape[2]))
+        np.prod(tmp_weighted, axis=0, keepdims=True, out=tmp_prod_weighted)
 
-        msg = np.zeros(msg_from_output.shape)
+        msg = self._get_out_buffer('output', msg_from_output.shape)
 
-        msg[:, [0], :] = (1-leak_prob)*tmp_prod_weighted
-        msg[:, [1], :] = 1-msg[:, [0], :]
+        np.multiply(tmp_prod_weighted, 1-leak_prob, out=msg[:, 0:1, :])
+        np.subtract(1, msg[:, 0:1, :], out=msg[:, 1:2, :])
 
         res['output'] = msg
         #compute message to output
 
         #compute message to input
-        r_j = tmp_prod_weighted / tmp_weighted
+        #r_j, then tmp_out, overwrite tmp_weighted
+        r_j = np.divide(tmp_prod_weighted, tmp_weighted, out=tmp_weighted)
 
-        tmp_out = (1-leak_prob)*r_j*(msg_from_output[:, [0], :] - msg_from_output[:, [1], :])
+        tmp_diff = self._get_scratch_buffer('diff', tmp_prod_weighted.shape)
+        np.subtract(msg_from_output[:, 0:1, :], msg_from_output[:, 1:2, :], out=tmp_diff)
+        tmp_diff *= (1-leak_prob)
+        tmp_out = np.multiply(r_j, tmp_diff, out=r_j)
 
-        msg = np.zeros(msg_from_input.shape)
+        msg = self._get_out_buffer('input', msg_from_input.shape)
 
-        msg[:, [0], :] = msg_from_output[:, [1], :] + tmp_out
-        msg[:, [1], :] = msg_from_output[:, [1], :] + exp_neg_beta*tmp_out
+        np.add(msg_from_output[:, 1:2, :], tmp_out, out=msg[:, 0:1, :])
+        tmp_out *= exp_neg_beta
+        np.add(msg_from_output[:, 1:2, :], tmp_out, out=msg[:, 1:2, :])
 
-        msg = msg / np.sum(msg, axis=1, keepdims=True)
+        msg /= np.sum(msg, axis=1, keepdims=True)
 
         res['input'] = msg
 
         return res
         #compute message to input
 
+    def _absorb_evidence(self, pinned):
+        """Absorbs factors whose output is observed to be 0: p(z=0|Y)
+        factorizes into a unary potential [1, 1-prob_success] on every input.
+        """
+
+        if 'output' not in pinned:
+            return super(NoisyOrNodes, self)._absorb_evidence(pinned)
+
+        (factor_ids, _, states) = pinned['output']
+        absorbed = factor_ids[states == 0]
+
+        unary_vals = np.tile([1.0, 1-self.nodes_params['prob_success']], (absorbed.size, 1))
+        return (absorbed, [('input', absorbed, unary_vals)])
+
     def finalize(self):
         """Prepares contained factor nodes for message passing and performs
         error-checking. Must be called once before message passing can be done
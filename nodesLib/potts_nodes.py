@@ -11,6 +11,7 @@ prefer to be in the same state.).
 
 import numpy as np
 from nodesLib.factor_nodes import FactorNodes
+from nodesLib.sparse_msgs import SparseMsgs
 
 class PottsNodes(FactorNodes):
     """This class represents a collection of Potts factor nodes.
@@ -25,6 +26,7 @@ class PottsNodes(FactorNodes):
 
     EDGE_TYPES = frozenset({'default'})
     BP_ALGO_TYPES = frozenset({'max', 'sum'})
+    SPARSE_MSGS = True
 
     def __init__(self, name='', nodes_params=None):
         """Initializer.
@@ -56,45 +58,101 @@ class PottsNodes(FactorNodes):
         super(PottsNodes, self).__init__(name, nodes_params)
 
     def _do_compute_messages(self):
+        if self.message_chunks['default'].sparse_k > 0:
+            return self.__compute_sparse_messages()
+
         alpha = self.nodes_params['alpha']
         msgs = self.get_msgs_on_edge('default')
-        res = np.zeros(msgs.shape)
+        res = self._get_out_buffer('default', msgs.shape)
 
-        res[0, :, :] = msgs[1, :, :]
-        res[1, :, :] = msgs[0, :, :]
+        np.copyto(res[0, :, :], msgs[1, :, :])
+        np.copyto(res[1, :, :], msgs[0, :, :])
         if self.nodes_params['bp_algo'] == 'sum':
-            res = res*(1-alpha)+alpha
+            res *= (1-alpha)
+            res += alpha
         else:
             #record where the max is
             inds = res.argmax(axis=1)
-
-            #get maxmimum over all states
-            state_max = alpha*np.max(res, axis=1)
-            state_max = state_max[:, np.newaxis, :]
+            ind0 = np.arange(res.shape[0])[:, np.newaxis]
+            ind2 = np.arange(res.shape[2])[np.newaxis, :]
+            res_max = res[ind0, inds, ind2]
 
             #mask out the maximum value. for finding 2nd max
-            mask = np.zeros_like(res)
-            ind0 = np.asarray(range(0, res.shape[0]))
-            ind0 = ind0[:, np.newaxis]
-
-            ind2 = np.asarray(range(0, res.shape[2]))
-            ind2 = ind2[np.newaxis, :]
-            mask[ind0, inds, ind2] = 1
-
-            res_masked = np.ma.masked_array(res, mask=mask)
+            res_masked = self._get_scratch_buffer('masked', res.shape)
+            np.copyto(res_masked, res)
+            res_masked[ind0, inds, ind2] = -np.inf
 
             #find second-max
             state_max2 = alpha*np.max(res_masked, axis=1)
 
             #for all entries except the max-state, this is the correct value
-            tmp_max = np.maximum(res, state_max)
+            np.maximum(res, alpha*res_max[:, np.newaxis, :], out=res)
 
-            tmp_max[ind0, inds, ind2] = np.maximum(res[ind0, inds, ind2], state_max2)
-            res = tmp_max
+            res[ind0, inds, ind2] = np.maximum(res_max, state_max2)
 
         res /= res.sum(axis=1, keepdims=True)
         return {'default': res}
 
+    def __compute_sparse_messages(self):
+        """Computes sparse messages (see MessageChunk.set_sparse). A Potts
+        factor maps the states stored by a message, and its floor, to the
+        states and floor of its outgoing message, so every message takes
+        O(k).
+        """
+
+        alpha = self.nodes_params['alpha']
+        msgs = self._get_sparse_msgs_in('default')
+        num_nodes = msgs.floor.size // 2
+        num_states = msgs.num_states
+        num_rest = num_states - msgs.idx.shape[1]
+
+        #the message on each edge is computed from the message on the other
+        swap = np.concatenate([np.arange(num_nodes, 2*num_nodes), np.arange(num_nodes)])
+        res = msgs.take(swap)
+
+        if self.nodes_params['bp_algo'] == 'sum':
+            res.val *= (1-alpha)
+            res.val += alpha
+            res.floor *= (1-alpha)
+            res.floor += alpha
+        else:
+            #maximum over all states but each one: the largest value but for
+            #the largest state, which gets the second largest
+            rows = np.arange(res.val.shape[0])
+            top = res.val.argmax(axis=1)
+            top_val = res.val[rows, top]
+            masked = res.val.copy()
+            masked[rows, top] = -np.inf
+            second_val = masked.max(axis=1)
+
+            floor_val = res.floor if num_rest > 0 else -np.inf*res.floor
+            others = np.repeat(top_val[:, np.newaxis], res.val.shape[1], axis=1)
+            others[rows, top] = second_val
+            others = np.maximum(others, floor_val[:, np.newaxis])
+
+            floor_others = np.maximum(top_val, res.floor if num_rest > 1 else -np.inf)
+            np.maximum(res.val, alpha*others, out=res.val)
+            res.floor = np.maximum(res.floor, alpha*floor_others)
+
+        norm = np.sum(res.val, axis=1) + num_rest*res.floor
+        res.val /= norm[:, np.newaxis]
+        res.floor /= norm
+        return {'default': res}
+
+    def _absorb_evidence(self, pinned):
+        """Absorbs every factor with an observed variable node: the factor
+        becomes a unary potential on its other variable node, alpha
+        everywhere but 1 at the observed state.
+        """
+
+        (factor_ids, _, states) = pinned['default']
+        (absorbed, first) = np.unique(factor_ids, return_index=True)
+
+        alpha = self.nodes_params['alpha']
+        unary_vals = alpha*np.ones((absorbed.size, self.message_chunks['default'].num_states))
+        unary_vals[np.arange(absorbed.size), states[first]] = 1.0
+        return (absorbed, [('default', absorbed, unary_vals)])
+
     def finalize(self):
         """Prepares contained factor nodes for message passing and performs
         error-checking. Must be called once before message passing can be done
@@ -0,0 +1,109 @@
+"""Module for the RunState and StateAttr classes. See documentation for
+RunState class."""
+
+import threading
+
+#RunState bound to each thread (attribute 'state'), if any
+_BOUND = threading.local()
+
+class RunState(object):
+    """This class holds the values that attributes declared as StateAttr take
+    while the RunState is bound to the current thread. Such attributes are
+    the ones that change during message-passing (incoming messages, beliefs,
+    message computation buffers, evidence), so binding a different RunState
+    to each thread lets several message-passing runs share one factor graph
+    concurrently.
+
+    A RunState is bound with a with-statement:
+
+        with state:
+            bpg.do_message_passing()
+
+    On first access, the value of an attribute in a RunState is initialized
+    from the attribute of the object itself (see StateAttr); the object is
+    never written to while a RunState is bound.
+
+    Public methods:
+        nbytes: returns the memory held by this RunState.
+    """
+
+    def __init__(self):
+        """Initializer."""
+
+        #key: (object, attribute name). value: value of the attribute.
+        self.values = {}
+        self.__prev = []
+
+    def __enter__(self):
+        self.__prev.append(getattr(_BOUND, 'state', None))
+        _BOUND.state = self
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        _BOUND.state = self.__prev.pop()
+        return False
+
+    def nbytes(self):
+        """Returns the number of bytes of the ndarrays (and BufferPools) held
+        by this RunState.
+        """
+
+        num_bytes = 0
+        for val in self.values.values():
+            val_bytes = getattr(val, 'nbytes', 0)
+            if callable(val_bytes):
+                val_bytes = val_bytes()
+            num_bytes += val_bytes
+        return num_bytes
+
+class StateAttr(object):
+    """This class is a descriptor for an attribute that is part of the state
+    of a message-passing run. While no RunState is bound to the current
+    thread, it behaves as a plain instance attribute. While a RunState is
+    bound, the attribute is read from and written to that RunState.
+
+    Public methods:
+        (none)
+    """
+
+    def __init__(self, name, init=None):
+        """Initializer.
+
+        Args:
+            name (str): name of the attribute (mangled, for private
+                attributes).
+
+            init (function, optional): takes the value of the attribute of the
+                object (None if it has none) and returns the initial value of
+                the attribute in a RunState. Defaults to using the value of
+                the object itself.
+        """
+
+        self.__name = name
+        self.__init = init
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+
+        state = getattr(_BOUND, 'state', None)
+        if state is None:
+            try:
+                return obj.__dict__[self.__name]
+            except KeyError:
+                raise AttributeError(self.__name)
+
+        key = (obj, self.__name)
+        if key not in state.values:
+            val = obj.__dict__.get(self.__name)
+            if self.__init is not None:
+                val = self.__init(val)
+            state.values[key] = val
+        return state.values[key]
+
+    def __set__(self, obj, val):
+        state = getattr(_BOUND, 'state', None)
+        if state is None:
+            obj.__dict__[self.__name] = val
+        else:
+            state.values[(obj, self.__name)] = val
@@ -0,0 +1,319 @@
+"""Module for the SparseMsgs class. See documentation for SparseMsgs class."""
+
+import numpy as np
+
+class SparseMsgs(object):
+    """This class represents a set of messages over many states compactly:
+    every message stores the values of (at most) k states, and a single floor
+    value shared by all its other states. Memory and most operations then
+    take O(k) per message instead of O(num_states).
+
+    Messages are rows, laid out as messages prepared for distribution (see
+    MessageChunk.do_prepare_msgs_for_distribution). The states of a row are
+    distinct. Computed messages are normalized: the k values plus the floor
+    times the number of other states sum to 1. Messages held by a
+    MessageChunk keep the scale dense messages would have (see update).
+
+    The number of states a message really keeps adapts to its mass: when
+    truncating (see truncate), the fewest largest states holding all but
+    mass_tol of the mass are kept, and the remaining stored states are folded
+    into the floor (their value becomes the floor value). k itself, shared by
+    all messages, grows up to a cap while folding states into the floor
+    would misplace more than mass_tol of the mass of some message.
+
+    Public methods:
+        uniform: static method returning uniform messages.
+
+        from_dense: static method to truncate dense messages.
+
+        truncate: static method to truncate candidate states to messages.
+
+        to_dense: returns the messages as dense messages.
+
+        concatenate: static method to concatenate messages.
+
+        take: returns a subset of the messages.
+
+        widen: stores more states per message.
+
+        clamp: clamps the messages to a range of values.
+
+        update: updates a subset of the messages with damping.
+
+        set_uniform: sets a subset of the messages to uniform messages.
+
+        copy: returns a copy of the messages.
+    """
+
+    def __init__(self, idx, val, floor, num_states):
+        """Initializer.
+
+        Args:
+            idx (ndarray): [#messages, k] ndarray of ints, the states stored.
+
+            val (ndarray): [#messages, k] ndarray of doubles, the values of
+                the states stored.
+
+            floor (ndarray): ndarray of doubles, the value of all other
+                states of every message.
+
+            num_states (int): number of states of the messages.
+        """
+
+        self.idx = idx
+        self.val = val
+        self.floor = floor
+        self.num_states = num_states
+
+    @staticmethod
+    def uniform(num_msgs, num_states, k):
+        """Returns num_msgs uniform messages over num_states states, storing
+        min(k, num_states) states each.
+        """
+
+        k = min(k, num_states)
+        idx = np.tile(np.arange(k), (num_msgs, 1))
+        val = np.ones((num_msgs, k))/num_states
+        floor = np.ones(num_msgs)/num_states
+        return SparseMsgs(idx, val, floor, num_states)
+
+    @staticmethod
+    def from_dense(msgs, k, mass_tol=0.0, normalize=True):
+        """Truncates dense messages to their top min(k, #states) states.
+
+        Args:
+            msgs (ndarray): [#messages, num_states] ndarray of doubles.
+
+            k (int): maximum number of states stored per message.
+
+            mass_tol (double, optional): see truncate. Defaults to 0.
+
+            normalize (bool, optional): see truncate. Defaults to True.
+
+        Returns:
+            The truncated SparseMsgs.
+        """
+
+        num_states = msgs.shape[1]
+        k = min(k, num_states)
+        rows = np.arange(msgs.shape[0])[:, np.newaxis]
+        idx = np.argpartition(-msgs, k-1, axis=1)[:, 0:k]
+        return SparseMsgs.truncate(idx, msgs[rows, idx], msgs.sum(axis=1), num_states, \
+                                   k, mass_tol, normalize=normalize)
+
+    @staticmethod
+    def truncate(idx, val, total, num_states, k, mass_tol, k_max=None, normalize=True):
+        """Keeps the k largest of candidate states of every message, and
+        spreads the mass of all other states evenly over them as the floor.
+        Of the k states, the fewest largest holding at least 1-mass_tol of
+        the mass are kept; the others are folded into the floor.
+
+        If k_max is larger than k, k is doubled (up to k_max) while, for some
+        message, the states left out of the k largest exceed the floor by
+        more than mass_tol of its mass in total. Messages with a flat tail
+        then keep k states, and peaked ones are not cut short.
+
+        Args:
+            idx (ndarray): [#messages, #candidates] ndarray of the candidate
+                states of every message. States of a row must be distinct,
+                except for candidates of value -inf, which are never kept.
+                There must be at least k of them.
+
+            val (ndarray): [#messages, #candidates] ndarray of the
+                (unnormalized) values of the candidates.
+
+            total (ndarray): unnormalized mass of every message, over all
+                its states.
+
+            num_states (int): number of states of the messages.
+
+            k (int): number of states stored per message.
+
+            mass_tol (double): mass the states kept may leave out.
+
+            k_max (int, optional): maximum number of states stored per
+                message. Defaults to k.
+
+            normalize (bool, optional): whether to normalize the messages, or
+                keep their mass at total. Defaults to True.
+
+        Returns:
+            The SparseMsgs, storing k or more states per message.
+        """
+
+        rows = np.arange(idx.shape[0])[:, np.newaxis]
+
+        #every message has at least k_cap valid candidates
+        k_cap = k
+        if k_max is not None and k_max > k and idx.shape[0] > 0:
+            num_valid = np.sum(val > -np.inf, axis=1).min()
+            k_cap = max(k, min(k_max, num_valid, num_states))
+
+        if idx.shape[1] > k_cap:
+            top = np.argpartition(-val, k_cap-1, axis=1)[:, 0:k_cap]
+            idx = idx[rows, top]
+            val = val[rows, top]
+
+        order = np.argsort(-val, axis=1)
+        idx = idx[rows, order]
+        val = val[rows, order]
+        cum = np.cumsum(val, axis=1)
+
+        while k < k_cap:
+            floor = np.maximum(total - cum[:, k-1], 0.0)/max(num_states - k, 1)
+            excess = np.sum(np.maximum(val[:, k:] - floor[:, np.newaxis], 0.0), axis=1)
+            if np.all(excess <= mass_tol*total):
+                break
+            k = min(2*k, k_cap)
+
+        (idx, val, cum) = (idx[:, 0:k], val[:, 0:k], cum[:, 0:k])
+
+        num_kept = np.minimum(np.sum(cum < (1-mass_tol)*total[:, np.newaxis], axis=1) + 1, k)
+        is_kept = np.arange(k)[np.newaxis, :] < num_kept[:, np.newaxis]
+
+        kept_mass = np.sum(np.where(is_kept, val, 0.0), axis=1)
+        num_rest = num_states - num_kept
+        floor = np.maximum(total - kept_mass, 0.0)/np.maximum(num_rest, 1)
+
+        #messages keeping all states have no other state. their floor only
+        #needs to be a valid value
+        floor[num_rest == 0] = val[num_rest == 0, -1]
+        val = np.where(is_kept, val, floor[:, np.newaxis])
+
+        norm = kept_mass + num_rest*floor
+        if normalize:
+            scale = 1.0/norm
+        else:
+            scale = total/norm
+        return SparseMsgs(idx, val*scale[:, np.newaxis], floor*scale, num_states)
+
+    @staticmethod
+    def concatenate(msgs_list):
+        """Concatenates SparseMsgs over the same states, storing as many
+        states per message as the widest of them (see widen).
+        """
+
+        k = max([msgs.idx.shape[1] for msgs in msgs_list])
+        msgs_list = [msgs if msgs.idx.shape[1] == k else msgs.copy().widen(k) \
+                     for msgs in msgs_list]
+        return SparseMsgs(np.concatenate([msgs.idx for msgs in msgs_list]), \
+                          np.concatenate([msgs.val for msgs in msgs_list]), \
+                          np.concatenate([msgs.floor for msgs in msgs_list]), \
+                          msgs_list[0].num_states)
+
+    def to_dense(self):
+        """Returns the messages as a [#messages, num_states] ndarray."""
+
+        dense = np.repeat(self.floor[:, np.newaxis], self.num_states, axis=1)
+        dense[np.arange(self.idx.shape[0])[:, np.newaxis], self.idx] = self.val
+        return dense
+
+    def widen(self, k):
+        """Stores min(k, num_states) states per message, if that is more
+        than stored now. Added states hold the floor value, so the messages
+        are unchanged. Returns self.
+        """
+
+        (num_msgs, num_stored) = self.idx.shape
+        k = min(k, self.num_states)
+        if k <= num_stored:
+            return self
+
+        #the first states not stored yet
+        is_stored = np.zeros((num_msgs, self.num_states), dtype='bool')
+        is_stored[np.arange(num_msgs)[:, np.newaxis], self.idx] = True
+        added = np.argsort(is_stored, axis=1, kind='mergesort')[:, 0:k-num_stored]
+
+        self.idx = np.concatenate([self.idx, added], axis=1)
+        self.val = np.concatenate([self.val, np.repeat(self.floor[:, np.newaxis], \
+                                                       k-num_stored, axis=1)], axis=1)
+        return self
+
+    def take(self, rows):
+        """Returns the messages of the given rows, as SparseMsgs."""
+
+        return SparseMsgs(self.idx[rows], self.val[rows], self.floor[rows], self.num_states)
+
+    def clamp(self, min_val, max_val):
+        """Clamps the values of the messages to [min_val, max_val], then
+        normalizes them. Returns self.
+        """
+
+        np.clip(self.val, min_val, max_val, out=self.val)
+        np.clip(self.floor, min_val, max_val, out=self.floor)
+
+        norm = np.sum(self.val, axis=1) + (self.num_states-self.idx.shape[1])*self.floor
+        self.val /= norm[:, np.newaxis]
+        self.floor /= norm
+        return self
+
+    def update(self, rows, msgs, damp, mass_tol, k_max=None):
+        """Updates messages to damp times their value plus (1-damp) times
+        new messages, truncating the result (see truncate). As for dense
+        messages, the result is not normalized.
+
+        Args:
+            rows (ndarray): rows of the messages to update. Must be distinct.
+
+            msgs (:obj: SparseMsgs): the new messages, one per row.
+
+            damp (double): damping.
+
+            mass_tol (double): see truncate.
+
+            k_max (int, optional): see truncate. Defaults to the number of
+                states stored now.
+        """
+
+        k = self.idx.shape[1]
+        if damp == 0.0:
+            if msgs.idx.shape[1] < k:
+                msgs = msgs.copy().widen(k)
+            self.widen(msgs.idx.shape[1])
+            self.idx[rows] = msgs.idx
+            self.val[rows] = msgs.val
+            self.floor[rows] = msgs.floor
+            return
+
+        (old_idx, old_val, old_floor) = (self.idx[rows], self.val[rows], self.floor[rows])
+
+        #value of the states of either message in the other one
+        is_same = old_idx[:, :, np.newaxis] == msgs.idx[:, np.newaxis, :]
+        new_at_old = np.where(is_same.any(axis=2), \
+                              np.sum(np.where(is_same, msgs.val[:, np.newaxis, :], 0.0), axis=2), \
+                              msgs.floor[:, np.newaxis])
+        new_in_old = is_same.any(axis=1)
+
+        cand_idx = np.concatenate([old_idx, msgs.idx], axis=1)
+        cand_val = np.concatenate([damp*old_val + (1-damp)*new_at_old, \
+                                   damp*old_floor[:, np.newaxis] + (1-damp)*msgs.val], axis=1)
+
+        #states already among the old ones are not candidates twice
+        cand_val[:, k:][new_in_old] = -np.inf
+
+        total = damp*(np.sum(old_val, axis=1) + (self.num_states-k)*old_floor) + \
+                (1-damp)*(np.sum(msgs.val, axis=1) + \
+                          (self.num_states-msgs.idx.shape[1])*msgs.floor)
+        res = SparseMsgs.truncate(cand_idx, cand_val, total, self.num_states, \
+                                  k, mass_tol, k_max, normalize=False)
+        self.widen(res.idx.shape[1])
+        self.idx[rows] = res.idx
+        self.val[rows] = res.val
+        self.floor[rows] = res.floor
+
+    def set_uniform(self, rows):
+        """Sets the messages of the given rows to uniform messages."""
+
+        self.val[rows] = 1.0/self.num_states
+        self.floor[rows] = 1.0/self.num_states
+
+    def copy(self):
+        """Returns a copy of the messages."""
+
+        return SparseMsgs(self.idx.copy(), self.val.copy(), self.floor.copy(), self.num_states)
+
+    @property
+    def nbytes(self):
+        """ Get the number of bytes held by the messages. """
+
+        return self.idx.nbytes + self.val.nbytes + self.floor.nbytes
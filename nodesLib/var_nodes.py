@@ -3,7 +3,9 @@
 import numpy as np
 import scipy as sp
 from nodesLib import MessageChunk
+from nodesLib import SparseMsgs
 from nodesLib.nodes import Nodes
+from nodesLib.run_state import StateAttr
 
 class VarNodes(Nodes):
     """This class represents a collection of variable nodes in a factor graph
@@ -22,8 +24,39 @@ class VarNodes(Nodes):
         get_beliefs: Returns the beliefs of the contained variable nodes.
 
         condition_on: Condition on the state of a variable node.
+
+        has_unaries: Indicates which variable nodes have unary potentials.
+
+        get_unaries: Returns the unary potentials of the variable nodes.
+
+        get_observed: Returns the variable nodes with hard evidence.
+
+        set_edge_multiplicities: Sets how many times the message on an edge
+            counts.
+
+        has_edge_multiplicities: Indicates which variable nodes have edges
+            with a multiplicity other than 1.
+
+        set_evidence: Sets removable hard evidence on variable nodes.
+
+        clear_evidence: Removes all evidence set by set_evidence.
+
+        has_evidence: Indicates whether evidence is set with set_evidence.
     """
 
+    SPARSE_MSGS = True
+
+    #log and exp of every entry, counted as 10 flops each, and the sums
+    FLOPS_PER_ENTRY = 25
+
+    #state of message-passing runs (see RunState)
+    bel = StateAttr('bel', lambda _: [])
+    __evidence = StateAttr('_VarNodes__evidence')
+
+    #unary potentials whose states but the most likely one hold at most this
+    #much mass (relative to it) are hard evidence. see get_observed
+    __HARD_EVIDENCE_TOL = 1e-9
+
     __DEFAULT_PARAMS = {'num_states': 2, \
                         'msgs_init_strat': MessageChunk.MSGS_INIT_ENUM.random}
 
@@ -54,6 +87,18 @@ class VarNodes(Nodes):
         self.message_chunks['vars'] = MessageChunk(name+'_vars', self.num_states)
         self.message_chunks['vars'].msgs_init_strat = nodes_params['msgs_init_strat']
 
+        #unary potentials added, but not yet merged. list of (node ids,
+        #log of unary potentials) tuples.
+        self.__pending_unaries = []
+
+        #multiplicities of edges set, but not yet merged. list of (node ids,
+        #locations, multiplicities) tuples.
+        self.__pending_mults = []
+
+        #removable evidence. (sorted node ids, log of unary potentials of size
+        #[1, num_states, #node ids]) or None.
+        self.__evidence = None
+
     def condition_on(self, node_ids, state):
         """Condition on the state of given variable nodes.
 
@@ -67,10 +112,51 @@ class VarNodes(Nodes):
 
         assert state < self.num_states
 
-        for node_id in node_ids:
-            tmp = [0.0]*self.num_states
-            tmp[state] = 1.0
-            self.add_unaries([node_id], tmp)
+        node_ids = np.asarray(node_ids, dtype='int').ravel()
+        unary_vals = np.zeros((node_ids.size, self.num_states))
+        unary_vals[:, state] = 1.0
+        self.add_unaries(node_ids, unary_vals)
+
+    def set_evidence(self, node_ids, states):
+        """Sets hard evidence on variable nodes, replacing any evidence set
+        before. Unlike condition_on, evidence can be removed again (see
+        clear_evidence), so it can change between runs of message-passing.
+
+        Args:
+            node_ids (list): ids of the variable nodes observed.
+
+            states (list): observed state of each of the variable nodes.
+        """
+
+        node_ids = np.asarray(node_ids, dtype='int').ravel()
+        states = np.asarray(states, dtype='int').ravel()
+        assert node_ids.size == states.size, 'Must give one state per node.'
+        assert np.all(states < self.num_states), 'Invalid state.'
+        assert np.unique(node_ids).size == node_ids.size, \
+               'Evidence can only be set once per node.'
+
+        if node_ids.size == 0:
+            self.__evidence = None
+            return
+
+        order = np.argsort(node_ids)
+        log_vals = np.log(1e-12)*np.ones((1, self.num_states, node_ids.size))
+        log_vals[0, states[order], np.arange(node_ids.size)] = 0.0
+        self.__evidence = (node_ids[order], log_vals)
+
+    def clear_evidence(self):
+        """Removes all evidence set by set_evidence."""
+
+        self.__evidence = None
+
+    def has_evidence(self):
+        """Indicates whether evidence is set with set_evidence.
+
+            Returns:
+                True if any variable node has evidence set, False otherwise.
+        """
+
+        return self.__evidence is not None
 
     def get_msg_chunk(self):
         """ Returns the MessageChunk of variables nodes this object represents."""
@@ -83,19 +169,33 @@ class VarNodes(Nodes):
         Preparation involves allocating space for and initializing messages.
         """
 
-        #do we have a unary attached to all nodes? then sort and delete all indices.
-        #this lets us avoid fancy indexing since we know the observations are in a
-        #contiguous chunk
+        self.__merge_duplicate_unaries()
+
+        if len(self.__pending_mults) > 0:
+            chunk = self.message_chunks['vars']
+            edge_mult = np.ones((chunk.max_degree, 1, chunk.num_nodes))
+            for (node_ids, locs, mults) in self.__pending_mults:
+                edge_mult[locs, 0, node_ids] = mults
+            self.nodes_params['edge_mult'] = edge_mult
+            self.__pending_mults = []
+
+        assert self.message_chunks['vars'].sparse_k == 0 or \
+               'edge_mult' not in self.nodes_params, \
+               'Sparse messages do not support edge multiplicities'
+
+        #do we have a unary attached to all nodes? then delete all indices
+        #(they are sorted). this lets us avoid fancy indexing since we know
+        #the observations are in a contiguous chunk
         if 'unary_idx' in self.nodes_params:
             if self.nodes_params['unary_idx'].size == self.message_chunks['vars'].num_nodes:
-                idx_resh = np.argsort(self.nodes_params['unary_idx'], axis=0)
-                self.nodes_params['log_unary'] = self.nodes_params['log_unary'][:, :, idx_resh]
                 del self.nodes_params['unary_idx']
 
         super(VarNodes, self).finalize()
 
     def add_unaries(self, node_ids, unary_vals):
-        """Adds unary potentials to the specified variable nodes.
+        """Adds unary potentials to the specified variable nodes. Unary
+        potentials added to the same variable node more than once are
+        multiplied.
 
         Args:
             node_ids (list): A list of the ids of the variable nodes (as
@@ -127,100 +227,391 @@ class VarNodes(Nodes):
                                       'Unary potentials must specify ' + \
                                       'same number of states as node.'
 
-        unary_to_reshape = [unary_vals.shape[0], unary_vals.shape[1], 1]
-        unary_vals = np.reshape(unary_vals, unary_to_reshape)
-        unary_vals = unary_vals.swapaxes(0, 2)
-        node_ids = np.asarray(node_ids)
+        node_ids = np.asarray(node_ids, dtype='int')
         node_ids = np.reshape(node_ids, [node_ids.size])
 
-        unary_vals /= np.sum(unary_vals, axis=1, keepdims=True)
+        unary_vals = unary_vals / np.sum(unary_vals, axis=1, keepdims=True, dtype=float)
 
         #clip for numerical issues
         unary_vals = np.clip(unary_vals, 1e-12, 1-1e-12)
         unary_vals /= np.sum(unary_vals, axis=1, keepdims=True)
 
+        #merged lazily, so that adding n unaries costs O(n log n) overall
+        self.__pending_unaries.append((node_ids, np.log(unary_vals)))
+
+    def _add_log_unaries(self, node_ids, log_vals):
+        """Adds the log of unary potentials, as returned by get_unaries, to
+        the specified variable nodes, without normalizing them.
+        """
+
+        self.__pending_unaries.append((np.asarray(node_ids, dtype='int'), log_vals))
+
+    def __merge_duplicate_unaries(self):
+        """Attaches the pending unary potentials (see add_unaries). The log of
+        all unary potentials of a variable node are summed, and the unary
+        potentials are stored sorted by variable node id.
+        """
+
+        if len(self.__pending_unaries) == 0:
+            return
+
+        node_ids = [pending[0] for pending in self.__pending_unaries]
+        log_vals = [pending[1] for pending in self.__pending_unaries]
+        self.__pending_unaries = []
+
         if 'log_unary' in self.nodes_params:
-            (node_ids, unary_vals) = self.__merge_duplicate_unaries(node_ids, unary_vals)
-
-            if node_ids.size > 0:
-                self.nodes_params['log_unary'] = np.concatenate((self.nodes_params['log_unary'], \
-                                                                np.log(unary_vals)), \
-                                                                axis=2)
-                self.nodes_params['unary_idx'] = np.concatenate((self.nodes_params['unary_idx'], \
-                                                               node_ids), \
-                                                               axis=0)
-        else:
-            self.nodes_params['log_unary'] = np.log(unary_vals)
-            self.nodes_params['unary_idx'] = np.copy(node_ids)
+            if 'unary_idx' in self.nodes_params:
+                node_ids.insert(0, self.nodes_params['unary_idx'])
+            else:
+                node_ids.insert(0, np.arange(self.message_chunks['vars'].num_nodes))
+            log_vals.insert(0, self.nodes_params['log_unary'][0, :, :].T)
+
+        node_ids = np.concatenate(node_ids)
+        log_vals = np.concatenate(log_vals, axis=0)
+
+        order = np.argsort(node_ids, kind='mergesort')
+        node_ids = node_ids[order]
+        log_vals = log_vals[order, :]
+
+        is_first = np.ones(node_ids.size, dtype='bool')
+        is_first[1:] = node_ids[1:] != node_ids[:-1]
+        starts = np.nonzero(is_first)[0]
+
+        log_vals = np.add.reduceat(log_vals, starts, axis=0)
+        self.nodes_params['log_unary'] = np.ascontiguousarray(log_vals.T[np.newaxis, :, :])
+        self.nodes_params['unary_idx'] = node_ids[starts]
+
+    def get_unaries(self):
+        """Returns the log of the unary potentials attached to the variable
+        nodes, with all unary potentials of a node summed.
+
+            Returns:
+                A tuple (node_ids, log_vals). node_ids is a sorted ndarray of
+                the ids of the variable nodes with unary potentials; log_vals
+                is an ndarray of size [#node_ids, num_states].
+        """
+
+        if not self.__has_any_unary():
+            return (np.zeros(0, dtype='int'), np.zeros((0, self.num_states)))
+
+        log_vals = self.nodes_params['log_unary'][0, :, :].T
+        if 'unary_idx' in self.nodes_params:
+            return (self.nodes_params['unary_idx'], log_vals)
+        return (np.arange(self.message_chunks['vars'].num_nodes), log_vals)
+
+    def get_observed(self):
+        """Returns the variable nodes whose unary potentials (see add_unaries
+        and condition_on) leave a single possible state. Evidence set with
+        set_evidence is not included.
+
+            Returns:
+                A tuple (node_ids, states) of ndarrays.
+        """
+
+        (node_ids, log_vals) = self.get_unaries()
+        log_vals = log_vals - log_vals.max(axis=1, keepdims=True)
+        off_mass = np.exp(log_vals).sum(axis=1) - 1.0
+        is_observed = off_mass <= self.__HARD_EVIDENCE_TOL
+        return (node_ids[is_observed], log_vals[is_observed, :].argmax(axis=1))
+
+    def set_edge_multiplicities(self, node_ids, locs, mults):
+        """Sets how many times the incoming message on an edge counts, as if
+        the variable node had that many identical edges, each receiving the
+        same message. Used for lifted message-passing (see LiftedBp). Must be
+        called before finalization.
 
-    def __merge_duplicate_unaries(self, node_ids, unary_vals):
-        # merges duplicate unaries and returns the variable nodes that are
-        # not duplicate entries (ie, that do not yet have unary potentials
-        # attached to them.).
+        Args:
+            node_ids (ndarray): ids of the variable nodes.
+
+            locs (ndarray): location of the edge of each variable node, as in
+                GraphEdgeInfo.get_edge_entries.
+
+            mults (ndarray): multiplicity of each edge. Defaults to 1 for
+                edges not given.
+        """
+
+        self.__pending_mults.append((np.asarray(node_ids, dtype='int'), \
+                                     np.asarray(locs, dtype='int'), \
+                                     np.asarray(mults, dtype=float)))
+
+    def has_edge_multiplicities(self):
+        """Indicates which variable nodes have an edge with a multiplicity
+        other than 1 (see set_edge_multiplicities). Only valid after
+        finalization.
+
+            Returns:
+                A boolean ndarray with one entry per variable node.
+        """
+
+        edge_mult = self.__get_edge_mult()
+        if edge_mult is None:
+            return np.zeros(self.message_chunks['vars'].num_nodes, dtype='bool')
+        return (edge_mult != 1).any(axis=(0, 1))
+
+    def __get_edge_mult(self, node_idxs=None):
+        """Returns the multiplicities of the edges of the variable nodes, of
+        size [max_degree, 1, #nodes], or None if all of them are 1.
+        """
 
-        dups = []
-        dups_val = None
-        for i in range(0, len(node_ids)):
-            node_id = node_ids[i]
-            if node_id in self.nodes_params['unary_idx']:
-                dups = np.append(dups, node_id)
+        if 'edge_mult' not in self.nodes_params:
+            return None
+        if node_idxs is None:
+            return self.nodes_params['edge_mult']
+        return self.nodes_params['edge_mult'][:, :, node_idxs]
+
+    def _get_init_params(self):
+        init_params = dict(self.nodes_params)
+        init_params.pop('log_unary', None)
+        init_params.pop('unary_idx', None)
+        init_params.pop('edge_mult', None)
+        return init_params
+
+    def _take_nodes(self, node_idxs):
+        node_idxs = np.asarray(node_idxs, dtype='int')
+        self.__merge_duplicate_unaries()
+
+        new_nodes = super(VarNodes, self)._take_nodes(node_idxs)
+        new_nodes.bel = []
+        new_nodes.__pending_unaries = []
+        new_nodes.__pending_mults = []
+
+        pos = -np.ones(self.message_chunks['vars'].num_nodes, dtype='int')
+        pos[node_idxs] = np.arange(node_idxs.size)
+
+        params = new_nodes.nodes_params
+        if 'unary_idx' in params:
+            (params['unary_idx'], params['log_unary']) = \
+                self.__take_sorted(pos, params['unary_idx'], params['log_unary'])
+        elif 'log_unary' in params:
+            params['log_unary'] = params['log_unary'][:, :, node_idxs]
+        if 'edge_mult' in params:
+            params['edge_mult'] = params['edge_mult'][:, :, node_idxs]
+
+        if self.__evidence is not None:
+            evidence = self.__take_sorted(pos, *self.__evidence)
+            new_nodes.__evidence = evidence if evidence[0].size > 0 else None
+        return new_nodes
+
+    @staticmethod
+    def __take_sorted(pos, node_ids, log_vals):
+        """Renumbers sorted node ids, and the log of their unary potentials
+        of size [1, num_states, #node ids], by pos (-1 for nodes not kept).
+        Returns the kept ones, sorted by their new ids.
+        """
 
-                if dups_val is None:
-                    dups_val = unary_vals[[i], :, :]
-                else:
-                    dups_val = np.concatenate((dups_val, unary_vals[[i], :, :]), axis=0)
+        node_ids = pos[node_ids]
+        keep = np.nonzero(node_ids >= 0)[0]
+        keep = keep[np.argsort(node_ids[keep], kind='mergesort')]
+        return (node_ids[keep], log_vals[:, :, keep])
 
-        if dups.size > 0:
-            log_dups_val = np.log(dups_val)
+    def __has_any_unary(self):
+        """Returns True if any variable node has a unary potential attached."""
 
-            for i in dups:
-                idx = np.where(self.nodes_params['unary_idx'] == i)[0][0]
-                self.nodes_params['log_unary'][idx, :] += log_dups_val[int(i), :]
+        self.__merge_duplicate_unaries()
+        return 'log_unary' in self.nodes_params
 
-        node_ids = np.delete(node_ids, dups)
-        unary_vals = np.delete(unary_vals, (dups), axis=0)
+    def has_unaries(self):
+        """Indicates which variable nodes have unary potentials attached.
 
-        return (node_ids, unary_vals)
+            Returns:
+                A boolean ndarray with one entry per variable node.
+        """
 
-    def __include_unary(self, log_arr):
+        res = np.zeros(self.message_chunks['vars'].num_nodes, dtype='bool')
+        if self.__has_any_unary():
+            if 'unary_idx' in self.nodes_params:
+                res[self.nodes_params['unary_idx']] = True
+            else:
+                res[:] = True
+        if self.__evidence is not None:
+            res[self.__evidence[0]] = True
+        return res
+
+    def __include_unary(self, log_arr, node_idxs=None):
         """Adds on the effect of the (log of) unary potentials.
 
             Args:
                 log_arr (double): an ndarray of doubles the same size as
                     self.log_unary
 
+                node_idxs (ndarray, optional): ids of the variable nodes along
+                    the last axis of log_arr. Defaults to all nodes.
+
             Returns:
                 arr modified to include information about the unary potentials
         """
 
-        if 'log_unary' in self.nodes_params:
+        if self.__has_any_unary():
             if 'unary_idx' in self.nodes_params:
-                unary_idx = self.nodes_params['unary_idx']
-                log_arr[:, :, unary_idx] += self.nodes_params['log_unary']
+                self.__add_log_unary(log_arr, self.nodes_params['unary_idx'], \
+                                     self.nodes_params['log_unary'], node_idxs)
+            elif node_idxs is not None:
+                log_arr += self.nodes_params['log_unary'][:, :, node_idxs]
             else:
                 log_arr += self.nodes_params['log_unary']
+
+        if self.__evidence is not None:
+            self.__add_log_unary(log_arr, self.__evidence[0], self.__evidence[1], \
+                                 node_idxs)
         return log_arr
 
-    def get_beliefs(self):
+    def __add_log_unary(self, log_arr, unary_idx, log_unary, node_idxs):
+        """Adds (the log of) unary potentials of some variable nodes to
+        log_arr. See __include_unary.
+
+        Args:
+            log_arr (ndarray): see __include_unary.
+
+            unary_idx (ndarray): sorted ids of the variable nodes with unary
+                potentials.
+
+            log_unary (ndarray): log of the unary potentials, of size
+                [1, num_states, unary_idx.size]
+
+            node_idxs (ndarray): see __include_unary.
+        """
+
+        if node_idxs is not None:
+            pos = -np.ones(self.message_chunks['vars'].num_nodes, dtype='int')
+            pos[node_idxs] = np.arange(len(node_idxs))
+            unary_idx = pos[unary_idx]
+            log_unary = log_unary[:, :, unary_idx >= 0]
+            unary_idx = unary_idx[unary_idx >= 0]
+        log_arr[:, :, unary_idx] += log_unary
+
+    def get_beliefs(self, node_ids=None):
         """Returns the beliefs of the contained variable nodes.
 
+            Args:
+                node_ids (ndarray, optional): ids of the variable nodes to
+                    return beliefs for. Defaults to all variable nodes.
+
             Returns:
                 Belief of the variable nodes as an ndarray
         """
 
+        if node_ids is not None:
+            return self.__compute_beliefs(np.asarray(node_ids))
+
         self.__update_beliefs()
         return self.bel
 
     def __update_beliefs(self):
         """Updates the beliefs of the contained variable nodes."""
 
-        log_bel = np.sum(np.log(self.message_chunks['vars'].msgs_in), \
-                         axis=0, \
-                         keepdims=True)
-        log_bel = self.__include_unary(log_bel)
+        self.bel = self.__compute_beliefs()
+
+    def __compute_beliefs(self, node_idxs=None):
+        """Computes the beliefs of the contained variable nodes.
+
+            Args:
+                node_idxs (ndarray, optional): ids of the variable nodes to
+                    compute beliefs for. Defaults to all variable nodes.
+
+            Returns:
+                Belief of the variable nodes as an ndarray
+        """
+
+        if self.message_chunks['vars'].sparse_k > 0:
+            self._node_idxs = node_idxs
+            log_bel = self.__sparse_log_sum(self._get_sparse_msgs_in('vars'))[0]
+            self._node_idxs = None
+            log_bel = log_bel.T[np.newaxis, :, :]
+        else:
+            msgs_in = self.message_chunks['vars'].msgs_in
+            if node_idxs is not None:
+                msgs_in = msgs_in[:, :, node_idxs]
+
+            log_msgs = np.log(msgs_in)
+            edge_mult = self.__get_edge_mult(node_idxs)
+            if edge_mult is not None:
+                log_msgs *= edge_mult
+
+            log_bel = np.sum(log_msgs, axis=0, keepdims=True)
+            log_bel = self.__include_unary(log_bel, node_idxs)
 
         denom = sp.misc.logsumexp(log_bel, axis=1, keepdims=True)
-        self.bel = np.exp(log_bel - denom)
+        return np.exp(log_bel - denom)
+
+    def __sparse_log_sum(self, msgs):
+        """Sums the log of the unary potentials and of the incoming sparse
+        messages of the variable nodes messages are being computed for.
+
+        Args:
+            msgs (:obj: SparseMsgs): incoming messages, as returned by
+                _get_sparse_msgs_in.
+
+        Returns:
+            A tuple (log_sum, log_floor, log_val): log_sum is an ndarray of
+            size [#nodes, num_states], log_floor holds the log of the floor
+            of the incoming messages, of size [max_degree, #nodes], and
+            log_val the log of their values, of size [max_degree, #nodes, k].
+        """
+
+        chunk = self.message_chunks['vars']
+        num_nodes = msgs.floor.size // chunk.max_degree
+        log_floor = np.log(msgs.floor).reshape(chunk.max_degree, num_nodes)
+        log_val = np.log(msgs.val).reshape(chunk.max_degree, num_nodes, -1)
+        idx = msgs.idx.reshape(log_val.shape)
+
+        log_sum = np.zeros((1, self.num_states, num_nodes))
+        log_sum = self.__include_unary(log_sum, self._node_idxs)[0].T.copy()
+        log_sum += np.sum(log_floor, axis=0)[:, np.newaxis]
+
+        #states stored by a message differ from its floor
+        rows = np.arange(num_nodes)[:, np.newaxis]
+        for loc in range(chunk.max_degree):
+            log_sum[rows, idx[loc]] += log_val[loc] - log_floor[loc][:, np.newaxis]
+
+        return (log_sum, log_floor, log_val)
+
+    def __compute_sparse_messages(self):
+        """Computes sparse messages from variable nodes (see
+        MessageChunk.set_sparse). The message on an edge is the product of
+        the unary potential and the other incoming messages, truncated to
+        its top states. These are among the top 2k states of the product of
+        all incoming messages, or the states stored by the message of the
+        edge itself, so every message takes O(k^2) once the product is
+        summed.
+
+        Returns:
+            dict with key 'vars', containing the computed SparseMsgs
+        """
+
+        chunk = self.message_chunks['vars']
+        msgs = self._get_sparse_msgs_in('vars')
+        (log_sum, log_floor, log_val) = self.__sparse_log_sum(msgs)
+        idx = msgs.idx.reshape(log_val.shape)
+        (num_nodes, k) = log_val.shape[1:]
+
+        #product of all messages, relative to its maximum
+        log_sum -= np.max(log_sum, axis=1, keepdims=True)
+        prod = np.exp(log_sum)
+        prod_mass = np.sum(prod, axis=1)
+
+        num_top = min(2*k, self.num_states)
+        top = np.argpartition(-log_sum, num_top-1, axis=1)[:, 0:num_top]
+        rows = np.arange(num_nodes)[:, np.newaxis]
+
+        res = []
+        for loc in range(chunk.max_degree):
+            floor = np.exp(log_floor[loc])
+            val = np.exp(log_val[loc])
+
+            #top states of the product, but those stored by this message
+            #have their own value
+            cand_val = np.concatenate([prod[rows, top]/floor[:, np.newaxis], \
+                                       prod[rows, idx[loc]]/val], axis=1)
+            is_stored = (top[:, :, np.newaxis] == idx[loc][:, np.newaxis, :]).any(axis=2)
+            cand_val[:, 0:num_top][is_stored] = -np.inf
+
+            total = prod_mass/floor + \
+                    np.sum(prod[rows, idx[loc]]*(1.0/val - 1.0/floor[:, np.newaxis]), axis=1)
+            res.append(SparseMsgs.truncate(np.concatenate([top, idx[loc]], axis=1), cand_val, \
+                                           total, self.num_states, k, chunk.sparse_tol, \
+                                           chunk.sparse_k_max))
+
+        return {'vars': SparseMsgs.concatenate(res)}
 
     def _do_compute_messages(self):
         """Helper function to compute messages from variable nodes.
@@ -229,21 +620,44 @@ class VarNodes(Nodes):
             dict with key 'vars', containing the computed messages
         """
 
-        msg_in = self.message_chunks['vars'].msgs_in
+        if self.message_chunks['vars'].sparse_k > 0:
+            return self.__compute_sparse_messages()
+
+        msg_in = self._get_msgs_in('vars')
+        f_msg = self._get_out_buffer('vars', msg_in.shape)
+
+        edge_mult = self.__get_edge_mult(self._node_idxs)
 
         ###OPTIMIZE FOR DEGREE 2
-        if msg_in.shape[0] == 2:
-            f_msg = np.zeros(msg_in.shape)
-            f_msg[0, :, :] = msg_in[1, :, :]
-            f_msg[1, :, :] = msg_in[0, :, :]
+        if msg_in.shape[0] == 2 and edge_mult is None:
+            np.copyto(f_msg[0, :, :], msg_in[1, :, :])
+            np.copyto(f_msg[1, :, :], msg_in[0, :, :])
+
+            if self.__has_any_unary() or self.__evidence is not None:
+                unary = self._get_scratch_buffer('unary', (1,)+msg_in.shape[1:])
+                unary.fill(0.0)
+                unary = np.exp(self.__include_unary(unary, self._node_idxs), out=unary)
+                f_msg *= unary
+                f_msg /= np.sum(f_msg, axis=1, keepdims=True)
 
         else:
-            log_mess = np.log(msg_in)
-            all_log_sum = np.sum(log_mess, axis=0, keepdims=True)
-            self.__include_unary(all_log_sum)
-#
-            f_msg = all_log_sum-log_mess
-            denom = sp.misc.logsumexp(f_msg, axis=1, keepdims=True)
-            f_msg = np.exp(f_msg - denom)
+            log_mess = self._get_scratch_buffer('log_mess', msg_in.shape)
+            np.log(msg_in, out=log_mess)
+            all_log_sum = self._get_scratch_buffer('all_log_sum', (1,)+msg_in.shape[1:])
+            if edge_mult is None:
+                np.sum(log_mess, axis=0, keepdims=True, out=all_log_sum)
+            else:
+                #an edge of multiplicity k sends its message to one of k
+                #identical factors, so the other k-1 still count
+                weighted = self._get_scratch_buffer('weighted', msg_in.shape)
+                np.multiply(log_mess, edge_mult, out=weighted)
+                np.sum(weighted, axis=0, keepdims=True, out=all_log_sum)
+            self.__include_unary(all_log_sum, self._node_idxs)
+
+            #normalize in the log domain, as in logsumexp
+            np.subtract(all_log_sum, log_mess, out=f_msg)
+            f_msg -= np.max(f_msg, axis=1, keepdims=True)
+            np.exp(f_msg, out=f_msg)
+            f_msg /= np.sum(f_msg, axis=1, keepdims=True)
 
         return {'vars': f_msg}
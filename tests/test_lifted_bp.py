@@ -0,0 +1,75 @@
+"""Tests for the LiftedBp class."""
+
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import unittest
+import numpy as np
+from graph import BpGraph
+from graph import LiftedBp
+from nodesLib import VarNodes
+from nodesLib import PottsNodes
+
+def build_multi_edge_graph(bp_params):
+    """Builds a loopy factor graph of 2 variable nodes joined by 3 identical
+    Potts factors. Its lifted graph (2 variable nodes, 1 factor node) is
+    acyclic.
+    """
+
+    bpg = BpGraph(bp_params)
+    var_nodes = VarNodes('vars', {'num_states': 2})
+    var_nodes.create_nodes(2)
+    var_nodes.add_unaries(np.array([0]), np.array([[0.8, 0.2]]))
+    potts = PottsNodes('potts', {'alpha': 0.4, 'bp_algo': 'sum'})
+    for fac_id in potts.create_nodes(3):
+        bpg.add_edge(var_nodes, 0, potts, fac_id)
+        bpg.add_edge(var_nodes, 1, potts, fac_id)
+    bpg.add_nodes_to_schedule(var_nodes)
+    bpg.add_nodes_to_schedule(potts)
+
+    return (bpg, var_nodes)
+
+class TestLiftedBp(unittest.TestCase):
+
+    def run_quiet(self, func):
+        stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+        try:
+            func()
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+
+    def check_lifted_matches_ground(self, bp_params):
+        bp_params = dict(bp_params, tol=1e-9, iters=1000)
+
+        (ground_bpg, ground_vars) = build_multi_edge_graph(dict(bp_params))
+        ground_bpg.finalize()
+        self.run_quiet(ground_bpg.do_message_passing)
+
+        (bpg, var_nodes) = build_multi_edge_graph(dict(bp_params))
+        lifted = LiftedBp(bpg)
+        self.assertEqual(lifted.get_num_nodes(), (5, 3))
+        self.run_quiet(lifted.do_message_passing)
+
+        np.testing.assert_allclose(lifted.get_beliefs(var_nodes), \
+                                   ground_vars.get_beliefs(), atol=1e-6)
+
+    def test_acyclic_lift_of_loopy_graph(self):
+        self.check_lifted_matches_ground({})
+
+    def test_acyclic_lift_with_tree_schedule(self):
+        self.check_lifted_matches_ground({'split_components': True, \
+                                          'tree_schedule': True})
+
+    def test_evidence_is_rejected(self):
+        (bpg, var_nodes) = build_multi_edge_graph({})
+        var_nodes.set_evidence([1], [0])
+        self.assertRaises(AssertionError, LiftedBp, bpg)
+
+        var_nodes.clear_evidence()
+        self.assertEqual(LiftedBp(bpg).get_num_nodes(), (5, 3))
+
+if __name__ == '__main__':
+    unittest.main()